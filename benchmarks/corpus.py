@@ -0,0 +1,107 @@
+"""Generation of synthetic atom-mapped reaction corpora for the benchmarks."""
+
+import random
+from typing import Dict, List, NamedTuple
+
+from rdkit import Chem
+
+# Building blocks concatenated into linear molecules
+BUILDING_BLOCKS = [
+    "C",
+    "CC",
+    "C(C)C",
+    "c1ccccc1",
+    "c1ccncc1",
+    "C1CCNCC1",
+    "C(=O)",
+    "N",
+    "O",
+    "C(F)(F)",
+    "S(=O)(=O)",
+]
+TERMINAL_BLOCKS = ["C", "F", "Cl", "OC", "C#N"]
+
+# Unmapped species added to the precursors, as found in USPTO
+REAGENTS = ["O", "CCN(CC)CC", "[Na+].[Cl-]", "C1CCOC1", "ClCCl", "[Pd]", "CN(C)C=O"]
+
+# Number of building blocks of the products for each complexity
+COMPLEXITIES: Dict[str, int] = {"small": 3, "medium": 8, "large": 20}
+
+
+class SyntheticReaction(NamedTuple):
+    precursors: str
+    product: str
+    precursors_with_reagents: str
+    unmapped_precursors: str
+
+
+def generate_product(rng: random.Random, num_blocks: int) -> Chem.Mol:
+    """Generates a random molecule from a chain of building blocks."""
+    while True:
+        smiles = "".join(rng.choice(BUILDING_BLOCKS) for _ in range(num_blocks))
+        mol = Chem.MolFromSmiles(smiles + rng.choice(TERMINAL_BLOCKS))
+        if mol is not None:
+            return mol
+
+
+def generate_reaction(rng: random.Random, num_blocks: int) -> SyntheticReaction:
+    """
+    Generates a mapped reaction forming one bond of a random product: the product
+    is split at a random acyclic single bond, and the precursor on one side of the
+    bond gets an (unmapped) bromine as a leaving group.
+    """
+    while True:
+        product = generate_product(rng, num_blocks)
+        bonds = [
+            bond
+            for bond in product.GetBonds()
+            if not bond.IsInRing() and bond.GetBondType() == Chem.BondType.SINGLE
+        ]
+        if bonds:
+            break
+
+    for atom in product.GetAtoms():
+        atom.SetAtomMapNum(atom.GetIdx() + 1)
+    bond = rng.choice(bonds)
+
+    precursors = Chem.RWMol(product)
+    precursors.RemoveBond(bond.GetBeginAtomIdx(), bond.GetEndAtomIdx())
+    bromine = precursors.AddAtom(Chem.Atom(35))
+    precursors.AddBond(bond.GetBeginAtomIdx(), bromine, Chem.BondType.SINGLE)
+    for atom in precursors.GetAtoms():
+        atom.SetNoImplicit(False)
+    Chem.SanitizeMol(precursors)
+
+    precursors_smiles = Chem.MolToSmiles(precursors)
+    reagents = rng.sample(REAGENTS, rng.randint(1, 3))
+    precursors_with_reagents = ".".join([precursors_smiles] + reagents)
+
+    unmapped = Chem.Mol(precursors)
+    for atom in unmapped.GetAtoms():
+        atom.SetAtomMapNum(0)
+    unmapped_precursors = ".".join([Chem.MolToSmiles(unmapped)] + reagents)
+
+    return SyntheticReaction(
+        precursors=precursors_smiles,
+        product=Chem.MolToSmiles(product),
+        precursors_with_reagents=precursors_with_reagents,
+        unmapped_precursors=unmapped_precursors,
+    )
+
+
+def generate_corpus(
+    size: int, complexity: str, seed: int = 42
+) -> List[SyntheticReaction]:
+    """
+    Generates a corpus of synthetic reactions, identical for a given seed.
+
+    Args:
+        size: Number of reactions
+        complexity: Key of COMPLEXITIES, determining the size of the molecules
+        seed: Seed of the random number generator
+    Returns:
+        List of synthetic reactions
+    """
+    rng = random.Random(f"{seed}:{complexity}")
+    num_blocks = COMPLEXITIES[complexity]
+    return [generate_reaction(rng, num_blocks) for _ in range(size)]
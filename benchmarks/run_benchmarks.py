@@ -0,0 +1,223 @@
+"""
+Benchmarks of the hot paths of dar.chem and dar.tagging on synthetic corpora.
+
+Usage:
+    python benchmarks/run_benchmarks.py run -o results.json
+    python benchmarks/run_benchmarks.py compare baseline.json results.json
+
+The results of 'run' are stored as JSON, so that the results obtained for two
+commits can be compared; 'compare' exits with a non-zero status if any benchmark
+is slower than the baseline by more than the given threshold.
+"""
+
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import click
+import rdkit
+from corpus import COMPLEXITIES, SyntheticReaction, generate_corpus
+
+from dar import chem, tagging
+
+# Inputs of each benchmarked function, obtained from a synthetic reaction
+BENCHMARKS: Dict[
+    str, Tuple[Callable[..., Any], Callable[[SyntheticReaction], Tuple]]
+] = {
+    "get_atomic_neighbourhoods": (
+        chem.get_atomic_neighbourhoods,
+        lambda rxn: (rxn.product,),
+    ),
+    "get_atom_list": (
+        chem.get_atom_list,
+        lambda rxn: (rxn.precursors, rxn.product, chem.AtomEnvironment.CHANGED),
+    ),
+    "get_tagged_products": (
+        tagging.get_tagged_products,
+        lambda rxn: (rxn.precursors, rxn.product),
+    ),
+    "permute_tagged_smiles": (
+        tagging.permute_tagged_smiles,
+        lambda rxn: (tagging.get_tagged_products(rxn.precursors, rxn.product), 1),
+    ),
+    "remove_unmapped_components": (
+        chem.remove_unmapped_components,
+        lambda rxn: (rxn.precursors_with_reagents,),
+    ),
+    "standardise_reaction_component": (
+        chem.standardise_reaction_component,
+        lambda rxn: (rxn.unmapped_precursors,),
+    ),
+}
+
+
+def _reset_caches() -> None:
+    # Caches filled by a previous benchmark would make the results depend on the
+    # order of the benchmarks
+    fragment_cache = getattr(chem, "fragment_cache", None)
+    if fragment_cache is not None:
+        fragment_cache.clear()
+    random.seed(42)
+
+
+def run_benchmark(
+    function: Callable[..., Any], inputs: List[Tuple], repeats: int
+) -> Dict[str, float]:
+    """
+    Measures the latency of each call and the throughput over all the inputs.
+
+    Args:
+        function: Function to benchmark
+        inputs: Arguments of the calls
+        repeats: Number of passes over the inputs; the fastest pass is reported
+    Returns:
+        Dictionary with the latency statistics (in microseconds) and throughput
+        (in calls per second)
+    """
+    best_total = float("inf")
+    best_latencies: List[float] = []
+    for _ in range(repeats):
+        _reset_caches()
+        latencies = []
+        for args in inputs:
+            start = time.perf_counter()
+            function(*args)
+            latencies.append(time.perf_counter() - start)
+        total = sum(latencies)
+        if total < best_total:
+            best_total, best_latencies = total, latencies
+
+    best_latencies.sort()
+    return {
+        "num_calls": len(inputs),
+        "mean_latency_us": 1e6 * best_total / len(inputs),
+        "median_latency_us": 1e6 * statistics.median(best_latencies),
+        "p95_latency_us": 1e6 * best_latencies[int(0.95 * (len(inputs) - 1))],
+        "throughput_per_s": len(inputs) / best_total,
+    }
+
+
+def get_metadata() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = "unknown"
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "rdkit": rdkit.__version__,
+        "platform": platform.platform(),
+    }
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--output", "-o", required=True, help="JSON file for the results")
+@click.option(
+    "--sizes",
+    default="100,1000",
+    help="Comma-separated sizes of the synthetic corpora",
+)
+@click.option(
+    "--complexities",
+    default=",".join(COMPLEXITIES),
+    help="Comma-separated complexities of the molecules of the corpora",
+)
+@click.option(
+    "--benchmarks",
+    "benchmark_names",
+    default=",".join(BENCHMARKS),
+    help="Comma-separated names of the functions to benchmark",
+)
+@click.option("--repeats", default=3, help="Number of passes over each corpus")
+@click.option("--seed", default=42, help="Seed for the generation of the corpora")
+def run(
+    output: str,
+    sizes: str,
+    complexities: str,
+    benchmark_names: str,
+    repeats: int,
+    seed: int,
+):
+    """Runs the benchmarks and writes the results to a JSON file."""
+    results = []
+    for complexity in complexities.split(","):
+        for size in [int(size) for size in sizes.split(",")]:
+            corpus = generate_corpus(size, complexity, seed)
+            for name in benchmark_names.split(","):
+                function, get_inputs = BENCHMARKS[name]
+                inputs = [get_inputs(rxn) for rxn in corpus]
+                result = run_benchmark(function, inputs, repeats)
+                results.append(
+                    {
+                        "benchmark": name,
+                        "size": size,
+                        "complexity": complexity,
+                        **result,
+                    }
+                )
+                print(
+                    f"{name:32} {complexity:>7} {size:>7}: "
+                    f"{result['median_latency_us']:10.1f} us/call (median), "
+                    f"{result['throughput_per_s']:10.1f} calls/s"
+                )
+
+    with open(output, "w") as f:
+        json.dump({"metadata": get_metadata(), "results": results}, f, indent=2)
+
+
+@cli.command()
+@click.argument("baseline_file")
+@click.argument("results_file")
+@click.option(
+    "--threshold",
+    default=0.1,
+    help="Relative loss of throughput above which a benchmark counts as regressed",
+)
+def compare(baseline_file: str, results_file: str, threshold: float):
+    """Compares two result files, e.g. for two commits."""
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    with open(results_file) as f:
+        results = json.load(f)
+
+    baseline_results = {
+        (r["benchmark"], r["complexity"], r["size"]): r for r in baseline["results"]
+    }
+    print(
+        f"Baseline: {baseline['metadata']['commit'][:10]}, "
+        f"results: {results['metadata']['commit'][:10]}"
+    )
+
+    num_regressions = 0
+    for result in results["results"]:
+        key = (result["benchmark"], result["complexity"], result["size"])
+        if key not in baseline_results:
+            continue
+        speedup = result["throughput_per_s"] / baseline_results[key]["throughput_per_s"]
+        regressed = speedup < 1 - threshold
+        num_regressions += regressed
+        print(
+            f"{key[0]:32} {key[1]:>7} {key[2]:>7}: {speedup:6.2f}x"
+            + ("  REGRESSION" if regressed else "")
+        )
+
+    if num_regressions:
+        print(f"{num_regressions} benchmarks regressed by more than {threshold:.0%}.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,86 @@
+import logging
+
+import click
+
+from dar.augmentation import write_augmented_token_files
+
+
+@click.command()
+@click.option(
+    "--file_path",
+    "-f",
+    required=True,
+    help="Absolute path to the tagged (filtered) csv file output from tag_analysis",
+)
+@click.option(
+    "--output_prefix",
+    "-o",
+    required=True,
+    help="Prefix of the output '.products_tokens' and '.precursors_tokens' files",
+)
+@click.option(
+    "--number_of_permutations",
+    "-p",
+    default=1,
+    help="Number of tag permutations sampled per number of tags.",
+)
+@click.option(
+    "--max_tags",
+    default=4,
+    help="Tag combinations of max_tags or more tags are not considered.",
+)
+@click.option("--seed", default=42, help="Master seed for the permutations.")
+@click.option(
+    "--n_workers",
+    "-n",
+    default=1,
+    help="Number of worker processes.",
+)
+@click.option(
+    "--chunk_size",
+    "-c",
+    default=100000,
+    help="Number of rows read from the input file at once.",
+)
+def augment_tags(
+    file_path: str,
+    output_prefix: str,
+    number_of_permutations: int,
+    max_tags: int,
+    seed: int,
+    n_workers: int,
+    chunk_size: int,
+) -> None:
+    """
+    Augments a tagged dataset with tag permutations of the products and writes
+    tokenised source (tagged products) and target (precursors) files for
+    'onmt_preprocess'.
+
+    The permutations of each reaction are sampled with a seed derived from the
+    master seed and the reaction, so that the output files are identical for any
+    number of workers.
+
+    Args:
+        file_path (str): Absolute path to the tagged (filtered) csv file
+        output_prefix (str): Prefix of the output files
+
+    Returns:
+        The '.products_tokens' and '.precursors_tokens' files
+    """
+    logging.basicConfig(level=logging.WARNING)
+
+    print("Augmenting Tags....")
+    num_pairs = write_augmented_token_files(
+        file_path,
+        output_prefix,
+        number_of_permutations=number_of_permutations,
+        max_tags=max_tags,
+        seed=seed,
+        n_workers=n_workers,
+        chunk_size=chunk_size,
+    )
+    print(f"Wrote {num_pairs} augmented reactions.")
+
+
+if __name__ == "__main__":
+    augment_tags()
@@ -0,0 +1,118 @@
+import json
+import time
+from typing import List, Optional, Tuple
+
+import click
+import pandas as pd
+from rxn.chemutils.reaction_smiles import (
+    ReactionFormat,
+    parse_any_reaction_smiles,
+    to_reaction_smiles,
+)
+
+from dar.aam import MapperPool, MappingStatistics
+
+
+def parse_configurations(configurations: str) -> List[Tuple[int, int]]:
+    """Parses configurations such as '1x4,2x2,4x1' into (workers, threads) tuples."""
+    parsed = []
+    for configuration in configurations.split(","):
+        n_workers, threads_per_worker = configuration.strip().split("x")
+        parsed.append((int(n_workers), int(threads_per_worker)))
+    return parsed
+
+
+@click.command()
+@click.option(
+    "--file",
+    type=str,
+    required=True,
+    help="File containing the reactions to map",
+)
+@click.option(
+    "--reaction_column",
+    type=str,
+    default="rxn",
+    help="Name of the column containing reactions",
+)
+@click.option(
+    "--configurations",
+    type=str,
+    default="1x4,2x2,4x1",
+    help="Comma-separated configurations, as <workers>x<threads per worker>",
+)
+@click.option(
+    "--num_reactions",
+    default=512,
+    help="Number of reactions mapped for each configuration",
+)
+@click.option(
+    "--worker_chunk_size",
+    default=64,
+    help="Number of reactions sent to a mapping process at once",
+)
+@click.option(
+    "--output_json",
+    type=str,
+    default=None,
+    help="Optional file to write the report to",
+)
+def benchmark_mapper_pool(
+    file: str,
+    reaction_column: str,
+    configurations: str,
+    num_reactions: int,
+    worker_chunk_size: int,
+    output_json: Optional[str],
+):
+    """
+    Reports the throughput of MapperPool for several combinations of number of
+    worker processes and number of torch threads per worker.
+    """
+    df = pd.read_csv(file, usecols=[reaction_column], nrows=num_reactions)
+    reactions = [
+        to_reaction_smiles(parse_any_reaction_smiles(rxn), ReactionFormat.STANDARD)
+        for rxn in df[reaction_column]
+    ]
+
+    report = []
+    for n_workers, threads_per_worker in parse_configurations(configurations):
+        start = time.perf_counter()
+        statistics = MappingStatistics()
+        with MapperPool(
+            n_workers=n_workers,
+            threads_per_worker=threads_per_worker,
+            chunk_size=worker_chunk_size,
+        ) as mapper_pool:
+            # The first chunk includes the loading of the models by the workers
+            mapper_pool.map_reactions(reactions[:n_workers])
+            startup_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            mapper_pool.map_reactions(reactions, statistics=statistics)
+            mapping_time = time.perf_counter() - start
+
+        report.append(
+            {
+                "n_workers": n_workers,
+                "threads_per_worker": threads_per_worker,
+                "num_reactions": len(reactions),
+                "startup_time": startup_time,
+                "mapping_time": mapping_time,
+                "reactions_per_second": len(reactions) / mapping_time,
+                "failed_reactions": statistics.failed_reactions,
+            }
+        )
+        print(
+            f"{n_workers} workers x {threads_per_worker} threads: "
+            f"{len(reactions) / mapping_time:.2f} reactions/s "
+            f"(startup {startup_time:.1f} s)"
+        )
+
+    if output_json is not None:
+        with open(output_json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    benchmark_mapper_pool()
@@ -0,0 +1,101 @@
+from collections import Counter
+from itertools import islice
+from typing import Iterator, List, Tuple
+
+import click
+from rxn.chemutils.tokenization import tokenize_smiles
+
+from dar.tagging import CandidateStatus, validate_tagged_candidate_batch
+
+
+@click.command()
+@click.option(
+    "--products_file",
+    "-p",
+    required=True,
+    help="Tokenised products given to the AutoTag model, one per line",
+)
+@click.option(
+    "--autotag_file",
+    "-a",
+    required=True,
+    help="Output of the AutoTag model, n_best lines per product",
+)
+@click.option("--n_best", "-n", default=10, help="n_best used with the AutoTag model.")
+@click.option(
+    "--output_file",
+    "-o",
+    required=True,
+    help="Tokenised valid and unique tagged products, input of the disconnection "
+    "model. The 0-based index of the product of each line is written to "
+    "<output_file>.product_ids.",
+)
+@click.option(
+    "--batch_size",
+    default=1000,
+    help="Number of products validated at once.",
+)
+def canonicalize_autotag_output(
+    products_file: str,
+    autotag_file: str,
+    n_best: int,
+    output_file: str,
+    batch_size: int,
+) -> None:
+    """
+    Canonicalises the tagged products predicted by the AutoTag model, keeping the
+    tags, and removes the invalid ones (invalid SMILES or tags, or a different
+    molecule than the product) and the duplicates among the predictions for a
+    product, before the translation with the disconnection-aware model.
+    """
+    num_products = _count_lines(products_file)
+    num_predictions = _count_lines(autotag_file)
+    if num_predictions != num_products * n_best:
+        raise click.ClickException(
+            f"{autotag_file} has {num_predictions} lines, expected n_best={n_best} "
+            f"lines for each of the {num_products} products in {products_file}."
+        )
+
+    status_counts: Counter = Counter()
+    product_id = 0
+    with open(output_file, "w") as f_out, open(
+        output_file + ".product_ids", "w"
+    ) as f_ids:
+        for products, candidates in _read_batches(
+            products_file, autotag_file, n_best, batch_size
+        ):
+            for results in validate_tagged_candidate_batch(products, candidates):
+                for result in results:
+                    status_counts[result.status] += 1
+                    if result.valid and result.tagged_smiles is not None:
+                        f_out.write(tokenize_smiles(result.tagged_smiles) + "\n")
+                        f_ids.write(f"{product_id}\n")
+                product_id += 1
+
+    for status in CandidateStatus:
+        print(f"{status.name.lower()}: {status_counts[status]}")
+
+
+def _count_lines(path: str) -> int:
+    with open(path) as f:
+        return sum(1 for _ in f)
+
+
+def _read_batches(
+    products_file: str, autotag_file: str, n_best: int, batch_size: int
+) -> Iterator[Tuple[List[str], List[List[str]]]]:
+    with open(products_file) as f_products, open(autotag_file) as f_autotag:
+        products: List[str] = []
+        candidates: List[List[str]] = []
+        for product in f_products:
+            products.append(product.strip())
+            candidates.append([line.strip() for line in islice(f_autotag, n_best)])
+            if len(products) == batch_size:
+                yield products, candidates
+                products, candidates = [], []
+        if products:
+            yield products, candidates
+
+
+if __name__ == "__main__":
+    canonicalize_autotag_output()
@@ -0,0 +1,130 @@
+import csv
+from contextlib import ExitStack
+from typing import Optional
+
+import click
+from rxn.chemutils.tokenization import detokenize_smiles
+
+from dar import metrics
+from dar.cascade import OnmtTranslator, run_cascade
+
+
+@click.command()
+@click.option(
+    "--input_file",
+    "-i",
+    required=True,
+    help="File with one product per line, as SMILES or tokenised SMILES (e.g. a "
+    "'.products_tokens' file)",
+)
+@click.option(
+    "--output_file",
+    "-o",
+    required=True,
+    help="CSV file for the predictions",
+)
+@click.option("--autotag_model", required=True, help="Path to the AutoTag model")
+@click.option(
+    "--disconnection_model",
+    required=True,
+    help="Path to the disconnection-aware model",
+)
+@click.option(
+    "--n_best",
+    default=10,
+    help="Number of tagged products requested from AutoTag per product.",
+)
+@click.option(
+    "--disconnection_n_best",
+    default=1,
+    help="Number of precursor predictions per tagged product.",
+)
+@click.option("--beam_size", default=10, help="Beam size of both models.")
+@click.option("--max_length", default=200, help="Maximal length of the predictions.")
+@click.option(
+    "--batch_size",
+    default=64,
+    help="Number of products, and of tagged products, translated at once.",
+)
+@click.option("--gpu", default=-1, help="Index of the GPU, the CPU if negative.")
+@click.option(
+    "--metrics_file",
+    type=str,
+    default=None,
+    help="Writes counters and timings of the stages to this file, in the Prometheus "
+    "text format if it ends with '.prom', as JSON otherwise.",
+)
+def cascade(
+    input_file: str,
+    output_file: str,
+    autotag_model: str,
+    disconnection_model: str,
+    n_best: int,
+    disconnection_n_best: int,
+    beam_size: int,
+    max_length: int,
+    batch_size: int,
+    gpu: int,
+    metrics_file: Optional[str],
+) -> None:
+    """
+    Predicts diverse precursors for products by running the AutoTag and the
+    disconnection-aware models in a cascade, as described in the README ('Improving
+    Class Diversity at Model Inference'), without intermediate files.
+
+    The tagged products proposed by AutoTag are canonicalised, and the invalid and
+    duplicate ones dropped, before the precursors are predicted for them.
+
+    The output CSV file contains one row per precursor prediction, with the columns
+    product, tagged_product, rank (of the prediction for the tagged product) and
+    precursors.
+    """
+    if metrics_file is not None:
+        metrics.enable()
+
+    translator_kwargs = dict(
+        beam_size=beam_size, max_length=max_length, batch_size=batch_size, gpu=gpu
+    )
+    num_products = 0
+    num_candidates = 0
+    num_tagged_products = 0
+    with ExitStack() as stack:
+        # The models are closed whatever happens
+        autotag = stack.enter_context(
+            OnmtTranslator(autotag_model, **translator_kwargs)
+        )
+        disconnection = stack.enter_context(
+            OnmtTranslator(disconnection_model, **translator_kwargs)
+        )
+        f_in = stack.enter_context(open(input_file))
+        f_out = stack.enter_context(open(output_file, "w", newline=""))
+        products = (detokenize_smiles(line.strip()) for line in f_in)
+        writer = csv.writer(f_out)
+        writer.writerow(["product", "tagged_product", "rank", "precursors"])
+        for result in run_cascade(
+            products,
+            autotag,
+            disconnection,
+            n_best=n_best,
+            disconnection_n_best=disconnection_n_best,
+            batch_size=batch_size,
+        ):
+            num_products += 1
+            num_candidates += result.num_candidates
+            num_tagged_products += len(result.predictions)
+            for prediction in result.predictions:
+                for rank, precursors in enumerate(prediction.precursors, 1):
+                    writer.writerow(
+                        [result.product, prediction.tagged_product, rank, precursors]
+                    )
+
+    print(
+        f"Predicted precursors for {num_tagged_products} valid and unique tagged "
+        f"products out of {num_candidates} proposed for {num_products} products."
+    )
+    if metrics_file is not None:
+        metrics.write_metrics(metrics_file)
+
+
+if __name__ == "__main__":
+    cascade()
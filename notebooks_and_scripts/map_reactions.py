@@ -1,15 +1,21 @@
 # Imports
+import os
+import time
+from contextlib import ExitStack
+from typing import Iterable, List, Optional
+
 import click
-import pandas as pd
 from rxn.chemutils.reaction_smiles import (
     ReactionFormat,
     parse_any_reaction_smiles,
     to_reaction_smiles,
 )
-from rxn.utilities.containers import chunker
-from rxnmapper import RXNMapper
 
-from dar.aam import map_reactions_with_error_handling
+from dar import metrics
+from dar.aam import MapperPool, MappingCache, MappingStatistics
+from dar.checkpoint import ChunkCheckpoint
+from dar.dedup import DuplicateStore
+from dar.io import DataFormat, get_output_path, iter_table_chunks, write_part
 
 
 @click.command()
@@ -25,35 +31,243 @@ from dar.aam import map_reactions_with_error_handling
     default="rxn",
     help="Enter the name of the column containing reactions",
 )
-def map_reactions(file: str, reaction_column: str):
+@click.option(
+    "--batch_size",
+    default=64,
+    help="Maximal number of reactions mapped in one batch",
+)
+@click.option(
+    "--token_budget",
+    default=16384,
+    help="Maximal number of padded tokens in one batch",
+)
+@click.option(
+    "--max_tokens",
+    default=512,
+    help="Reactions with more tokens are not mapped",
+)
+@click.option(
+    "--chunk_size",
+    default=4096,
+    help="Number of reactions read, sorted by length and checkpointed together",
+)
+@click.option(
+    "--cache_path",
+    type=str,
+    default=None,
+    help="SQLite file caching the mapping results across runs",
+)
+@click.option(
+    "--cache_size",
+    type=int,
+    default=None,
+    help="Maximal number of cached results, unbounded by default",
+)
+@click.option(
+    "--n_workers",
+    "-n",
+    default=1,
+    help="Number of mapping processes, each with its own model",
+)
+@click.option(
+    "--threads_per_worker",
+    type=int,
+    default=None,
+    help="Number of torch threads per mapping process, torch default if not given",
+)
+@click.option(
+    "--worker_chunk_size",
+    default=256,
+    help="Number of reactions sent to a mapping process at once",
+)
+@click.option(
+    "--output_format",
+    type=click.Choice([data_format.value for data_format in DataFormat]),
+    default="csv",
+    help="Format of the output. Parquet and Arrow outputs are directories with "
+    "one part file per chunk.",
+)
+@click.option(
+    "--deduplicate",
+    type=click.Choice(["none", "exact", "canonical"]),
+    default="none",
+    help="Maps each unique reaction of the file once and copies the result to its "
+    "duplicates, identical strings ('exact') or identical canonical reactions "
+    "('canonical'), in later chunks as well. Adds the 'duplicate_count' column, "
+    "the number of rows of the file with the same reaction, counted in a first "
+    "pass over the file.",
+)
+@click.option(
+    "--metrics_file",
+    type=str,
+    default=None,
+    help="Writes counters and timings of the stages (RXNMapper calls, failures by "
+    "reason, cache hits, rows/s) to this file, in the Prometheus text format if it "
+    "ends with '.prom', as JSON otherwise.",
+)
+def map_reactions(
+    file: str,
+    reaction_column: str,
+    batch_size: int,
+    token_budget: int,
+    max_tokens: int,
+    chunk_size: int,
+    cache_path: Optional[str],
+    cache_size: Optional[int],
+    n_workers: int,
+    threads_per_worker: Optional[int],
+    worker_chunk_size: int,
+    output_format: str,
+    deduplicate: str,
+    metrics_file: Optional[str],
+):
     """
     Maps reactions from a file containing unmapped reaction SMILES
 
+    The results are appended to the output file chunk by chunk, and the progress
+    is recorded in a '.progress.json' manifest next to it. Running the same
+    command again after an interruption skips the chunks already mapped; the final
+    file is identical to the one of an uninterrupted run.
+
     Args:
-        file (str): Absolute path to a file containing reaction SMILES, one on each line
+        file (str): Absolute path to a file containing reaction SMILES, one on each
+            line. Parquet and Arrow files are read according to their extension.
 
     Returns:
         A file with the original unmapped rection, the atom-mapped reaction
     """
-    df = pd.read_csv(file)
-    rxns = df[reaction_column].to_list()
-    df[reaction_column] = [
-        to_reaction_smiles(parse_any_reaction_smiles(rxn), ReactionFormat.STANDARD)
-        for rxn in rxns
-    ]
+    data_format = DataFormat(output_format)
+    output_path = get_output_path(file, "mapped", data_format)
+    checkpoint = ChunkCheckpoint(
+        output_path,
+        parameters=dict(
+            file=os.path.abspath(file),
+            file_size=os.path.getsize(file),
+            reaction_column=reaction_column,
+            chunk_size=chunk_size,
+            max_tokens=max_tokens,
+            output_format=output_format,
+            deduplicate=deduplicate,
+        ),
+    )
+    if checkpoint.finished:
+        print(f"{output_path} is already complete.")
+        return
+    if checkpoint.resuming:
+        print(f"Resuming after {checkpoint.completed_chunks} mapped chunks.")
+
+    if metrics_file is not None:
+        # Before creating the pool, so that its workers record metrics as well
+        metrics.enable()
 
     # Remap reactions using the predicted precursors and apply retagging
     # Used to determine which bond was broken
-    rxn_mapper = RXNMapper()
+    mapper_pool = MapperPool(
+        n_workers=n_workers,
+        threads_per_worker=threads_per_worker,
+        chunk_size=worker_chunk_size,
+        max_tokens=max_tokens,
+        token_budget=token_budget,
+        max_batch_size=batch_size,
+    )
+
+    cache = (
+        MappingCache(cache_path, max_entries=cache_size)
+        if cache_path is not None
+        else None
+    )
+
+    num_reactions = 0
+    num_duplicates = 0
+    mapping_time = 0.0
+    statistics = MappingStatistics()
+    with ExitStack() as stack:
+        stack.enter_context(mapper_pool)
+        output = None
+        if data_format is DataFormat.CSV:
+            output = stack.enter_context(checkpoint.open_output())
+
+        duplicate_store = None
+        if deduplicate != "none":
+            # Next to the output rather than in the (possibly small) /tmp
+            duplicate_store = stack.enter_context(
+                DuplicateStore(
+                    canonical=deduplicate == "canonical",
+                    directory=os.path.dirname(os.path.abspath(output_path)),
+                )
+            )
+            # The counts cover the chunks mapped before a resumption as well; the
+            # results of these chunks are not kept, so their duplicates in the
+            # next chunks are mapped again (or found in the mapping cache)
+            for df in iter_table_chunks(file, chunk_size, columns=[reaction_column]):
+                with metrics.stage("duplicate_counting", rows=len(df)):
+                    duplicate_store.count(standardise_reactions(df[reaction_column]))
+
+        for i, df in enumerate(iter_table_chunks(file, chunk_size)):
+            if i < checkpoint.completed_chunks:
+                continue
 
-    results = []
-    batch_size = 64
-    for chunk in chunker(df[reaction_column].to_list(), batch_size):
-        results.extend(map_reactions_with_error_handling(rxn_mapper, chunk))
+            with metrics.stage("standardisation", rows=len(df)):
+                df[reaction_column] = standardise_reactions(df[reaction_column])
+            start = time.perf_counter()
+            if duplicate_store is None:
+                with metrics.stage("mapping", rows=len(df)):
+                    df["mapped_rxn"] = mapper_pool.map_reactions(
+                        df[reaction_column].to_list(),
+                        cache=cache,
+                        statistics=statistics,
+                    )
+            else:
+                with metrics.stage("deduplication", rows=len(df)):
+                    stored = duplicate_store.deduplicate(df[reaction_column].to_list())
+                missing = [stored.unique.reactions[i] for i in stored.missing]
+                with metrics.stage("mapping", rows=len(missing)):
+                    mapped_reactions = stored.fill(
+                        mapper_pool.map_reactions(
+                            missing, cache=cache, statistics=statistics
+                        )
+                    )
+                duplicate_store.put(stored, mapped_reactions)
+                df["mapped_rxn"] = stored.unique.broadcast(mapped_reactions)
+                df["duplicate_count"] = stored.unique.row_counts()
+                num_duplicates += len(df) - len(missing)
+            mapping_time += time.perf_counter() - start
 
-    df["mapped_rxn"] = results
+            with metrics.stage("writing", rows=len(df)):
+                if output is None:
+                    write_part(df, output_path, i, data_format)
+                else:
+                    df.to_csv(output, index=False, header=i == 0)
+            checkpoint.chunk_done(output)
+            num_reactions += len(df)
 
-    df.to_csv(file.split(".")[0] + ".mapped.csv", index=False)
+    checkpoint.job_done()
+    print(
+        f"Mapped {num_reactions} reactions with {statistics.batch_calls} calls to "
+        f"RXNMapper, of which {statistics.failed_batch_calls} failed; "
+        f"{statistics.failed_reactions} reactions could not be mapped and "
+        f"{statistics.rejected_reactions} exceeded {max_tokens} tokens."
+    )
+    if deduplicate != "none":
+        print(f"Skipped {num_duplicates} duplicate reactions.")
+    if num_reactions:
+        print(
+            f"Throughput with {n_workers} workers and {threads_per_worker} threads "
+            f"per worker: {num_reactions / mapping_time:.2f} reactions/s."
+        )
+    if cache is not None:
+        print(f"Cache: {cache.hits} hits, {cache.misses} misses.")
+        cache.close()
+    if metrics_file is not None:
+        metrics.write_metrics(metrics_file)
+
+
+def standardise_reactions(reactions: Iterable[str]) -> List[str]:
+    """Reaction SMILES in the standard format, from any reaction format."""
+    return [
+        to_reaction_smiles(parse_any_reaction_smiles(rxn), ReactionFormat.STANDARD)
+        for rxn in reactions
+    ]
 
 
 if __name__ == "__main__":
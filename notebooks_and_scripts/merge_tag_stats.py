@@ -0,0 +1,57 @@
+from typing import Tuple
+
+import click
+
+from dar.io import DataFormat
+from dar.stats import get_stats_path, merge_stats_files, write_reports
+
+
+@click.command()
+@click.option(
+    "--stats_files",
+    "-i",
+    multiple=True,
+    required=True,
+    help="Statistics file ('.tag_stats.json') of a shard, output from "
+    "tag_analysis. Can be given several times.",
+)
+@click.option(
+    "--output_path",
+    "-o",
+    required=True,
+    help="Path from which the report paths are derived, e.g. 'data/uspto.csv' "
+    "for 'data/uspto.tagged_stats.csv'. The merged statistics are also saved, "
+    "to 'data/uspto.tag_stats.json', so that they can be merged again.",
+)
+@click.option(
+    "--output_format",
+    type=click.Choice([data_format.value for data_format in DataFormat]),
+    default="csv",
+    help="Format of the reports.",
+)
+@click.option(
+    "--num_tag_rows",
+    default=10,
+    help="Numbers of tags below this value are reported individually in the "
+    "'tagged_stats' report, the remaining reactions being counted together.",
+)
+def merge_tag_stats(
+    stats_files: Tuple[str, ...],
+    output_path: str,
+    output_format: str,
+    num_tag_rows: int,
+) -> None:
+    """
+    Combines the tag statistics of the shards of a dataset, output from
+    'tag_analysis.py', into the reports for the whole dataset: 'tagged_stats',
+    'tag_combination_stats' and 'tagged_element_stats'.
+    """
+    stats = merge_stats_files(stats_files)
+    print(f"Merged the statistics of {stats.num_reactions} reactions.")
+
+    stats.save(get_stats_path(output_path))
+    write_reports(stats, output_path, DataFormat(output_format), num_rows=num_tag_rows)
+
+
+if __name__ == "__main__":
+    merge_tag_stats()
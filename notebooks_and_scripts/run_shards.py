@@ -0,0 +1,250 @@
+import os
+import shlex
+import subprocess
+import sys
+from typing import Optional
+
+import click
+
+from dar.io import DataFormat, get_output_path
+from dar.sharding import (
+    ShardClaim,
+    ShardManifest,
+    create_shard_run,
+    is_shard_done,
+    mark_shard_done,
+    merge_shards,
+    promote_shard_run,
+    remove_shard_run,
+    split_dataset,
+)
+
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+@click.group()
+def run_shards() -> None:
+    """
+    Runs the map -> tag -> filter pipeline of 'map_reactions.py' and
+    'tag_analysis.py' over hash-partitioned shards of a dataset, on any number of
+    nodes sharing a work directory:
+
+        python run_shards.py split -f data/uspto.csv -w /shared/uspto -s 64
+        python run_shards.py work -w /shared/uspto  # on each node
+        python run_shards.py merge -w /shared/uspto
+
+    The merged outputs are the files of a single-node run on the dataset.
+    """
+
+
+@run_shards.command()
+@click.option("--file_path", "-f", required=True, help="Dataset to split.")
+@click.option(
+    "--work_dir", "-w", required=True, help="Work directory on a shared filesystem."
+)
+@click.option("--num_shards", "-s", type=int, required=True, help="Number of shards.")
+@click.option(
+    "--reaction_column",
+    default="rxn",
+    help="Column containing the reactions.",
+)
+@click.option(
+    "--chunk_size",
+    "-c",
+    default=100000,
+    help="Number of rows read from the dataset at once.",
+)
+def split(
+    file_path: str,
+    work_dir: str,
+    num_shards: int,
+    reaction_column: str,
+    chunk_size: int,
+) -> None:
+    """Splits a dataset into shards, once for all the nodes."""
+    manifest = split_dataset(
+        file_path,
+        work_dir,
+        num_shards,
+        reaction_column=reaction_column,
+        chunk_size=chunk_size,
+    )
+    print(f"Split {manifest.num_rows} reactions into {manifest.num_shards} shards.")
+
+
+@run_shards.command()
+@click.option(
+    "--work_dir", "-w", required=True, help="Work directory on a shared filesystem."
+)
+@click.option(
+    "--output_format",
+    type=click.Choice([data_format.value for data_format in DataFormat]),
+    default="csv",
+    help="Format of the outputs of the shards.",
+)
+@click.option(
+    "--mapping_options",
+    default="",
+    help="Options passed to map_reactions.py, e.g. '--n_workers 4 --cache_path "
+    "cache.sqlite'.",
+)
+@click.option(
+    "--tagging_options",
+    default="",
+    help="Options passed to tag_analysis.py, e.g. '-n 8 --extract_templates'.",
+)
+@click.option(
+    "--stale_after",
+    type=float,
+    default=None,
+    help="Number of seconds after which the claim of a shard that was not "
+    "refreshed (its node crashed) is taken over. Never by default.",
+)
+@click.option(
+    "--heartbeat",
+    default=60.0,
+    help="Number of seconds between refreshes of the claim of a running shard.",
+)
+def work(
+    work_dir: str,
+    output_format: str,
+    mapping_options: str,
+    tagging_options: str,
+    stale_after: Optional[float],
+    heartbeat: float,
+) -> None:
+    """
+    Claims the shards that no other node is processing, one after the other, and
+    runs the mapping and tagging of each, in a directory of its own for each
+    claim: a node whose claim was taken over never writes to the outputs of the
+    new owner, and the first run of a shard to complete provides its outputs.
+
+    A shard whose stages fail is released, to be claimed again by the next run on
+    any node, which resumes it (see 'map_reactions.py'), and the other shards are
+    processed before reporting the failures.
+    """
+    if stale_after is not None and stale_after <= heartbeat:
+        raise click.BadParameter(
+            "must be longer than the heartbeat.", param_hint="--stale_after"
+        )
+
+    manifest = ShardManifest.load(work_dir)
+    data_format = DataFormat(output_format)
+    num_processed = 0
+    failed = []
+    for shard_name in manifest.shard_names:
+        if is_shard_done(work_dir, shard_name):
+            continue
+        claim = ShardClaim.acquire(
+            work_dir, shard_name, stale_after=stale_after, heartbeat=heartbeat
+        )
+        if claim is None:
+            continue
+
+        print(f"Processing {shard_name}....")
+        input_path = create_shard_run(work_dir, claim)
+        error = None
+        with claim:
+            try:
+                subprocess.run(
+                    [
+                        sys.executable,
+                        os.path.join(SCRIPTS_DIRECTORY, "map_reactions.py"),
+                        "--file",
+                        input_path,
+                        "--reaction_column",
+                        manifest.reaction_column,
+                        "--output_format",
+                        output_format,
+                        *shlex.split(mapping_options),
+                    ],
+                    check=True,
+                )
+                subprocess.run(
+                    [
+                        sys.executable,
+                        os.path.join(SCRIPTS_DIRECTORY, "tag_analysis.py"),
+                        "--file_path",
+                        get_output_path(input_path, "mapped", data_format),
+                        "--output_format",
+                        output_format,
+                        *shlex.split(tagging_options),
+                    ],
+                    check=True,
+                )
+            except subprocess.CalledProcessError as e:
+                error = e
+        if error is not None:
+            print(f"{shard_name} failed: {error}")
+            failed.append(shard_name)
+            claim.release()
+            continue
+        if not claim.owned:
+            print(f"{shard_name} was taken over by another node.")
+            remove_shard_run(work_dir, claim)
+            continue
+        if not promote_shard_run(work_dir, claim):
+            print(f"{shard_name} was completed by another node first.")
+        mark_shard_done(work_dir, shard_name)
+        num_processed += 1
+
+    num_done = sum(is_shard_done(work_dir, name) for name in manifest.shard_names)
+    print(
+        f"Processed {num_processed} shards; {num_done} of {manifest.num_shards} "
+        "shards are done."
+    )
+    if failed:
+        raise click.ClickException(
+            f"{len(failed)} shards failed and were released: {', '.join(failed)}."
+        )
+
+
+@run_shards.command()
+@click.option(
+    "--work_dir", "-w", required=True, help="Work directory on a shared filesystem."
+)
+@click.option(
+    "--output_path",
+    "-o",
+    default=None,
+    help="Path from which the output paths are derived, e.g. 'data/uspto.csv' for "
+    "'data/uspto.tagged.csv'. Defaults to the path of the dataset.",
+)
+@click.option(
+    "--output_format",
+    type=click.Choice([data_format.value for data_format in DataFormat]),
+    default="csv",
+    help="Format of the outputs of the shards, and of the merged outputs.",
+)
+@click.option(
+    "--num_tag_rows",
+    default=10,
+    help="Numbers of tags below this value are reported individually in the "
+    "'tagged_stats' report.",
+)
+@click.option(
+    "--chunk_size",
+    "-c",
+    default=100000,
+    help="Number of rows read from each shard at once.",
+)
+def merge(
+    work_dir: str,
+    output_path: Optional[str],
+    output_format: str,
+    num_tag_rows: int,
+    chunk_size: int,
+) -> None:
+    """Merges the outputs of the shards, once all of them are done."""
+    merge_shards(
+        work_dir,
+        output_path=output_path,
+        data_format=DataFormat(output_format),
+        num_tag_rows=num_tag_rows,
+        chunk_size=chunk_size,
+    )
+    print("Merged the outputs of the shards.")
+
+
+if __name__ == "__main__":
+    run_shards()
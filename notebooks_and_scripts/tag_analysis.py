@@ -1,9 +1,25 @@
+import multiprocessing.pool
+import os
+from contextlib import ExitStack
+from typing import Iterable, Optional
+
 import click
 import pandas as pd
-from rxn.chemutils.utils import remove_atom_mapping
 
-from dar.chem import remove_unmapped_components, standardise_reaction_component
-from dar.tagging import find_number_tags, get_tagged_products, return_tag_combinations
+from dar import metrics
+from dar.chem import clean_mapped_components, fragment_cache
+from dar.dedup import DuplicateStore
+from dar.io import (
+    DataFormat,
+    TableWriter,
+    get_output_path,
+    iter_table_chunks,
+    read_table,
+)
+from dar.parallel import create_pool
+from dar.stats import TagStatistics, get_stats_path, write_reports
+from dar.tagging import TaggedProduct, tag_reactions
+from dar.templates import TemplateTable
 
 
 @click.command()
@@ -18,8 +34,91 @@ from dar.tagging import find_number_tags, get_tagged_products, return_tag_combin
     default=False,
     help="Removes unmapped species from reactants.",
 )
+@click.option(
+    "--extract_templates",
+    is_flag=True,
+    help="Extracts the retro template of each reaction, adds the 'template_hash' "
+    "column and writes the distinct templates with their counts to the "
+    "'templates' file.",
+)
+@click.option(
+    "--template_radius",
+    default=1,
+    help="Number of bonds around the reaction centre included in the templates.",
+)
+@click.option(
+    "--n_workers",
+    "-n",
+    default=1,
+    help="Number of worker processes used for tagging and reactant cleanup.",
+)
+@click.option(
+    "--worker_chunksize",
+    default=64,
+    help="Number of reactions sent to a worker at once.",
+)
+@click.option(
+    "--max_tags",
+    default=4,
+    help="Tag combinations of max_tags or more tags are not counted.",
+)
+@click.option(
+    "--chunk_size",
+    "-c",
+    type=int,
+    default=None,
+    help="Streams the input file in chunks of this many rows, keeping memory flat. "
+    "By default the whole file is read at once.",
+)
+@click.option(
+    "--fragment_cache_file",
+    type=str,
+    default=None,
+    help="JSON file with canonical fragments, loaded if it exists and saved at the "
+    "end, to reuse the canonicalisation cache between runs.",
+)
+@click.option(
+    "--output_format",
+    type=click.Choice([data_format.value for data_format in DataFormat]),
+    default="csv",
+    help="Format of the output files.",
+)
+@click.option(
+    "--deduplicate",
+    is_flag=True,
+    help="Tags each unique mapped reaction once and copies the results to its "
+    "duplicates, in later chunks as well. Adds the 'duplicate_count' column, the "
+    "number of rows of the file with the same mapped reaction, counted in a first "
+    "pass over the file.",
+)
+@click.option(
+    "--num_tag_rows",
+    default=10,
+    help="Numbers of tags below this value are reported individually in the "
+    "'tagged_stats' report, the remaining reactions being counted together.",
+)
+@click.option(
+    "--metrics_file",
+    type=str,
+    default=None,
+    help="Writes counters and timings of the stages (RDKit parses, failures by "
+    "reason, cache hits, rows/s) to this file, in the Prometheus text format if it "
+    "ends with '.prom', as JSON otherwise.",
+)
 def analyse_tags(
-    file_path: str, remove_unmapped: bool, extract_templates: bool
+    file_path: str,
+    remove_unmapped: bool,
+    extract_templates: bool,
+    template_radius: int,
+    n_workers: int,
+    worker_chunksize: int,
+    max_tags: int,
+    chunk_size: Optional[int],
+    fragment_cache_file: Optional[str],
+    output_format: str,
+    deduplicate: bool,
+    num_tag_rows: int,
+    metrics_file: Optional[str],
 ) -> None:
     """
     Given an output file from 'rxn_reaction_preprocessing' containing atom-mapped reaction SMILES:
@@ -27,62 +126,258 @@ def analyse_tags(
     - Removes unmapped scpecies (optional)
     - Calculates the number of tagged atoms
     - Calculates the number of possible tag permutations
-    - Generates a report on the distribution of atom tags in the dataset
+    - Generates reports on the distribution of atom tags in the dataset, from
+      statistics saved to the 'tag_stats.json' file, which 'merge_tag_stats.py'
+      combines across shards of a dataset
+    - Extracts the reaction templates and counts the distinct ones (optional)
     - Filters the dataset for:
         - Reactions with 0 tagged atoms (i.e. no disconnection, no change in atom environments)
         - Reactions with >10 tagged atoms (too many bond changes for a reaction to reasonably occur, low frequency)
 
+    With --chunk_size, the input is streamed in chunks and all outputs are appended
+    chunk by chunk, so that memory usage does not grow with the dataset size.
+
+    The input may also be a Parquet or Arrow file (or dataset directory), e.g. from
+    'map_reactions.py', and the outputs written as such with --output_format.
+
     Args:
         file (str): Absolute path to the output file from 'rxn_reaction_preprocessing' containing atom-mapped reaction SMILES
 
     Returns:
         A filtered csv file with the tagged products, optionally removal of unmapped species
-        csv report of atom tag distribution across the dataset
+        csv reports of atom tag distribution across the dataset
     """
-    print("Reading Data....")
-    data = pd.read_csv(file_path)
-    data[["reactants", "products"]] = data["mapped_rxn"].str.split(">>", expand=True)
+    if metrics_file is not None:
+        metrics.enable()
+    if fragment_cache_file is not None and os.path.exists(fragment_cache_file):
+        fragment_cache.load(fragment_cache_file)
 
-    print("Tagging Products....")
-    data["tagged_products"] = data.apply(
-        lambda x: get_tagged_products(x["reactants"], x["products"]), axis=1
+    if chunk_size is None:
+        print("Reading Data....")
+        chunks: Iterable[pd.DataFrame] = [read_table(file_path)]
+    else:
+        print(f"Streaming Data in chunks of {chunk_size} rows....")
+        chunks = iter_table_chunks(file_path, chunk_size)
+
+    data_format = DataFormat(output_format)
+    tag_stats = TagStatistics()
+    template_table: Optional[TemplateTable] = None
+    duplicate_store: Optional[DuplicateStore] = None
+    with ExitStack() as stack:
+        # Created once, after enabling the metrics and loading the fragment cache,
+        # and reused for all the chunks
+        pool = create_pool(n_workers)
+        if pool is not None:
+            stack.enter_context(pool)
+        tagged_writer = stack.enter_context(
+            TableWriter(get_output_path(file_path, "tagged", data_format))
+        )
+        filtered_writer = stack.enter_context(
+            TableWriter(get_output_path(file_path, "tagged_filtered", data_format))
+        )
+        if extract_templates:
+            # Closed, and its temporary file removed, even if tagging fails
+            template_table = stack.enter_context(
+                TemplateTable(get_output_path(file_path, "templates", data_format))
+            )
+        if deduplicate:
+            duplicate_store = stack.enter_context(
+                DuplicateStore(
+                    canonical=False,
+                    directory=os.path.dirname(os.path.abspath(file_path)),
+                )
+            )
+            counted_chunks = (
+                chunks
+                if chunk_size is None
+                else iter_table_chunks(file_path, chunk_size, columns=["mapped_rxn"])
+            )
+            for data in counted_chunks:
+                with metrics.stage("duplicate_counting", rows=len(data)):
+                    duplicate_store.count(data["mapped_rxn"].fillna(""))
+        for data in chunks:
+            data = tag_data(
+                data,
+                remove_unmapped,
+                n_workers,
+                worker_chunksize,
+                max_tags,
+                duplicate_store=duplicate_store,
+                template_table=template_table,
+                template_radius=template_radius,
+                pool=pool,
+            )
+            tag_stats.update(data)
+            with metrics.stage("writing", rows=len(data)):
+                tagged_writer.write(data)
+
+            with metrics.stage("filtering", rows=len(data)):
+                data = filter_tagged_data(data)
+            with metrics.stage("writing", rows=len(data)):
+                filtered_writer.write(data)
+
+    print(
+        f"Fragment cache: {fragment_cache.hits} hits, {fragment_cache.misses} misses."
     )
+    if template_table is not None:
+        print(f"Found {len(template_table)} distinct templates.")
+    if fragment_cache_file is not None:
+        fragment_cache.save(fragment_cache_file)
+
+    tag_stats.save(get_stats_path(file_path))
+    write_reports(tag_stats, file_path, data_format, num_rows=num_tag_rows)
+
+    if metrics_file is not None:
+        metrics.write_metrics(metrics_file)
+
+
+def tag_data(
+    data: pd.DataFrame,
+    remove_unmapped: bool,
+    n_workers: int,
+    worker_chunksize: int,
+    max_tags: int = 4,
+    duplicate_store: Optional[DuplicateStore] = None,
+    template_table: Optional[TemplateTable] = None,
+    template_radius: int = 1,
+    pool: Optional[multiprocessing.pool.Pool] = None,
+) -> pd.DataFrame:
+    """
+    Tags the products and cleans the reactants of a dataframe of atom-mapped
+    reactions, and calculates the number of tags and tag combinations.
 
-    if remove_unmapped:
-        data["reactants"] = data["reactants"].apply(remove_unmapped_components)
+    Args:
+        data: Dataframe containing atom-mapped reactions in the 'mapped_rxn' column
+        remove_unmapped: Removes unmapped species from reactants.
+        n_workers: Number of worker processes used for tagging and reactant cleanup.
+        worker_chunksize: Number of reactions sent to a worker at once.
+        max_tags: Tag combinations of max_tags or more tags are not counted.
+        duplicate_store: If given, only tags and cleans the mapped reactions not
+                         processed in the previous chunks, and adds the
+                         'duplicate_count' column, see 'DuplicateStore'.
+        template_table: If given, also extracts the templates of the reactions,
+                        from the molecules parsed for tagging, counts them in this
+                        table and adds the 'template_hash' column.
+        template_radius: Number of bonds around the reaction centre included in
+                         the templates.
+        pool: Pool of n_workers processes reused across chunks, see 'create_pool'.
 
-    data["reactants"] = data["reactants"].apply(remove_atom_mapping)
-    data["reactants"] = data["reactants"].apply(standardise_reaction_component)
+    Returns:
+        The dataframe with the reactants, products, tagged_products, num_tags and
+        tag_combinations columns, and the template_hash column (empty for the
+        reactions whose template could not be extracted) if templates are extracted
+    """
+    # Not with 'expand=True', which fails on chunks without any reaction
+    sides = data["mapped_rxn"].astype(object).str.split(">>")
+    data["reactants"] = sides.str[0]
+    data["products"] = sides.str[1]
+
+    reactions = data["mapped_rxn"]
+    reactants = data["reactants"]
+    stored = None
+    if duplicate_store is not None:
+        with metrics.stage("deduplication", rows=len(data)):
+            stored = duplicate_store.deduplicate(
+                data["mapped_rxn"].fillna("").to_list()
+            )
+        rows = [stored.unique.indices[i] for i in stored.missing]
+        reactions = reactions.iloc[rows]
+        reactants = reactants.iloc[rows]
+        print(f"Found {len(data) - len(rows)} duplicate reactions.")
+
+    print("Tagging Products....")
+    tagged = []
+    num_failed = 0
+    with metrics.stage("tagging", rows=len(reactions)):
+        for result in tag_reactions(
+            reactions,
+            n_workers=n_workers,
+            chunksize=worker_chunksize,
+            max_tags=max_tags,
+            template_radius=template_radius if template_table is not None else None,
+            pool=pool,
+        ):
+            if result.tagged is None:
+                # Failed reactions get no tags and are removed by the filtering
+                num_failed += 1
+                tagged.append(TaggedProduct("", set(), 0, 0))
+            else:
+                tagged.append(result.tagged)
+    print(f"Failed to tag {num_failed} reactions.")
+
+    template_hashes = [""] * len(tagged)
+    if template_table is not None:
+        # Each unique reaction counts for all its duplicates in the dataset, when
+        # it first occurs (it may be tagged again if its result was not kept)
+        counts = (
+            [stored.unique.counts[i] if stored.first[i] else 0 for i in stored.missing]
+            if stored is not None
+            else [1] * len(tagged)
+        )
+        template_hashes = []
+        for product, reaction, count in zip(tagged, reactions.fillna(""), counts):
+            if product.template is None:
+                template_hashes.append("")
+            else:
+                template_hashes.append(
+                    template_table.add(product.template, reaction, count)
+                )
+        print(f"Failed to extract {template_hashes.count('')} templates.")
+
+    with metrics.stage("reactant_cleanup", rows=len(reactants)):
+        cleaned_reactants = list(
+            clean_mapped_components(
+                reactants,
+                remove_unmapped,
+                n_workers=n_workers,
+                chunksize=worker_chunksize,
+                pool=pool,
+            )
+        )
+
+    if duplicate_store is not None and stored is not None:
+        results = stored.fill(list(zip(tagged, cleaned_reactants, template_hashes)))
+        duplicate_store.put(stored, results)
+        results = stored.unique.broadcast(results)
+        tagged = [result[0] for result in results]
+        cleaned_reactants = [result[1] for result in results]
+        template_hashes = [result[2] for result in results]
+        data["duplicate_count"] = stored.unique.row_counts()
+
+    data["tagged_products"] = [result.tagged_products for result in tagged]
+    data["reactants"] = cleaned_reactants
 
     print("Calculating Num Tags....")
-    data["num_tags"] = data["tagged_products"].apply(find_number_tags)
-    data.to_csv(file_path.split(".")[0] + ".tagged.csv", header=True, index=False)
+    data["num_tags"] = [result.num_tags for result in tagged]
 
     print("Calculating Num Tag Combinations....")
-    data["tag_combinations"] = data["tagged_products"].apply(return_tag_combinations)
+    data["tag_combinations"] = [result.tag_combinations for result in tagged]
 
-    data.to_csv(file_path.split(".")[0] + ".tagged.csv", header=True, index=False)
+    if template_table is not None:
+        data["template_hash"] = template_hashes
 
-    tag_stats = data.groupby(["num_tags"]).size()
-    tag_stats_df = data.groupby(["num_tags"]).size()[:10].to_frame(name="counts")
-    tag_stats_df.reset_index(inplace=True)
-    counts_gte_ten = tag_stats[10:].sum()
-    tag_stats_df.loc[len(tag_stats_df.index)] = ["10+", counts_gte_ten]
-    tag_stats_df["dataset_fraction"] = tag_stats_df["counts"].apply(
-        lambda x: round(x / tag_stats_df["counts"].sum() * 100, 2)
-    )
+    return data
 
-    tag_stats_df.to_csv(
-        file_path.split(".")[0] + ".tagged_stats.csv", header=True, index=False
-    )
 
+def filter_tagged_data(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Filters out reactions with 0 or more than 10 tagged atoms and joins the
+    reactants and tagged products into the 'tagged_rxn' column.
+
+    Args:
+        data: Dataframe output from 'tag_data'
+
+    Returns:
+        The filtered dataframe
+    """
     data = data[(data.num_tags != 0) & (data.num_tags <= 10)].copy()
 
-    data["tagged_rxn"] = data[["reactants", "tagged_products"]].agg(">>".join, axis=1)
+    data["tagged_rxn"] = [
+        ">>".join(components)
+        for components in zip(data["reactants"], data["tagged_products"])
+    ]
 
-    data.to_csv(
-        file_path.split(".")[0] + ".tagged_filtered.csv", header=True, index=False
-    )
+    return data
 
 
 if __name__ == "__main__":
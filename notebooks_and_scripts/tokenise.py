@@ -0,0 +1,79 @@
+import logging
+import os
+from typing import Optional
+
+import click
+
+from dar.tokenisation import write_token_files
+
+
+@click.command()
+@click.option(
+    "--file_path",
+    "-f",
+    required=True,
+    help="Tagged (filtered) dataset, e.g. a split of the output of tag_analysis",
+)
+@click.option(
+    "--output_prefix",
+    "-o",
+    default=None,
+    help="Prefix of the output '.products_tokens' and '.precursors_tokens' files. "
+    "Defaults to the input path without its extension.",
+)
+@click.option(
+    "--reaction_column",
+    default="tagged_rxn",
+    help="Column containing the (tagged) reactions.",
+)
+@click.option(
+    "--enzymatic",
+    is_flag=True,
+    help="The reactions contain EC numbers ('reactants|EC>>products'), tokenised "
+    "with the precursors.",
+)
+@click.option(
+    "--n_workers",
+    "-n",
+    default=1,
+    help="Number of worker processes.",
+)
+@click.option(
+    "--chunk_size",
+    "-c",
+    default=100000,
+    help="Number of rows read from the input file at once.",
+)
+def tokenise(
+    file_path: str,
+    output_prefix: Optional[str],
+    reaction_column: str,
+    enzymatic: bool,
+    n_workers: int,
+    chunk_size: int,
+) -> None:
+    """
+    Tokenises a tagged dataset into the source (tagged products) and target
+    (precursors) files expected by '01_preprocess_onmt.sh', e.g.
+    'data.tagged_filtered.train.csv' -> 'data.tagged_filtered.train.products_tokens'
+    and 'data.tagged_filtered.train.precursors_tokens'.
+
+    The dataset is streamed, and the lines of the output files follow its order.
+    """
+    logging.basicConfig(level=logging.WARNING)
+    if output_prefix is None:
+        output_prefix = os.path.splitext(file_path.rstrip(os.sep))[0]
+
+    num_pairs = write_token_files(
+        file_path,
+        output_prefix,
+        reaction_column=reaction_column,
+        enzymatic=enzymatic,
+        n_workers=n_workers,
+        chunk_size=chunk_size,
+    )
+    print(f"Wrote {num_pairs} tokenised reactions to {output_prefix}.*_tokens.")
+
+
+if __name__ == "__main__":
+    tokenise()
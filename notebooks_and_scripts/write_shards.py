@@ -0,0 +1,83 @@
+import logging
+from typing import Optional
+
+import click
+
+from dar.shards import write_shards
+
+
+@click.command()
+@click.option(
+    "--file_path",
+    "-f",
+    required=True,
+    help="Tagged (filtered) dataset, e.g. a split of the output of tag_analysis",
+)
+@click.option(
+    "--output_dir",
+    "-o",
+    required=True,
+    help="Directory for the shards and the merged vocabulary",
+)
+@click.option("--shard_size", default=100000, help="Number of reactions per shard.")
+@click.option(
+    "--reaction_column",
+    default="tagged_rxn",
+    help="Column containing the (tagged) reactions.",
+)
+@click.option(
+    "--enzymatic",
+    is_flag=True,
+    help="The reactions contain EC numbers ('reactants|EC>>products'), tokenised "
+    "with the precursors.",
+)
+@click.option(
+    "--max_vocab_size",
+    type=int,
+    default=None,
+    help="Maximal number of tokens of the merged vocabulary, unbounded by default.",
+)
+@click.option(
+    "--n_workers",
+    "-n",
+    default=1,
+    help="Number of worker processes.",
+)
+@click.option(
+    "--chunk_size",
+    "-c",
+    default=100000,
+    help="Number of rows read from the input file at once.",
+)
+def write_shards_cli(
+    file_path: str,
+    output_dir: str,
+    shard_size: int,
+    reaction_column: str,
+    enzymatic: bool,
+    max_vocab_size: Optional[int],
+    n_workers: int,
+    chunk_size: int,
+) -> None:
+    """
+    Tokenises a tagged dataset into binary shards: arrays of token ids of the
+    tagged products (source) and precursors (target), memory-mapped and randomly
+    accessible with 'dar.shards.ShardReader', with a vocabulary merged over all the
+    shards.
+    """
+    logging.basicConfig(level=logging.WARNING)
+    num_pairs = write_shards(
+        file_path,
+        output_dir,
+        shard_size=shard_size,
+        reaction_column=reaction_column,
+        enzymatic=enzymatic,
+        n_workers=n_workers,
+        chunk_size=chunk_size,
+        max_vocab_size=max_vocab_size,
+    )
+    print(f"Wrote {num_pairs} tokenised reactions to {output_dir}.")
+
+
+if __name__ == "__main__":
+    write_shards_cli()
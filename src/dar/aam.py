@@ -1,48 +1,715 @@
+import hashlib
 import logging
-from typing import List
+import multiprocessing
+import os
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, fields
+from functools import partial
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
+import rxnmapper
 from rxnmapper import RXNMapper  # noqa
+from rxnmapper.smiles_utils import SMI_REGEX_PATTERN
+
+from dar import metrics
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# Same tokenisation as the one used by RXNMapper
+SMILES_TOKEN_REGEX = re.compile(SMI_REGEX_PATTERN)
+
+
+class MappingResult(NamedTuple):
+    """Mapped reaction SMILES and the corresponding RXNMapper confidence."""
+
+    mapped_rxn: str
+    confidence: float
+
+
+# Result for reactions that could not be mapped
+FAILED_MAPPING = MappingResult(">>", 0.0)
+
 
 def map_reactions(mapper: RXNMapper, reactions: List[str]) -> List[str]:
     """Map multiple reaction SMILES.
     This function may raise exceptions, typically if the number of tokens is
     larger than 512."""
+    return [
+        result.mapped_rxn for result in map_reactions_with_confidence(mapper, reactions)
+    ]
+
+
+def map_reactions_with_confidence(
+    mapper: RXNMapper, reactions: List[str]
+) -> List[MappingResult]:
+    """Map multiple reaction SMILES, keeping the confidence of the mapping.
+    This function may raise exceptions, typically if the number of tokens is
+    larger than 512."""
     chunk_results = mapper.get_attention_guided_atom_maps(
         reactions, canonicalize_rxns=True
     )
-    resulting_smiles = [result["mapped_rxn"] for result in chunk_results]
-    return resulting_smiles
+    return [
+        MappingResult(result["mapped_rxn"], result["confidence"])
+        for result in chunk_results
+    ]
+
+
+@dataclass
+class MappingStatistics:
+    """
+    Counters for the batched calls to RXNMapper.
+
+    Attributes:
+        batch_calls: Number of calls to the mapper, including single reactions
+        failed_batch_calls: Number of calls that raised an exception
+        failed_reactions: Number of reactions that could not be mapped
+        rejected_reactions: Number of reactions not sent to the mapper because
+                            they exceed the token limit
+    """
+
+    batch_calls: int = 0
+    failed_batch_calls: int = 0
+    failed_reactions: int = 0
+    rejected_reactions: int = 0
+
+    def merge(self, other: "MappingStatistics") -> None:
+        """Adds the counters of another instance, e.g. from a worker process."""
+        for field in fields(self):
+            setattr(
+                self, field.name, getattr(self, field.name) + getattr(other, field.name)
+            )
 
 
 def map_reactions_with_error_handling(
-    mapper: RXNMapper, reactions: List[str]
+    mapper: RXNMapper,
+    reactions: List[str],
+    statistics: Optional[MappingStatistics] = None,
 ) -> List[str]:
     """
     Map multiple reaction SMILES.
-    When there is an error, the reactions will be mapped one by one, and the
-    one causing the error will be replaced by an empty reaction, ">>".
+    When there is an error, the chunk of reactions is split in half and both
+    halves are mapped again, recursively, until the reactions causing the error
+    are isolated. These are replaced by an empty reaction, ">>".
+
+    Args:
+        mapper: RXNMapper instance
+        reactions: Reaction SMILES to map
+        statistics: Counters to update with the number of calls and failures
+    Returns:
+        Mapped reaction SMILES, in the same order as the input reactions
     """
+    if statistics is None:
+        statistics = MappingStatistics()
+
+    return [
+        result.mapped_rxn
+        for result in _map_reactions_with_bisection(mapper, reactions, statistics)
+    ]
+
+
+def _map_reactions_with_bisection(
+    mapper: RXNMapper,
+    reactions: List[str],
+    statistics: MappingStatistics,
+    depth: int = 0,
+) -> List[MappingResult]:
+    if not reactions:
+        return []
+
+    statistics.batch_calls += 1
+    metrics.increment("rxnmapper_batch_calls")
     try:
-        return map_reactions(mapper, reactions)
-    except Exception:
+        with metrics.timer("rxnmapper_batch_seconds"):
+            return map_reactions_with_confidence(mapper, reactions)
+    except Exception as e:
+        statistics.failed_batch_calls += 1
+        metrics.increment("rxnmapper_failed_batch_calls", reason=e.__class__.__name__)
+        if len(reactions) == 1:
+            logger.info(
+                f"Reaction causing the error: {reactions[0]}; "
+                f"{e.__class__.__name__}: {e}"
+            )
+            statistics.failed_reactions += 1
+            metrics.increment(
+                "failures", function="map_reactions", reason=e.__class__.__name__
+            )
+            return [FAILED_MAPPING]
+
+    if depth == 0:
         logger.warning(
             f"Error while mapping chunk of {len(reactions)} reactions. "
-            "Mapping them individually."
+            "Bisecting it to isolate the reactions causing the error."
         )
+    middle = len(reactions) // 2
+    return _map_reactions_with_bisection(
+        mapper, reactions[:middle], statistics, depth + 1
+    ) + _map_reactions_with_bisection(mapper, reactions[middle:], statistics, depth + 1)
 
-    mapped_reactions = []
-    for reaction in reactions:
-        try:
-            mapped_reaction = map_reactions(mapper, [reaction])[0]
-        except Exception as e:
+
+def count_reaction_tokens(reaction: str) -> int:
+    """
+    Counts the tokens of a reaction SMILES as seen by RXNMapper, including the
+    two special tokens added by the model tokenizer.
+
+    The count is made on the given SMILES; RXNMapper canonicalises the reaction
+    before tokenising it, which may change the count slightly.
+
+    Args:
+        reaction: Reaction SMILES
+    Returns:
+        Number of tokens
+    """
+    return len(SMILES_TOKEN_REGEX.findall(reaction)) + 2
+
+
+def map_reactions_in_token_batches(
+    mapper: RXNMapper,
+    reactions: List[str],
+    max_tokens: int = 512,
+    token_budget: int = 16384,
+    max_batch_size: int = 64,
+    statistics: Optional[MappingStatistics] = None,
+) -> List[str]:
+    """
+    Map multiple reaction SMILES, in batches of reactions of similar lengths.
+
+    The reactions are tokenised first: the ones with more than 'max_tokens'
+    tokens are not sent to the model and are replaced by an empty reaction, ">>".
+    The others are sorted by number of tokens and grouped in batches whose padded
+    size (number of reactions times the longest reaction) fits in 'token_budget',
+    so that short reactions are mapped in large batches with little padding.
+    Errors within a batch are handled by 'map_reactions_with_error_handling'.
+
+    Args:
+        mapper: RXNMapper instance
+        reactions: Reaction SMILES to map
+        max_tokens: Maximal number of tokens supported by the model
+        token_budget: Maximal number of (padded) tokens in a batch
+        max_batch_size: Maximal number of reactions in a batch
+        statistics: Counters to update with the number of calls and failures
+    Returns:
+        Mapped reaction SMILES, in the same order as the input reactions
+    """
+    if statistics is None:
+        statistics = MappingStatistics()
+
+    return [
+        result.mapped_rxn
+        for result in _map_reactions_in_token_batches(
+            mapper, reactions, max_tokens, token_budget, max_batch_size, statistics
+        )
+    ]
+
+
+def _map_reactions_in_token_batches(
+    mapper: RXNMapper,
+    reactions: List[str],
+    max_tokens: int,
+    token_budget: int,
+    max_batch_size: int,
+    statistics: MappingStatistics,
+) -> List[MappingResult]:
+    lengths = [count_reaction_tokens(reaction) for reaction in reactions]
+    mapped_reactions = [FAILED_MAPPING] * len(reactions)
+
+    for i, length in enumerate(lengths):
+        if length > max_tokens:
             logger.info(
-                f"Reaction causing the error: {reaction}; "
-                f"{e.__class__.__name__}: {e}"
+                f"Reaction not mapped: {reactions[i]}; "
+                f"{length} tokens, should be at most {max_tokens}."
+            )
+            statistics.rejected_reactions += 1
+            metrics.increment(
+                "failures", function="map_reactions", reason="too_many_tokens"
             )
-            mapped_reaction = ">>"
-        mapped_reactions.append(mapped_reaction)
+
+    indices = sorted(
+        (i for i, length in enumerate(lengths) if length <= max_tokens),
+        key=lambda i: lengths[i],
+    )
+    for batch in _token_batches(indices, lengths, token_budget, max_batch_size):
+        batch_results = _map_reactions_with_bisection(
+            mapper, [reactions[i] for i in batch], statistics
+        )
+        for i, mapped_reaction in zip(batch, batch_results):
+            mapped_reactions[i] = mapped_reaction
+
     return mapped_reactions
+
+
+def _token_batches(
+    indices: List[int], lengths: List[int], token_budget: int, max_batch_size: int
+) -> Iterator[List[int]]:
+    """
+    Groups indices sorted by increasing length into batches, see
+    'map_reactions_in_token_batches'. A batch always contains at least one index.
+    """
+    batch: List[int] = []
+    for i in indices:
+        # The lengths are sorted, so that the new reaction is the longest one
+        if batch and (
+            len(batch) >= max_batch_size or (len(batch) + 1) * lengths[i] > token_budget
+        ):
+            yield batch
+            batch = []
+        batch.append(i)
+    if batch:
+        yield batch
+
+
+class MappingCache:
+    """
+    Persistent cache of atom-mapping results, stored in an SQLite database.
+
+    Entries are keyed by a hash of the namespace (by default, the rxnmapper
+    version) and of the reaction SMILES given to the mapper, and hold the mapped
+    reaction and its confidence. When 'max_entries' is given, the least recently
+    used entries are evicted beyond that size. To keep lookups read-only, the
+    access time of an entry is only updated when it is older than
+    'touch_interval', which bounds the precision of the eviction order.
+
+    The database is used in WAL mode, so that several processes can read and
+    write the same cache concurrently; each process opens its own connection.
+    As for any SQLite database, the file should be on a local filesystem.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: Optional[int] = None,
+        namespace: Optional[str] = None,
+        timeout: float = 60.0,
+        touch_interval: float = 60.0,
+    ):
+        """
+        Args:
+            path: Path to the SQLite database, created if it does not exist
+            max_entries: Maximal number of entries, unbounded if None
+            namespace: Prefix of the keys, to separate the results of different
+                       models. Defaults to the rxnmapper version.
+            timeout: Seconds to wait for a lock held by another process
+            touch_interval: Seconds after which the access time of an entry that
+                            is looked up is updated
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.namespace = (
+            namespace if namespace is not None else f"rxnmapper-{rxnmapper.__version__}"
+        )
+        self.timeout = timeout
+        self.touch_interval = touch_interval
+        self.hits = 0
+        self.misses = 0
+
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+
+        with self._transaction() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS mappings (key TEXT PRIMARY KEY, "
+                "mapped_rxn TEXT NOT NULL, confidence REAL NOT NULL, "
+                "last_access REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS mappings_last_access "
+                "ON mappings (last_access)"
+            )
+            # Number of entries, kept up to date by triggers to avoid COUNT(*)
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS counts (name TEXT PRIMARY KEY, "
+                "value INTEGER NOT NULL)"
+            )
+            connection.execute(
+                "INSERT OR IGNORE INTO counts VALUES ('entries', "
+                "(SELECT COUNT(*) FROM mappings))"
+            )
+            connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS mappings_insert AFTER INSERT ON "
+                "mappings BEGIN UPDATE counts SET value = value + 1 "
+                "WHERE name = 'entries'; END"
+            )
+            connection.execute(
+                "CREATE TRIGGER IF NOT EXISTS mappings_delete AFTER DELETE ON "
+                "mappings BEGIN UPDATE counts SET value = value - 1 "
+                "WHERE name = 'entries'; END"
+            )
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # SQLite connections must not be shared with forked processes
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+        return self._connection
+
+    @contextmanager
+    def _transaction(self, mode: str = "IMMEDIATE") -> Iterator[sqlite3.Connection]:
+        """
+        Args:
+            mode: "IMMEDIATE" to take the write lock at once, "DEFERRED" for a
+                  read transaction, which does not block the other processes
+        """
+        connection = self.connection
+        connection.execute(f"BEGIN {mode}")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def key(self, reaction: str) -> str:
+        return hashlib.sha256(f"{self.namespace}\n{reaction}".encode()).hexdigest()
+
+    def get_many(self, reactions: List[str]) -> List[Optional[MappingResult]]:
+        """
+        Looks up the results for several reactions and marks them as recently used,
+        see 'touch_interval'.
+
+        Args:
+            reactions: Reaction SMILES, as given to the mapper
+        Returns:
+            The cached results, None for the reactions not in the cache
+        """
+        keys = [self.key(reaction) for reaction in reactions]
+        unique_keys = list(dict.fromkeys(keys))
+
+        found = {}
+        now = time.time()
+        to_touch = []
+        with self._transaction("DEFERRED") as connection:
+            for i in range(0, len(unique_keys), _SQLITE_BATCH_SIZE):
+                batch = unique_keys[i : i + _SQLITE_BATCH_SIZE]
+                rows = connection.execute(
+                    "SELECT key, mapped_rxn, confidence, last_access FROM mappings "
+                    f"WHERE key IN ({', '.join('?' * len(batch))})",
+                    batch,
+                )
+                for key, mapped_rxn, confidence, last_access in rows:
+                    found[key] = MappingResult(mapped_rxn, confidence)
+                    if last_access < now - self.touch_interval:
+                        to_touch.append(key)
+
+        # Only takes the write lock when some entries were not used recently
+        if to_touch:
+            with self._transaction() as connection:
+                connection.executemany(
+                    "UPDATE mappings SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in to_touch],
+                )
+
+        results = [found.get(key) for key in keys]
+        num_hits = sum(result is not None for result in results)
+        self.hits += num_hits
+        self.misses += len(results) - num_hits
+        return results
+
+    def put_many(self, reactions: List[str], results: List[MappingResult]) -> None:
+        """
+        Stores the results for several reactions, evicting the least recently
+        used entries if the cache exceeds its maximal size.
+
+        Args:
+            reactions: Reaction SMILES, as given to the mapper
+            results: The corresponding mapping results
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO mappings VALUES (?, ?, ?, ?)",
+                [
+                    (self.key(reaction), result.mapped_rxn, result.confidence, now)
+                    for reaction, result in zip(reactions, results)
+                ],
+            )
+
+            if self.max_entries is not None:
+                excess = self._count(connection) - self.max_entries
+                if excess > 0:
+                    connection.execute(
+                        "DELETE FROM mappings WHERE key IN (SELECT key FROM "
+                        "mappings ORDER BY last_access LIMIT ?)",
+                        (excess,),
+                    )
+
+    def __len__(self) -> int:
+        return self._count(self.connection)
+
+    @staticmethod
+    def _count(connection: sqlite3.Connection) -> int:
+        return connection.execute(
+            "SELECT value FROM counts WHERE name = 'entries'"
+        ).fetchone()[0]
+
+    def close(self) -> None:
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+
+    def __enter__(self) -> "MappingCache":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __getstate__(self) -> dict:
+        # The connection is re-opened in the process the cache is sent to
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        state["_pid"] = None
+        return state
+
+
+# Maximal number of parameters of an SQLite statement is 999 in older versions
+_SQLITE_BATCH_SIZE = 500
+
+
+def map_reactions_with_cache(
+    mapper: RXNMapper,
+    reactions: List[str],
+    cache: MappingCache,
+    max_tokens: int = 512,
+    token_budget: int = 16384,
+    max_batch_size: int = 64,
+    statistics: Optional[MappingStatistics] = None,
+) -> List[str]:
+    """
+    Map multiple reaction SMILES, only sending the reactions missing from the
+    cache to the mapper (see 'map_reactions_in_token_batches'), and storing the
+    new results in the cache. Reactions that could not be mapped are not cached.
+
+    Args:
+        mapper: RXNMapper instance
+        reactions: Reaction SMILES to map
+        cache: The cache of mapping results
+        max_tokens: Maximal number of tokens supported by the model
+        token_budget: Maximal number of (padded) tokens in a batch
+        max_batch_size: Maximal number of reactions in a batch
+        statistics: Counters to update with the number of calls and failures
+    Returns:
+        Mapped reaction SMILES, in the same order as the input reactions
+    """
+    if statistics is None:
+        statistics = MappingStatistics()
+
+    results = _map_reactions_with_cache(
+        partial(
+            _map_reactions_in_token_batches,
+            mapper,
+            max_tokens=max_tokens,
+            token_budget=token_budget,
+            max_batch_size=max_batch_size,
+            statistics=statistics,
+        ),
+        reactions,
+        cache,
+    )
+    return [result.mapped_rxn for result in results]
+
+
+def _map_reactions_with_cache(
+    map_function: Callable[[List[str]], List[MappingResult]],
+    reactions: List[str],
+    cache: MappingCache,
+) -> List[MappingResult]:
+    cached = cache.get_many(reactions)
+    missing = [i for i, result in enumerate(cached) if result is None]
+    metrics.increment("mapping_cache_hits", len(reactions) - len(missing))
+    metrics.increment("mapping_cache_misses", len(missing))
+
+    new_results = map_function([reactions[i] for i in missing])
+    cache.put_many(
+        [
+            reactions[i]
+            for i, result in zip(missing, new_results)
+            if result != FAILED_MAPPING
+        ],
+        [result for result in new_results if result != FAILED_MAPPING],
+    )
+
+    for i, result in zip(missing, new_results):
+        cached[i] = result
+
+    return [result if result is not None else FAILED_MAPPING for result in cached]
+
+
+# RXNMapper instance of the worker processes of MapperPool
+_worker_mapper: Optional[RXNMapper] = None
+
+
+def _init_mapper_worker(
+    threads_per_worker: Optional[int],
+    mapper_kwargs: Dict[str, Any],
+    enable_metrics: bool = False,
+    mapper_class: Optional[Callable[..., Any]] = None,
+) -> None:
+    global _worker_mapper
+    if enable_metrics:
+        metrics.init_worker()
+    if threads_per_worker is not None:
+        import torch
+
+        torch.set_num_threads(threads_per_worker)
+    _worker_mapper = (mapper_class or RXNMapper)(**mapper_kwargs)
+
+
+def _map_chunk_in_worker(
+    chunk: List[str], max_tokens: int, token_budget: int, max_batch_size: int
+) -> Tuple[List[MappingResult], MappingStatistics]:
+    assert _worker_mapper is not None
+    statistics = MappingStatistics()
+    results = _map_reactions_in_token_batches(
+        _worker_mapper, chunk, max_tokens, token_budget, max_batch_size, statistics
+    )
+    return results, statistics
+
+
+class MapperPool:
+    """
+    Pool of processes mapping reactions on CPU, each with its own RXNMapper
+    instance and a capped number of torch threads.
+
+    Reactions are split into chunks that idle workers take from a shared queue;
+    each chunk is mapped in token batches (see 'map_reactions_in_token_batches')
+    and the results are reassembled in input order. The total number of cores
+    used is about n_workers * threads_per_worker; few threads per worker usually
+    give a better throughput than one worker with many threads, since the model
+    spends much of its time outside of the parallelised torch operations.
+
+    If metrics (see dar.metrics) are enabled when the pool is created, those
+    recorded in the workers are merged into the ones of the current process.
+    """
+
+    def __init__(
+        self,
+        n_workers: int = 1,
+        threads_per_worker: Optional[int] = None,
+        chunk_size: int = 256,
+        max_tokens: int = 512,
+        token_budget: int = 16384,
+        max_batch_size: int = 64,
+        mapper_kwargs: Optional[Dict[str, Any]] = None,
+        mapper_class: Optional[Callable[..., Any]] = None,
+    ):
+        """
+        Args:
+            n_workers: Number of worker processes. With 1 (or less), the reactions
+                       are mapped in the current process.
+            threads_per_worker: Number of torch intra-op threads per worker, torch
+                                default if None
+            chunk_size: Number of reactions sent to a worker at once
+            max_tokens: Maximal number of tokens supported by the model
+            token_budget: Maximal number of (padded) tokens in a batch
+            max_batch_size: Maximal number of reactions in a batch
+            mapper_kwargs: Keyword arguments for the RXNMapper instances
+            mapper_class: Class instantiated with mapper_kwargs in each worker
+                          instead of RXNMapper, e.g. a stub in tests. Must be
+                          defined at module level when n_workers > 1.
+        """
+        self.n_workers = n_workers
+        self.chunk_size = chunk_size
+        self._map_chunk = partial(
+            _map_chunk_in_worker,
+            max_tokens=max_tokens,
+            token_budget=token_budget,
+            max_batch_size=max_batch_size,
+        )
+
+        self._pool = None
+        if n_workers > 1:
+            # Forking a process after torch has started its thread pools can
+            # deadlock, hence the spawned workers
+            self._pool = multiprocessing.get_context("spawn").Pool(
+                processes=n_workers,
+                initializer=_init_mapper_worker,
+                initargs=(
+                    threads_per_worker,
+                    mapper_kwargs or {},
+                    metrics.is_enabled(),
+                    mapper_class,
+                ),
+            )
+        else:
+            _init_mapper_worker(
+                threads_per_worker, mapper_kwargs or {}, mapper_class=mapper_class
+            )
+
+    def map_reactions(
+        self,
+        reactions: List[str],
+        cache: Optional[MappingCache] = None,
+        statistics: Optional[MappingStatistics] = None,
+    ) -> List[str]:
+        """
+        Map multiple reaction SMILES with the workers of the pool.
+
+        Args:
+            reactions: Reaction SMILES to map
+            cache: The cache of mapping results, looked up and updated in the
+                   current process. Not used if None.
+            statistics: Counters to update with the number of calls and failures
+        Returns:
+            Mapped reaction SMILES, in the same order as the input reactions
+        """
+        if statistics is None:
+            statistics = MappingStatistics()
+
+        map_function = partial(self._map_with_workers, statistics=statistics)
+        if cache is None:
+            results = map_function(reactions)
+        else:
+            results = _map_reactions_with_cache(map_function, reactions, cache)
+        return [result.mapped_rxn for result in results]
+
+    def _map_with_workers(
+        self, reactions: List[str], statistics: MappingStatistics
+    ) -> List[MappingResult]:
+        chunks = [
+            reactions[i : i + self.chunk_size]
+            for i in range(0, len(reactions), self.chunk_size)
+        ]
+        if self._pool is None:
+            chunk_results: Iterable[
+                Tuple[Tuple[List[MappingResult], MappingStatistics], Any]
+            ] = ((self._map_chunk(chunk), None) for chunk in chunks)
+        else:
+            chunk_results = self._pool.imap(
+                partial(metrics.call_with_metrics, self._map_chunk), chunks
+            )
+
+        results: List[MappingResult] = []
+        for (chunk_result, chunk_statistics), chunk_metrics in chunk_results:
+            results.extend(chunk_result)
+            statistics.merge(chunk_statistics)
+            if chunk_metrics is not None:
+                metrics.merge(chunk_metrics)
+        return results
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self) -> "MapperPool":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
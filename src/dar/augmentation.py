@@ -0,0 +1,222 @@
+import hashlib
+import logging
+import random
+from functools import partial
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from rdkit import Chem
+from rxn.chemutils.tokenization import tokenize_smiles
+
+from dar.io import iter_table_chunks
+from dar.parallel import imap_ordered
+from dar.tagging import get_tag_combinations_id_dict, permute_tagged_mol
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class AugmentedReaction(NamedTuple):
+    """
+    Tag permutations obtained for one tagged reaction.
+
+    Attributes:
+        tagged_rxn: The tagged reaction SMILES, 'precursors>>tagged product'
+        pairs: Tuples of (tagged product, precursors) SMILES, starting with the
+               original tagged product followed by its tag permutations
+        error: Description of the error if the permutations could not be
+               obtained, None otherwise. The original pair is kept in that case,
+               unless the reaction itself could not be split or tokenised.
+    """
+
+    tagged_rxn: str
+    pairs: List[Tuple[str, str]]
+    error: Optional[str] = None
+
+
+def get_row_seed(seed: int, row: str) -> int:
+    """
+    Derives the seed of the random number generator for one row from a master
+    seed and the row content. Unlike 'hash', this does not depend on the process.
+
+    Args:
+        seed: Master seed
+        row: Row content, e.g. the tagged reaction SMILES
+    Returns:
+        Seed for the given row
+    """
+    digest = hashlib.sha256(f"{seed}:{row}".encode()).digest()
+    return int.from_bytes(digest[:8], "little")
+
+
+def augment_tagged_reaction(
+    tagged_rxn: str,
+    number_of_permutations: int = 1,
+    max_tags: int = 4,
+    seed: int = 42,
+    tokenize: bool = False,
+) -> AugmentedReaction:
+    """
+    Samples tag permutations of the product of a tagged reaction, see
+    'permute_tagged_smiles'. Up to 'number_of_permutations' permutations are
+    sampled for each number of tags; fewer if there are not enough combinations.
+
+    Args:
+        tagged_rxn: Tagged reaction SMILES, 'precursors>>tagged product'
+        number_of_permutations: number of permutations to obtain per number of tags
+        max_tags: Combinations of max_tags or more tags are not considered
+        seed: Master seed, combined with the reaction to seed the sampling
+        tokenize: Whether to return tokenised SMILES in the pairs
+    Returns:
+        AugmentedReaction with the original and permuted (product, precursors) pairs
+    """
+    try:
+        precursors, tagged_product = tagged_rxn.split(">>")
+    except Exception:
+        # Also covers non-string rows, e.g. NaN for an empty CSV cell
+        return AugmentedReaction(
+            tagged_rxn, [], f"ValueError: Invalid tagged reaction SMILES: {tagged_rxn}"
+        )
+    pairs = [(tagged_product, precursors)]
+
+    try:
+        mol = Chem.MolFromSmiles(tagged_product)
+        if mol is None:
+            raise ValueError(f"Invalid tagged product SMILES: {tagged_product}")
+
+        rng = random.Random(get_row_seed(seed, tagged_rxn))
+        permutation_ids = []
+        for combinations in get_tag_combinations_id_dict(mol, max_tags).values():
+            permutation_ids.extend(
+                rng.sample(combinations, min(number_of_permutations, len(combinations)))
+            )
+
+        pairs.extend(
+            (permuted_product, precursors)
+            for permuted_product in permute_tagged_mol(mol, permutation_ids)
+        )
+    except Exception as e:
+        return _maybe_tokenize(
+            AugmentedReaction(tagged_rxn, pairs, f"{e.__class__.__name__}: {e}"),
+            tokenize,
+        )
+
+    return _maybe_tokenize(AugmentedReaction(tagged_rxn, pairs), tokenize)
+
+
+def _maybe_tokenize(result: AugmentedReaction, tokenize: bool) -> AugmentedReaction:
+    if not tokenize:
+        return result
+    try:
+        pairs = [
+            (tokenize_smiles(product), tokenize_smiles(precursors))
+            for product, precursors in result.pairs
+        ]
+    except Exception as e:
+        # Untokenisable reactions are dropped altogether
+        return AugmentedReaction(result.tagged_rxn, [], f"{e.__class__.__name__}: {e}")
+    return result._replace(pairs=pairs)
+
+
+def augment_tagged_reactions(
+    tagged_rxns: Iterable[str],
+    number_of_permutations: int = 1,
+    max_tags: int = 4,
+    seed: int = 42,
+    n_workers: int = 1,
+    chunksize: int = 64,
+    tokenize: bool = False,
+) -> Iterator[AugmentedReaction]:
+    """
+    Samples tag permutations for many tagged reactions, optionally in parallel.
+    The output only depends on the seed and the reactions, not on the number of
+    workers.
+
+    Args:
+        tagged_rxns: Tagged reaction SMILES, e.g. the 'tagged_rxn' column of the
+                     '.tagged_filtered.csv' file
+        number_of_permutations: number of permutations to obtain per number of tags
+        max_tags: Combinations of max_tags or more tags are not considered
+        seed: Master seed
+        n_workers: Number of worker processes, 1 to run in the current process
+        chunksize: Number of reactions sent to a worker at once
+        tokenize: Whether to return tokenised SMILES in the pairs
+    Returns:
+        Iterator over AugmentedReaction, in the same order as the input reactions
+    """
+    return imap_ordered(
+        partial(
+            augment_tagged_reaction,
+            number_of_permutations=number_of_permutations,
+            max_tags=max_tags,
+            seed=seed,
+            tokenize=tokenize,
+        ),
+        tagged_rxns,
+        n_workers=n_workers,
+        chunksize=chunksize,
+    )
+
+
+def write_augmented_token_files(
+    file_path: str,
+    output_prefix: str,
+    number_of_permutations: int = 1,
+    max_tags: int = 4,
+    seed: int = 42,
+    n_workers: int = 1,
+    chunk_size: int = 100000,
+    reaction_column: str = "tagged_rxn",
+) -> int:
+    """
+    Streams a tagged (filtered) dataset and writes the tokenised tagged products
+    and precursors, with their tag permutations, to the source and target files
+    expected by 'onmt_preprocess'.
+
+    Args:
+        file_path: CSV, Parquet or Arrow file containing the tagged reactions
+        output_prefix: Prefix of the output files, '.products_tokens' and
+                       '.precursors_tokens' are appended to it
+        number_of_permutations: number of permutations to obtain per number of tags
+        max_tags: Combinations of max_tags or more tags are not considered
+        seed: Master seed
+        n_workers: Number of worker processes
+        chunk_size: Number of rows read from the input file at once
+        reaction_column: Column containing the tagged reactions
+    Returns:
+        Number of (source, target) pairs written
+    """
+
+    def tagged_rxns() -> Iterator[str]:
+        for chunk in iter_table_chunks(
+            file_path, chunk_size, columns=[reaction_column]
+        ):
+            yield from chunk[reaction_column]
+
+    num_pairs = 0
+    num_failed = 0
+    with open(f"{output_prefix}.products_tokens", "w") as src, open(
+        f"{output_prefix}.precursors_tokens", "w"
+    ) as tgt:
+        for result in augment_tagged_reactions(
+            tagged_rxns(),
+            number_of_permutations=number_of_permutations,
+            max_tags=max_tags,
+            seed=seed,
+            n_workers=n_workers,
+            tokenize=True,
+        ):
+            if result.error is not None:
+                num_failed += 1
+                logger.info(
+                    f"Could not permute the tags of {result.tagged_rxn}; "
+                    f"{result.error}"
+                )
+            for tagged_product_tokens, precursors_tokens in result.pairs:
+                src.write(tagged_product_tokens + "\n")
+                tgt.write(precursors_tokens + "\n")
+                num_pairs += 1
+
+    if num_failed:
+        logger.warning(f"Could not permute the tags of {num_failed} reactions.")
+
+    return num_pairs
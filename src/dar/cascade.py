@@ -0,0 +1,260 @@
+"""
+Cascade inference: the AutoTag model proposes disconnection sites for a product
+(tagged products), and the disconnection-aware model predicts the precursors for
+each of them.
+
+Both models are behind the 'Translator' interface, so that the cascade runs in a
+single process without intermediate files, and can be tested with a
+'StubTranslator' instead of OpenNMT models.
+"""
+
+import os
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Iterable, Iterator, List, NamedTuple, TypeVar
+
+from rxn.chemutils.tokenization import detokenize_smiles, tokenize_smiles
+
+from dar import metrics
+from dar.tagging import validate_tagged_candidate_batch
+
+_T = TypeVar("_T", bound="Translator")
+
+
+class Translator(ABC):
+    """Sequence-to-sequence model translating tokenised SMILES."""
+
+    @abstractmethod
+    def translate(self, sources: List[str], n_best: int = 1) -> List[List[str]]:
+        """
+        Translates a batch of tokenised SMILES.
+
+        Args:
+            sources: Tokenised source SMILES
+            n_best: Number of predictions per source
+        Returns:
+            The n_best tokenised predictions (or fewer) of each source, best first
+        """
+
+    def close(self) -> None:
+        """Releases the resources of the model."""
+
+    def __enter__(self: _T) -> _T:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class StubTranslator(Translator):
+    """
+    Translator returning the predictions of a function, e.g. to test the cascade
+    without models. The sizes of the batches it received are recorded.
+    """
+
+    def __init__(self, predict: Callable[[str], List[str]]):
+        """
+        Args:
+            predict: Function returning the tokenised predictions for a tokenised
+                     source, best first
+        """
+        self.predict = predict
+        self.batch_sizes: List[int] = []
+
+    def translate(self, sources: List[str], n_best: int = 1) -> List[List[str]]:
+        self.batch_sizes.append(len(sources))
+        return [self.predict(source)[:n_best] for source in sources]
+
+
+class OnmtTranslator(Translator):
+    """
+    OpenNMT model loaded in the current process, with the options of the
+    'onmt_translate' calls of the README.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        beam_size: int = 10,
+        max_length: int = 200,
+        batch_size: int = 64,
+        gpu: int = -1,
+    ):
+        """
+        Args:
+            model_path: Path to the '.pt' model
+            beam_size: Beam size, at least the n_best given to 'translate'
+            max_length: Maximal length of the predictions, in tokens
+            batch_size: Batch size of OpenNMT
+            gpu: Index of the GPU to use, the CPU if negative
+        """
+        try:
+            import onmt.opts
+            from onmt.translate.translator import build_translator
+            from onmt.utils.parse import ArgumentParser
+        except ImportError as e:
+            raise ImportError(
+                "OnmtTranslator requires OpenNMT, install it with "
+                "'pip install rxn-opennmt-py'."
+            ) from e
+
+        self.beam_size = beam_size
+        self.batch_size = batch_size
+        parser = ArgumentParser()
+        onmt.opts.config_opts(parser)
+        onmt.opts.translate_opts(parser)
+        # The sources are given to 'translate', the source file is never read
+        args = [
+            "-model",
+            model_path,
+            "-src",
+            "unused",
+            "-beam_size",
+            str(beam_size),
+            "-n_best",
+            str(beam_size),
+            "-max_length",
+            str(max_length),
+            "-batch_size",
+            str(batch_size),
+            "-gpu",
+            str(gpu),
+            "-replace_unk",
+        ]
+        self._opt = parser.parse_args(args)
+        ArgumentParser.validate_translate_opts(self._opt)
+        self._devnull = open(os.devnull, "w")
+        self._translator: Any = build_translator(
+            self._opt, report_score=False, out_file=self._devnull
+        )
+
+    def translate(self, sources: List[str], n_best: int = 1) -> List[List[str]]:
+        if n_best > self.beam_size:
+            raise ValueError(
+                f"n_best ({n_best}) cannot exceed the beam size ({self.beam_size})."
+            )
+        if not sources:
+            return []
+        _, predictions = self._translator.translate(
+            src=sources, batch_size=self.batch_size
+        )
+        return [[p.strip() for p in prediction[:n_best]] for prediction in predictions]
+
+    def close(self) -> None:
+        self._devnull.close()
+
+
+class CascadePrediction(NamedTuple):
+    tagged_product: str
+    precursors: List[str]
+
+
+class CascadeResult(NamedTuple):
+    """
+    Predictions for one product, with:
+        product: The input product SMILES
+        predictions: The precursors predicted for each valid and unique tagged
+                     product proposed by AutoTag, in the order of AutoTag
+        num_candidates: Number of tagged products proposed by AutoTag, including
+                        the invalid and duplicate ones
+    """
+
+    product: str
+    predictions: List[CascadePrediction]
+    num_candidates: int
+
+
+def run_cascade(
+    products: Iterable[str],
+    autotag: Translator,
+    disconnection: Translator,
+    n_best: int = 10,
+    disconnection_n_best: int = 1,
+    batch_size: int = 64,
+) -> Iterator[CascadeResult]:
+    """
+    Predicts diverse precursors for products with the AutoTag and disconnection
+    models, streaming the products in batches.
+
+    The tagged products proposed by AutoTag are canonicalised, and the invalid
+    ones and the duplicates of a product dropped (see 'validate_tagged_candidates'),
+    before being sent to the disconnection model in micro-batches of batch_size
+    tagged products.
+
+    Args:
+        products: Product SMILES (not tokenised)
+        autotag: The AutoTag model
+        disconnection: The disconnection-aware model
+        n_best: Number of tagged products requested from AutoTag per product
+        disconnection_n_best: Number of precursor predictions per tagged product
+        batch_size: Number of products per AutoTag call, and of tagged products
+                    per disconnection model call
+    Returns:
+        Iterator over the results, in the order of the products
+    """
+    batch: List[str] = []
+    for product in products:
+        batch.append(product)
+        if len(batch) == batch_size:
+            yield from _run_cascade_batch(
+                batch, autotag, disconnection, n_best, disconnection_n_best, batch_size
+            )
+            batch = []
+    if batch:
+        yield from _run_cascade_batch(
+            batch, autotag, disconnection, n_best, disconnection_n_best, batch_size
+        )
+
+
+def _run_cascade_batch(
+    products: List[str],
+    autotag: Translator,
+    disconnection: Translator,
+    n_best: int,
+    disconnection_n_best: int,
+    batch_size: int,
+) -> Iterator[CascadeResult]:
+    with metrics.stage("autotag", rows=len(products)):
+        candidates = autotag.translate(
+            [tokenize_smiles(product) for product in products], n_best=n_best
+        )
+
+    # Valid and unique tagged products of each product
+    tagged_products: List[List[str]] = [
+        [
+            candidate.tagged_smiles
+            for candidate in product_candidates
+            if candidate.valid and candidate.tagged_smiles is not None
+        ]
+        for product_candidates in validate_tagged_candidate_batch(products, candidates)
+    ]
+
+    sources = [
+        tokenize_smiles(tagged_product)
+        for product_tagged_products in tagged_products
+        for tagged_product in product_tagged_products
+    ]
+    precursors: List[List[str]] = []
+    with metrics.stage("disconnection", rows=len(sources)):
+        for i in range(0, len(sources), batch_size):
+            precursors.extend(
+                disconnection.translate(
+                    sources[i : i + batch_size], n_best=disconnection_n_best
+                )
+            )
+
+    start = 0
+    for product, product_candidates, product_tagged_products in zip(
+        products, candidates, tagged_products
+    ):
+        end = start + len(product_tagged_products)
+        predictions = [
+            CascadePrediction(
+                tagged_product,
+                [detokenize_smiles(prediction) for prediction in predictions],
+            )
+            for tagged_product, predictions in zip(
+                product_tagged_products, precursors[start:end]
+            )
+        ]
+        start = end
+        yield CascadeResult(product, predictions, len(product_candidates))
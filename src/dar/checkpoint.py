@@ -0,0 +1,103 @@
+import json
+import os
+from typing import Any, Dict, Optional
+
+
+class ChunkCheckpoint:
+    """
+    Progress manifest for jobs appending their results chunk by chunk to an
+    output file, so that they can be resumed after a crash or pre-emption.
+
+    The manifest records the number of completed chunks and the size of the output
+    file after the last completed chunk. On resume, the output file is truncated
+    to that size, which discards anything written for a chunk that did not
+    complete, and the completed chunks can be skipped.
+    """
+
+    def __init__(self, output_path: str, parameters: Optional[Dict[str, Any]] = None):
+        """
+        Args:
+            output_path: File the results are appended to. The manifest is
+                         stored next to it, with the '.progress.json' suffix.
+            parameters: JSON-serialisable job parameters influencing the output
+                        (e.g. input file and chunk size). Resuming a job started
+                        with different parameters raises a ValueError.
+        """
+        self.output_path = output_path
+        self.manifest_path = output_path + ".progress.json"
+        self.parameters = parameters if parameters is not None else {}
+        self.completed_chunks = 0
+        self.output_size = 0
+        self.finished = False
+
+        if os.path.exists(self.manifest_path):
+            self._load()
+
+    def _load(self) -> None:
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+
+        if manifest["parameters"] != self.parameters:
+            raise ValueError(
+                f"Cannot resume {self.output_path}: it was started with parameters "
+                f"{manifest['parameters']}, not {self.parameters}. Remove "
+                f"{self.manifest_path} to start over."
+            )
+        self.completed_chunks = manifest["completed_chunks"]
+        self.output_size = manifest["output_size"]
+        self.finished = manifest["finished"]
+
+    @property
+    def resuming(self) -> bool:
+        return self.completed_chunks > 0
+
+    def open_output(self) -> Any:
+        """
+        Opens the output file for appending, after discarding anything written
+        after the last completed chunk. A new job starts from an empty file.
+
+        Returns:
+            The output file object, in text mode
+        """
+        if not self.resuming:
+            return open(self.output_path, "w")
+
+        output = open(self.output_path, "r+")
+        output.truncate(self.output_size)
+        output.seek(self.output_size)
+        return output
+
+    def chunk_done(self, output: Any = None) -> None:
+        """
+        Records the completion of one chunk, once its results are on disk.
+
+        Args:
+            output: The output file object the results of the chunk were written
+                    to; None if each chunk is written to its own part file.
+        """
+        if output is not None:
+            output.flush()
+            os.fsync(output.fileno())
+            self.output_size = output.tell()
+        self.completed_chunks += 1
+        self._save()
+
+    def job_done(self) -> None:
+        """Records the completion of the whole job."""
+        self.finished = True
+        self._save()
+
+    def _save(self) -> None:
+        manifest = {
+            "parameters": self.parameters,
+            "completed_chunks": self.completed_chunks,
+            "output_size": self.output_size,
+            "finished": self.finished,
+        }
+        # Write to a temporary file first so that the manifest is never incomplete
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
@@ -1,12 +1,22 @@
 from __future__ import annotations
 
+import json
+import multiprocessing.pool
+import re
 from collections import OrderedDict
+from contextlib import contextmanager
 from enum import Enum, auto, unique
-from typing import List, Set
+from functools import partial
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
 
+import numpy as np
 from rdkit import Chem
 from rdkit.Chem import rdChemReactions
 from rxn.chemutils.conversion import canonicalize_smiles
+from rxn.chemutils.utils import remove_atom_mapping
+
+from dar import metrics
+from dar.parallel import imap_ordered
 
 
 @unique
@@ -25,6 +35,7 @@ def remove_mapping(smiles: str) -> str:
     Returns:
         SMILES string without atom-mapping
     """
+    metrics.increment("rdkit_parses", function="remove_mapping")
     mol = Chem.MolFromSmiles(smiles, sanitize=False)
 
     [atom.ClearProp("molAtomMapNumber") for atom in mol.GetAtoms()]
@@ -48,7 +59,111 @@ def remove_rxn_mapping(rxn_smiles: str) -> str:
     return rdChemReactions.ReactionToSmiles(rd_rxn)
 
 
-def standardise_reaction_component(component_smiles: str) -> str:
+class FragmentCache:
+    """
+    Bounded LRU cache of canonical SMILES of single fragments (molecules).
+
+    The same reagents, solvents and catalysts recur across most reactions of a
+    dataset, so that canonicalising the fragments of a reaction component one by
+    one through this cache avoids most of the RDKit calls. The content can be
+    saved to and loaded from a JSON file, e.g. to reuse it between runs or to
+    warm up the cache of worker processes.
+    """
+
+    def __init__(self, max_size: int = 100000):
+        """
+        Args:
+            max_size: Maximal number of fragments kept in the cache
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._canonical_smiles: OrderedDict[str, str] = OrderedDict()
+        # Fragments canonicalised while recording, see 'record_new_fragments'
+        self._new_fragments: Optional[List[Tuple[str, str]]] = None
+
+    def canonicalize(self, smiles: str) -> str:
+        """
+        Canonicalises a fragment SMILES, see 'canonicalize_smiles' from
+        rxn.chemutils, whose exceptions are propagated (and not cached).
+
+        Args:
+            smiles: SMILES string of a fragment
+        Returns:
+            Canonical SMILES string
+        """
+        try:
+            canonical_smiles = self._canonical_smiles[smiles]
+        except KeyError:
+            self.misses += 1
+            metrics.increment("fragment_cache_misses")
+        else:
+            self.hits += 1
+            metrics.increment("fragment_cache_hits")
+            self._canonical_smiles.move_to_end(smiles)
+            return canonical_smiles
+
+        metrics.increment("rdkit_parses", function="canonicalize_smiles")
+        canonical_smiles = canonicalize_smiles(smiles)
+        self._canonical_smiles[smiles] = canonical_smiles
+        if len(self._canonical_smiles) > self.max_size:
+            self._canonical_smiles.popitem(last=False)
+        if self._new_fragments is not None:
+            self._new_fragments.append((smiles, canonical_smiles))
+        return canonical_smiles
+
+    @contextmanager
+    def record_new_fragments(self) -> Iterator[List[Tuple[str, str]]]:
+        """
+        Records the fragments canonicalised (i.e. not found in the cache) within
+        the block, e.g. in a worker process, to add them to the cache of another
+        process with 'update'.
+
+        Returns:
+            List of (SMILES, canonical SMILES) filled in during the block
+        """
+        new_fragments: List[Tuple[str, str]] = []
+        self._new_fragments = new_fragments
+        try:
+            yield new_fragments
+        finally:
+            self._new_fragments = None
+
+    def update(self, fragments: Iterable[Tuple[str, str]]) -> None:
+        """Adds (SMILES, canonical SMILES) pairs to the cache, as most recent."""
+        for smiles, canonical_smiles in fragments:
+            self._canonical_smiles[smiles] = canonical_smiles
+            self._canonical_smiles.move_to_end(smiles)
+        while len(self._canonical_smiles) > self.max_size:
+            self._canonical_smiles.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._canonical_smiles)
+
+    def clear(self) -> None:
+        self._canonical_smiles.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def save(self, path: str) -> None:
+        """Saves the cached fragments, from least to most recently used."""
+        with open(path, "w") as f:
+            json.dump(list(self._canonical_smiles.items()), f)
+
+    def load(self, path: str) -> None:
+        """Adds the fragments saved in a file to the cache."""
+        with open(path) as f:
+            self.update(json.load(f))
+
+
+# Cache used by default in the current process. Worker processes started by fork
+# inherit its content.
+fragment_cache = FragmentCache()
+
+
+def standardise_reaction_component(
+    component_smiles: str, cache: Optional[FragmentCache] = None
+) -> str:
     """
     Standardises reaction component given a SMILES string
     Reaction component example:
@@ -56,13 +171,36 @@ def standardise_reaction_component(component_smiles: str) -> str:
 
     Args:
         component_smiles: SMILES string
+        cache: Cache of canonical fragments, the module-level 'fragment_cache'
+               if None
     Returns:
         Standardised SMILES or None if errors
     """
+    if cache is None:
+        cache = fragment_cache
+
     try:
-        return ".".join(sorted(canonicalize_smiles(component_smiles).split(".")))
+        fragments = [
+            cache.canonicalize(fragment) for fragment in component_smiles.split(".")
+        ]
     except Exception:
-        return ""
+        # Fragments may be connected across dots by ring bonds, e.g. 'C1.C1'
+        metrics.increment(
+            "fallbacks",
+            function="standardise_reaction_component",
+            reason="whole_component",
+        )
+        try:
+            metrics.increment("rdkit_parses", function="canonicalize_smiles")
+            fragments = canonicalize_smiles(component_smiles).split(".")
+        except Exception as e:
+            metrics.increment(
+                "failures",
+                function="standardise_reaction_component",
+                reason=e.__class__.__name__,
+            )
+            return ""
+    return ".".join(sorted(fragments))
 
 
 def remove_unmapped_components(component: str) -> str:
@@ -80,6 +218,9 @@ def remove_unmapped_components(component: str) -> str:
 
     try:
         component_list = component.split(".")
+        metrics.increment(
+            "rdkit_parses", len(component_list), function="remove_unmapped_components"
+        )
         component_mols = [Chem.MolFromSmiles(smiles) for smiles in component_list]
         mapped_mols = []
 
@@ -92,10 +233,134 @@ def remove_unmapped_components(component: str) -> str:
 
         return mapped_smiles
 
-    except Exception:
+    except Exception as e:
+        metrics.increment(
+            "failures",
+            function="remove_unmapped_components",
+            reason=e.__class__.__name__,
+        )
+        return ""
+
+
+def clean_mapped_component(component: str, remove_unmapped: bool = True) -> str:
+    """
+    Removes the non-mapped species (optionally) and the atom mapping from a
+    reactant/reagent/product SMILES string, and standardises it.
+
+    Equivalent to chaining 'remove_unmapped_components' (if remove_unmapped),
+    'remove_atom_mapping' and 'standardise_reaction_component', but each fragment
+    is parsed only once: the mapped fragments are identified from the SMILES
+    string, and only the unmapped SMILES is canonicalised (through the
+    module-level 'fragment_cache').
+
+    Args:
+        component: component SMILES string with atom mapping information.
+                    e.g. CC(C)(C)[SiH2][O:20][C:19](C)(C)[c:18]1[n:14]([CH:13]2[C:2]....
+        remove_unmapped: Whether to remove the species without any mapped atom
+
+    Returns:
+        Standardised SMILES string without atom mapping information or empty string
+        if error
+    """
+    try:
+        if not remove_unmapped:
+            return standardise_reaction_component(remove_atom_mapping(component))
+
+        cleaned_smiles = []
+        for fragment in component.split("."):
+            if not fragment:
+                continue
+            # Sanitisation errors invalidate the whole component, even for the
+            # fragments without mapped atoms
+            smiles = fragment_cache.canonicalize(remove_atom_mapping(fragment))
+            if _is_mapped_fragment(fragment):
+                cleaned_smiles.append(smiles)
+
+        return ".".join(sorted(".".join(cleaned_smiles).split(".")))
+
+    except Exception as e:
+        metrics.increment(
+            "failures", function="clean_mapped_component", reason=e.__class__.__name__
+        )
         return ""
 
 
+def clean_mapped_components(
+    components: Iterable[str],
+    remove_unmapped: bool = True,
+    n_workers: int = 1,
+    chunksize: int = 64,
+    pool: Optional[multiprocessing.pool.Pool] = None,
+) -> Iterator[str]:
+    """
+    Batch version of 'clean_mapped_component', optionally in parallel.
+
+    The fragments canonicalised by the worker processes, and their cache hits
+    and misses, are added to the module-level 'fragment_cache', so that it can be
+    saved and reported as after cleaning in the current process.
+
+    Args:
+        components: Component SMILES strings with atom mapping information
+        remove_unmapped: Whether to remove the species without any mapped atom
+        n_workers: Number of worker processes, 1 to clean in the current process
+        chunksize: Number of components sent to a worker at once
+        pool: Pool of n_workers processes reused across calls, see 'create_pool'
+    Returns:
+        Iterator over the standardised SMILES strings, in the same order as the
+        components
+    """
+    if pool is None and n_workers <= 1:
+        for component in components:
+            yield clean_mapped_component(component, remove_unmapped)
+        return
+
+    for cleaned, hits, misses, new_fragments in imap_ordered(
+        partial(_clean_mapped_component_in_worker, remove_unmapped=remove_unmapped),
+        components,
+        n_workers=n_workers,
+        chunksize=chunksize,
+        pool=pool,
+    ):
+        fragment_cache.update(new_fragments)
+        fragment_cache.hits += hits
+        fragment_cache.misses += misses
+        yield cleaned
+
+
+def _clean_mapped_component_in_worker(
+    component: str, remove_unmapped: bool
+) -> Tuple[str, int, int, List[Tuple[str, str]]]:
+    hits, misses = fragment_cache.hits, fragment_cache.misses
+    with fragment_cache.record_new_fragments() as new_fragments:
+        cleaned = clean_mapped_component(component, remove_unmapped)
+    return (
+        cleaned,
+        fragment_cache.hits - hits,
+        fragment_cache.misses - misses,
+        new_fragments,
+    )
+
+
+# Symbol (with isotope, hydrogens and charge) of the atoms with a map number
+_MAPPED_ATOM_REGEX = re.compile(r"\[([^\]]*):\d+\]")
+
+
+def _is_mapped_fragment(fragment: str) -> bool:
+    mapped_atoms = _MAPPED_ATOM_REGEX.findall(fragment)
+    if any(symbol != "H" for symbol in mapped_atoms):
+        return True
+    if not mapped_atoms:
+        return False
+    # Mapped hydrogens may be removed when parsing, in which case the fragment
+    # does not count as mapped in 'remove_unmapped_components'
+    metrics.increment(
+        "fallbacks", function="clean_mapped_component", reason="mapped_hydrogens"
+    )
+    metrics.increment("rdkit_parses", function="clean_mapped_component")
+    mol = Chem.MolFromSmiles(fragment)
+    return any(atom.GetAtomMapNum() != 0 for atom in mol.GetAtoms())
+
+
 def get_atomic_neighbourhoods(smiles: str) -> OrderedDict[int, List[str]]:
     """
     Obtains a dictionary containing each atomIdx and a list of its bonding environment.
@@ -107,6 +372,7 @@ def get_atomic_neighbourhoods(smiles: str) -> OrderedDict[int, List[str]]:
         A dictionary containing each atomIdx and a list of its bonding environment.
     """
 
+    metrics.increment("rdkit_parses", function="get_atomic_neighbourhoods")
     mol = Chem.MolFromSmiles(smiles, sanitize=False)
     atoms = mol.GetAtoms()
 
@@ -128,6 +394,297 @@ def get_atomic_neighbourhoods(smiles: str) -> OrderedDict[int, List[str]]:
     return ordered_neighbour_dict
 
 
+def get_bond_array(smiles: str) -> np.ndarray:
+    """
+    Obtains the bonds involving at least one mapped atom as an integer array.
+    This is a compact equivalent of 'get_atomic_neighbourhoods': each bond listed
+    there for an atom is a row of this array.
+
+    Args:
+        smiles: Atom-Mapped SMILES string
+
+    Returns:
+        Array of shape (n_bonds, 3), with rows (lowest atom map, highest atom map,
+        bond type code). Unmapped atoms have atom map 0.
+    """
+
+    metrics.increment("rdkit_parses", function="get_bond_array")
+    return get_mol_bond_array(Chem.MolFromSmiles(smiles, sanitize=False))
+
+
+def get_mol_bond_array(mol: Chem.rdchem.Mol) -> np.ndarray:
+    """
+    Obtains the bonds involving at least one mapped atom of an already parsed
+    molecule as an integer array, see 'get_bond_array'.
+
+    Args:
+        mol: Atom-Mapped RdKit molecule object
+
+    Returns:
+        Array of shape (n_bonds, 3), with rows (lowest atom map, highest atom map,
+        bond type code).
+    """
+    atom_maps = np.array(
+        [atom.GetAtomMapNum() for atom in mol.GetAtoms()], dtype=np.int64
+    )
+    bonds = np.array(
+        [
+            (bond.GetBeginAtomIdx(), bond.GetEndAtomIdx(), int(bond.GetBondType()))
+            for bond in mol.GetBonds()
+        ],
+        dtype=np.int64,
+    ).reshape(-1, 3)
+
+    begin_maps = atom_maps[bonds[:, 0]]
+    end_maps = atom_maps[bonds[:, 1]]
+    bond_array = np.stack(
+        [
+            np.minimum(begin_maps, end_maps),
+            np.maximum(begin_maps, end_maps),
+            bonds[:, 2],
+        ],
+        axis=1,
+    )
+
+    return bond_array[bond_array[:, 1] != 0]
+
+
+def compare_bond_arrays(
+    precursor_bonds: np.ndarray,
+    product_bonds: np.ndarray,
+    atom_environment: AtomEnvironment,
+) -> np.ndarray:
+    """
+    Given the bond arrays of a set of precursors and products, obtains the atomIdxs
+    for which the atomic environment has changed, as defined by a change in the
+    bonds, or for which it is unchanged.
+
+    An atom has changed if any of its bonds is not found the same number of times
+    on both sides of the reaction.
+
+    Args:
+        precursor_bonds: Output of 'get_bond_array' for the precursor(s)
+        product_bonds: Output of 'get_bond_array' for the product(s)
+        atom_environment: "changed" for changed atoms
+                        or "same" for list of equivalent atoms
+
+    Returns:
+        Sorted array of atomIdxs with the requested atomic environment
+    """
+    _check_atom_environment(atom_environment)
+
+    counts = _BondCounts.from_bond_arrays(precursor_bonds, product_bonds)
+    changed_keys = counts.keys[counts.totals != 0] // counts.type_base
+    changed_indices = np.unique(
+        np.concatenate(
+            [changed_keys // counts.map_base, changed_keys % counts.map_base]
+        )
+    )
+    changed_indices = changed_indices[changed_indices != 0]
+
+    if atom_environment == AtomEnvironment.CHANGED:
+        return changed_indices
+    return np.setdiff1d(counts.all_indices, changed_indices, assume_unique=True)
+
+
+def _check_atom_environment(atom_environment: AtomEnvironment) -> None:
+    if atom_environment not in (AtomEnvironment.CHANGED, AtomEnvironment.SAME):
+        raise TypeError(
+            """Unrecognised type: Use 'AtomEnvironment.CHANGED' for a list of changed
+            atomIdxs or 'AtomEnvironment.SAME'
+            for a list of unchanged atomIdxs"""
+        )
+
+
+class _BondCounts(NamedTuple):
+    """
+    Each distinct bond of a reaction encoded as a single integer key,
+    (lowest atom map * map_base + highest atom map) * type_base + bond type code,
+    with its number of occurrences in the precursors minus in the products.
+    Bonds with a non-zero total have changed.
+    """
+
+    keys: np.ndarray
+    totals: np.ndarray
+    map_base: int
+    type_base: int
+    # Sorted atom maps of all the mapped atoms of the reaction
+    all_indices: np.ndarray
+
+    @classmethod
+    def from_bond_arrays(
+        cls, precursor_bonds: np.ndarray, product_bonds: np.ndarray
+    ) -> "_BondCounts":
+        bonds = np.concatenate([precursor_bonds, product_bonds])
+        all_indices = np.unique(bonds[:, :2])
+        all_indices = all_indices[all_indices != 0]
+
+        map_base = int(bonds[:, 1].max(initial=0)) + 1
+        type_base = int(bonds[:, 2].max(initial=0)) + 1
+        bond_keys = (bonds[:, 0] * map_base + bonds[:, 1]) * type_base + bonds[:, 2]
+        signs = np.concatenate(
+            [
+                np.ones(len(precursor_bonds), dtype=np.int64),
+                -np.ones(len(product_bonds), dtype=np.int64),
+            ]
+        )
+        unique_keys, inverse = np.unique(bond_keys, return_inverse=True)
+        totals = np.bincount(
+            inverse.reshape(-1), weights=signs, minlength=len(unique_keys)
+        ).astype(np.int64)
+        return cls(unique_keys, totals, map_base, type_base, all_indices)
+
+    def decode(self, keys: np.ndarray) -> np.ndarray:
+        """Bond array rows (lowest atom map, highest atom map, bond type code)."""
+        pairs = keys // self.type_base
+        return np.stack(
+            [pairs // self.map_base, pairs % self.map_base, keys % self.type_base],
+            axis=1,
+        ).reshape(-1, 3)
+
+
+class ReactionCentre(NamedTuple):
+    """
+    Bonds and atoms changed by a reaction, as integer arrays of atom maps. Bond
+    type codes are the integer values of 'Chem.BondType'.
+
+    Attributes:
+        broken_bonds: Bonds of the precursors absent from the products, with rows
+                      (lowest atom map, highest atom map, bond type code)
+        formed_bonds: Bonds of the products absent from the precursors, same rows
+        order_changed_bonds: Bonds between the same mapped atoms on both sides but
+                             of another type, with rows (lowest atom map, highest
+                             atom map, precursor bond type, product bond type)
+        changed_atoms: Sorted atom maps of the atoms involved in any of these bonds
+        unchanged_atoms: Sorted atom maps of the other mapped atoms
+
+    Bonds to unmapped atoms have atom map 0 (and are never order changes).
+    """
+
+    broken_bonds: np.ndarray
+    formed_bonds: np.ndarray
+    order_changed_bonds: np.ndarray
+    changed_atoms: np.ndarray
+    unchanged_atoms: np.ndarray
+
+    @classmethod
+    def from_bond_arrays(
+        cls, precursor_bonds: np.ndarray, product_bonds: np.ndarray
+    ) -> "ReactionCentre":
+        """
+        Args:
+            precursor_bonds: Output of 'get_bond_array' for the precursor(s)
+            product_bonds: Output of 'get_bond_array' for the product(s)
+        """
+        counts = _BondCounts.from_bond_arrays(precursor_bonds, product_bonds)
+        removed = np.repeat(counts.keys, np.maximum(counts.totals, 0))
+        added = np.repeat(counts.keys, np.maximum(-counts.totals, 0))
+
+        # Order changes: exactly one removed and one added bond between the same
+        # two mapped atoms
+        removed_pairs = removed // counts.type_base
+        added_pairs = added // counts.type_base
+        pairs, pair_counts = np.unique(removed_pairs, return_counts=True)
+        single_removed = pairs[pair_counts == 1]
+        pairs, pair_counts = np.unique(added_pairs, return_counts=True)
+        single_added = pairs[pair_counts == 1]
+        changed_pairs = np.intersect1d(single_removed, single_added)
+        changed_pairs = changed_pairs[changed_pairs // counts.map_base != 0]
+
+        is_order_change = np.isin(removed_pairs, changed_pairs)
+        before = counts.decode(removed[is_order_change])
+        broken_bonds = counts.decode(removed[~is_order_change])
+        is_order_change = np.isin(added_pairs, changed_pairs)
+        after = counts.decode(added[is_order_change])
+        formed_bonds = counts.decode(added[~is_order_change])
+        # Keys are sorted, hence the same order of the pairs before and after
+        order_changed_bonds = np.concatenate([before, after[:, 2:]], axis=1)
+
+        changed_atoms = np.unique(
+            np.concatenate(
+                [
+                    broken_bonds[:, :2].ravel(),
+                    formed_bonds[:, :2].ravel(),
+                    order_changed_bonds[:, :2].ravel(),
+                ]
+            )
+        )
+        changed_atoms = changed_atoms[changed_atoms != 0]
+        unchanged_atoms = np.setdiff1d(
+            counts.all_indices, changed_atoms, assume_unique=True
+        )
+        return cls(
+            broken_bonds,
+            formed_bonds,
+            order_changed_bonds,
+            changed_atoms,
+            unchanged_atoms,
+        )
+
+    def get_atoms(self, atom_environment: AtomEnvironment) -> np.ndarray:
+        """
+        Args:
+            atom_environment: "changed" for changed atoms
+                            or "same" for list of equivalent atoms
+        Returns:
+            Sorted atom maps of the atoms with the requested atomic environment
+        """
+        _check_atom_environment(atom_environment)
+        if atom_environment == AtomEnvironment.CHANGED:
+            return self.changed_atoms
+        return self.unchanged_atoms
+
+
+def get_reaction_centre(precursor_smiles: str, product_smiles: str) -> ReactionCentre:
+    """
+    Determines the bonds and atoms changed by a reaction, parsing each side once.
+
+    Args:
+        precursor_smiles: Atom-mapped SMILES string for the precursor(s)
+        product_smiles: Atom-mapped SMILES string for the product(s)
+    Returns:
+        The reaction centre
+    """
+    return ReactionCentre.from_bond_arrays(
+        get_bond_array(precursor_smiles), get_bond_array(product_smiles)
+    )
+
+
+def _get_reaction_centre_with_error_handling(
+    reaction: str,
+) -> Optional[ReactionCentre]:
+    try:
+        precursor_smiles, product_smiles = reaction.split(">>")
+        return get_reaction_centre(precursor_smiles, product_smiles)
+    except Exception as e:
+        metrics.increment(
+            "failures", function="get_reaction_centre", reason=e.__class__.__name__
+        )
+        return None
+
+
+def get_reaction_centres(
+    reactions: Iterable[str], n_workers: int = 1, chunksize: int = 64
+) -> Iterator[Optional[ReactionCentre]]:
+    """
+    Batch version of 'get_reaction_centre', optionally in parallel.
+
+    Args:
+        reactions: Atom-mapped reaction SMILES ('precursors>>products')
+        n_workers: Number of worker processes
+        chunksize: Number of reactions sent to a worker at once
+    Returns:
+        Iterator over the reaction centres (None if a reaction could not be
+        processed), in the same order as the reactions
+    """
+    return imap_ordered(
+        _get_reaction_centre_with_error_handling,
+        reactions,
+        n_workers=n_workers,
+        chunksize=chunksize,
+    )
+
+
 def get_all_atom_indices(precursor_smiles: str, product_smiles: str) -> Set[int]:
     """
     Retrieves all atomIdxs common between precursors and products for a reaction
@@ -140,12 +697,11 @@ def get_all_atom_indices(precursor_smiles: str, product_smiles: str) -> Set[int]
         Set of all AtomIdxs common between precursors and products
     """
 
-    ordered_precursor_neighbour_dict = get_atomic_neighbourhoods(precursor_smiles)
-    ordered_product_neighbour_dict = get_atomic_neighbourhoods(product_smiles)
-
-    all_indices = set(ordered_product_neighbour_dict.keys()) | set(
-        ordered_precursor_neighbour_dict.keys()
+    bonds = np.concatenate(
+        [get_bond_array(precursor_smiles), get_bond_array(product_smiles)]
     )
+    all_indices = set(bonds[:, :2].ravel().tolist())
+    all_indices.discard(0)
 
     return all_indices
 
@@ -168,36 +724,8 @@ def get_atom_list(
         List of atomIdxs for which the atomic environment has changed
     """
 
-    ordered_precursor_neighbour_dict = get_atomic_neighbourhoods(precursor_smiles)
-    ordered_product_neighbour_dict = get_atomic_neighbourhoods(product_smiles)
-
-    all_indices = set(ordered_product_neighbour_dict.keys()) | set(
-        ordered_precursor_neighbour_dict.keys()
+    return (
+        get_reaction_centre(precursor_smiles, product_smiles)
+        .get_atoms(atom_environment)
+        .tolist()
     )
-
-    if atom_environment == AtomEnvironment.CHANGED:
-        # Checks to see equivlence of atomic enviroments (AE).
-        # If not equivelent, then changed AE and added to list
-        atom_list = [
-            atom_map
-            for atom_map in all_indices
-            if ordered_precursor_neighbour_dict.get(atom_map, [])
-            != ordered_product_neighbour_dict.get(atom_map, [])
-        ]
-    elif atom_environment == AtomEnvironment.SAME:
-        # Checks to see equivlence of atomic enviroments (AE).
-        # If equivelent, then unchanged AE and added to list
-        atom_list = [
-            atom_map
-            for atom_map in all_indices
-            if ordered_precursor_neighbour_dict.get(atom_map, [])
-            == ordered_product_neighbour_dict.get(atom_map, [])
-        ]
-    else:
-        raise TypeError(
-            """Unrecognised type: Use 'AtomEnvironment.CHANGED' for a list of changed
-            atomIdxs or 'AtomEnvironment.SAME'
-            for a list of unchanged atomIdxs"""
-        )
-
-    return atom_list
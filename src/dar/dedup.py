@@ -0,0 +1,403 @@
+"""
+Deduplication of reactions ahead of the expensive stages (mapping, tagging).
+
+Only the unique reactions are processed, and the results are broadcast back to
+all the rows:
+
+    unique = deduplicate_reactions(df["rxn"].to_list())
+    mapped = mapper_pool.map_reactions(unique.reactions)
+    df["mapped_rxn"] = unique.broadcast(mapped)
+    df["duplicate_count"] = unique.row_counts()
+
+Datasets processed chunk by chunk use a 'DuplicateStore' instead, so that the
+duplicates of a later chunk reuse the results of the earlier ones and
+'duplicate_count' counts the rows of the whole dataset.
+"""
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import tempfile
+from collections import Counter
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+from dar import metrics
+from dar.chem import standardise_reaction_component
+
+T = TypeVar("T")
+
+
+def canonicalize_reaction(reaction: str) -> str:
+    """
+    Canonicalises a reaction SMILES component by component, ignoring the order of
+    the fragments, see 'standardise_reaction_component'.
+
+    Args:
+        reaction: Reaction SMILES, e.g. 'CC(=O)O.OCC>>CCOC(C)=O'
+    Returns:
+        Canonical reaction SMILES, or the input reaction if one of its components
+        cannot be canonicalised
+    """
+    components = reaction.split(">")
+    canonical_components = []
+    for component in components:
+        canonical_component = standardise_reaction_component(component)
+        if component and not canonical_component:
+            return reaction
+        canonical_components.append(canonical_component)
+    return ">".join(canonical_components)
+
+
+def reaction_hash(reaction: str, canonical: bool = True) -> str:
+    """
+    Content hash identifying duplicate reactions.
+
+    Args:
+        reaction: Reaction SMILES
+        canonical: Whether reactions that only differ by the SMILES of their
+                   components (e.g. 'OCC.CC(=O)O' and 'CC(=O)O.CCO') are duplicates.
+                   Otherwise, only identical strings are.
+    Returns:
+        Hexadecimal digest of the (canonical) reaction SMILES
+    """
+    if canonical:
+        reaction = canonicalize_reaction(reaction)
+    return hashlib.sha256(reaction.encode()).hexdigest()
+
+
+class UniqueReactions(NamedTuple):
+    """
+    Unique reactions of a list of reactions, with:
+        reactions: First occurrence of each unique reaction
+        indices: Row index of the first occurrence of each unique reaction
+        inverse: Index in 'reactions' of the unique reaction of each input row
+        counts: Number of input rows for each unique reaction
+    """
+
+    reactions: List[str]
+    indices: List[int]
+    inverse: List[int]
+    counts: List[int]
+
+    @property
+    def num_duplicates(self) -> int:
+        """Number of rows that are duplicates of a previous row."""
+        return len(self.inverse) - len(self.reactions)
+
+    def broadcast(self, results: Sequence[T]) -> List[T]:
+        """
+        Expands the results obtained for the unique reactions to all the rows.
+
+        Args:
+            results: One result per unique reaction, in the order of 'reactions'
+        Returns:
+            One result per input row
+        """
+        if len(results) != len(self.reactions):
+            raise ValueError(
+                f"Expected {len(self.reactions)} results, got {len(results)}."
+            )
+        return [results[i] for i in self.inverse]
+
+    def row_counts(self) -> List[int]:
+        """Number of rows (including itself) with the reaction of each row."""
+        return self.broadcast(self.counts)
+
+
+def deduplicate_reactions(
+    reactions: Sequence[str], canonical: bool = True
+) -> UniqueReactions:
+    """
+    Finds the unique reactions of a list, see 'reaction_hash'.
+
+    Args:
+        reactions: Reaction SMILES
+        canonical: Whether to compare the canonical reaction SMILES, or the
+                   strings as they are
+    Returns:
+        The unique reactions, with what is needed to broadcast results back
+    """
+    unique, _ = _deduplicate(reactions, canonical)
+    metrics.increment("duplicate_reactions", unique.num_duplicates)
+    return unique
+
+
+def _deduplicate(
+    reactions: Sequence[str], canonical: bool
+) -> Tuple[UniqueReactions, List[str]]:
+    """Unique reactions, see 'deduplicate_reactions', and their hashes."""
+    unique_indices: Dict[str, int] = {}
+    unique = UniqueReactions([], [], [], [])
+    for row, reaction in enumerate(reactions):
+        key = reaction_hash(reaction, canonical=canonical)
+        index = unique_indices.get(key)
+        if index is None:
+            index = unique_indices[key] = len(unique.reactions)
+            unique.reactions.append(reaction)
+            unique.indices.append(row)
+            unique.counts.append(0)
+        unique.inverse.append(index)
+        unique.counts[index] += 1
+    return unique, list(unique_indices)
+
+
+class StoredReactions(NamedTuple):
+    """
+    Unique reactions of a chunk, see 'DuplicateStore.deduplicate', with:
+        unique: Unique reactions of the chunk, whose 'counts' are their numbers
+                of rows in the whole dataset
+        keys: Hash of each unique reaction, see 'reaction_hash'
+        results: Result of each unique reaction kept in the store, None for the
+                 reactions still to process
+        first: Whether each unique reaction occurs for the first time in the chunk
+        remaining: Number of rows of each unique reaction in the later chunks
+    """
+
+    unique: UniqueReactions
+    keys: List[str]
+    results: List[Optional[Any]]
+    first: List[bool]
+    remaining: List[int]
+
+    @property
+    def missing(self) -> List[int]:
+        """Indices in 'unique.reactions' of the reactions still to process."""
+        return [i for i, result in enumerate(self.results) if result is None]
+
+    def fill(self, results: Sequence[T]) -> List[T]:
+        """
+        Completes the stored results with those of the missing reactions.
+
+        Args:
+            results: One result per missing reaction, in the order of 'missing'
+        Returns:
+            One result per unique reaction
+        """
+        missing = self.missing
+        if len(results) != len(missing):
+            raise ValueError(f"Expected {len(missing)} results, got {len(results)}.")
+        filled: List[Any] = list(self.results)
+        for i, result in zip(missing, results):
+            filled[i] = result
+        return filled
+
+
+class DuplicateStore:
+    """
+    Deduplicates the reactions of a dataset processed chunk by chunk.
+
+    A first pass counts the rows of each reaction over the whole dataset
+    ('count'). The chunks are then deduplicated in order ('deduplicate'), and the
+    results of their unique reactions are kept ('put') while duplicates of them
+    remain in the later chunks, so that these duplicates are not processed again.
+
+    The counts and results are stored in a temporary SQLite database keyed by
+    'reaction_hash', so that memory does not grow with the dataset. At most
+    'max_results' results are kept, the oldest ones being dropped beyond that
+    (their duplicates are then processed again).
+
+        with DuplicateStore() as store:
+            for chunk in iter_table_chunks(path, chunk_size):
+                store.count(chunk["rxn"].to_list())
+            for chunk in iter_table_chunks(path, chunk_size):
+                stored = store.deduplicate(chunk["rxn"].to_list())
+                results = stored.fill(
+                    process([stored.unique.reactions[i] for i in stored.missing])
+                )
+                store.put(stored, results)
+                chunk["result"] = stored.unique.broadcast(results)
+                chunk["duplicate_count"] = stored.unique.row_counts()
+    """
+
+    def __init__(
+        self,
+        canonical: bool = True,
+        max_results: Optional[int] = 1000000,
+        directory: Optional[str] = None,
+    ):
+        """
+        Args:
+            canonical: Whether to compare the canonical reaction SMILES, or the
+                       strings as they are, see 'reaction_hash'
+            max_results: Maximal number of results kept, unbounded if None
+            directory: Directory of the temporary database, the default temporary
+                       directory if None
+        """
+        self.canonical = canonical
+        self.max_results = max_results
+        self._directory = tempfile.TemporaryDirectory(dir=directory)
+        self._connection = sqlite3.connect(
+            os.path.join(self._directory.name, "reactions.sqlite"),
+            isolation_level=None,
+        )
+        # Temporary data, not worth a journal
+        self._connection.execute("PRAGMA journal_mode=OFF")
+        self._connection.execute("PRAGMA synchronous=OFF")
+        self._connection.execute(
+            "CREATE TABLE counts (key TEXT PRIMARY KEY, count INTEGER NOT NULL, "
+            "remaining INTEGER NOT NULL)"
+        )
+        # Ordered by 'id', the oldest results being dropped first
+        self._connection.execute(
+            "CREATE TABLE results (id INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL, "
+            "result BLOB NOT NULL)"
+        )
+        self._num_results = 0
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        connection = self._connection
+        connection.execute("BEGIN")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def count(self, reactions: Iterable[str]) -> None:
+        """
+        Counts the rows of reactions in the first pass over the dataset.
+
+        Args:
+            reactions: Reaction SMILES of a chunk
+        """
+        counts = Counter(
+            reaction_hash(reaction, canonical=self.canonical) for reaction in reactions
+        )
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO counts VALUES (?, 0, 0)",
+                [(key,) for key in counts],
+            )
+            connection.executemany(
+                "UPDATE counts SET count = count + ?, remaining = remaining + ? "
+                "WHERE key = ?",
+                [(count, count, key) for key, count in counts.items()],
+            )
+
+    def deduplicate(self, reactions: Sequence[str]) -> StoredReactions:
+        """
+        Finds the unique reactions of a chunk, with the results kept for them,
+        and marks their rows as processed.
+
+        Args:
+            reactions: Reaction SMILES of the chunk, all of them counted before
+        Returns:
+            The unique reactions, with their counts in the whole dataset
+        """
+        unique, keys = _deduplicate(reactions, self.canonical)
+
+        counts: Dict[str, Tuple[int, int]] = {}
+        results: Dict[str, Any] = {}
+        with self._transaction() as connection:
+            for i in range(0, len(keys), _SQLITE_BATCH_SIZE):
+                batch = keys[i : i + _SQLITE_BATCH_SIZE]
+                placeholders = ", ".join("?" * len(batch))
+                for key, count, remaining in connection.execute(
+                    "SELECT key, count, remaining FROM counts "
+                    f"WHERE key IN ({placeholders})",
+                    batch,
+                ):
+                    counts[key] = (count, remaining)
+                for key, result in connection.execute(
+                    f"SELECT key, result FROM results WHERE key IN ({placeholders})",
+                    batch,
+                ):
+                    results[key] = pickle.loads(result)
+
+            missing = [key for key in keys if key not in counts]
+            if missing:
+                raise ValueError(f"{len(missing)} reactions were not counted.")
+
+            connection.executemany(
+                "UPDATE counts SET remaining = remaining - ? WHERE key = ?",
+                zip(unique.counts, keys),
+            )
+            # Not needed anymore once the last duplicates are processed
+            done = [
+                (key,)
+                for key, count in zip(keys, unique.counts)
+                if key in results and counts[key][1] == count
+            ]
+            connection.executemany("DELETE FROM results WHERE key = ?", done)
+            self._num_results -= len(done)
+
+        stored = StoredReactions(
+            unique=unique._replace(counts=[counts[key][0] for key in keys]),
+            keys=keys,
+            results=[results.get(key) for key in keys],
+            first=[counts[key][0] == counts[key][1] for key in keys],
+            remaining=[
+                counts[key][1] - count for key, count in zip(keys, unique.counts)
+            ],
+        )
+        metrics.increment(
+            "duplicate_reactions",
+            len(reactions) - sum(unique.counts[i] for i in stored.missing),
+        )
+        return stored
+
+    def put(self, stored: StoredReactions, results: Sequence[Any]) -> None:
+        """
+        Keeps the new results of a chunk for the duplicates in the later chunks.
+
+        Args:
+            stored: The unique reactions of the chunk, see 'deduplicate'
+            results: One result (not None) per unique reaction, see
+                     'StoredReactions.fill'
+        """
+        new_results = [
+            (key, pickle.dumps(result))
+            for key, stored_result, remaining, result in zip(
+                stored.keys, stored.results, stored.remaining, results
+            )
+            if stored_result is None and remaining > 0
+        ]
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT INTO results (key, result) VALUES (?, ?)", new_results
+            )
+            self._num_results += len(new_results)
+
+            if self.max_results is not None:
+                excess = self._num_results - self.max_results
+                if excess > 0:
+                    connection.execute(
+                        "DELETE FROM results WHERE id IN (SELECT id FROM results "
+                        "ORDER BY id LIMIT ?)",
+                        (excess,),
+                    )
+                    self._num_results -= excess
+
+    def __len__(self) -> int:
+        """Number of results kept."""
+        return self._num_results
+
+    def close(self) -> None:
+        """Closes and removes the database."""
+        self._connection.close()
+        self._directory.cleanup()
+
+    def __enter__(self) -> "DuplicateStore":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+# Maximal number of parameters of an SQLite statement is 999 in older versions
+_SQLITE_BATCH_SIZE = 500
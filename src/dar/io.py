@@ -0,0 +1,290 @@
+import os
+from enum import Enum
+from typing import Any, Dict, Iterator, List, Optional
+
+import pandas as pd
+
+# Compact types for the columns produced by the pipeline. The other integer
+# columns are kept as int64, and the text columns (SMILES) stored as UTF-8 strings.
+COMPACT_COLUMN_TYPES: Dict[str, str] = {
+    "num_tags": "int16",
+    "tag_combinations": "int64",
+}
+
+
+class DataFormat(Enum):
+    CSV = "csv"
+    PARQUET = "parquet"
+    ARROW = "arrow"
+
+    @property
+    def extension(self) -> str:
+        return "." + self.value
+
+    @classmethod
+    def from_path(cls, path: str) -> "DataFormat":
+        """Deduces the format from the extension of a file or directory."""
+        extension = os.path.splitext(path.rstrip(os.sep))[1].lower()
+        if extension in (".arrow", ".feather", ".ipc"):
+            return cls.ARROW
+        if extension in (".parquet", ".pq"):
+            return cls.PARQUET
+        return cls.CSV
+
+
+def get_output_path(
+    input_path: str, suffix: str, data_format: Optional[DataFormat] = None
+) -> str:
+    """
+    Derives the path of an output file from the one of the input file, by
+    replacing everything after the first dot of the file name, e.g.
+    'data/uspto.mapped.csv' -> 'data/uspto.tagged.parquet'. Unlike splitting the
+    whole path at the first dot, this is safe for directories containing dots.
+
+    Args:
+        input_path: Path to the input file
+        suffix: Suffix identifying the output, e.g. 'tagged'
+        data_format: Format of the output, CSV if None
+
+    Returns:
+        Path to the output file, in the same directory as the input file
+    """
+    if data_format is None:
+        data_format = DataFormat.CSV
+    directory, file_name = os.path.split(input_path.rstrip(os.sep))
+    stem = file_name.split(".")[0]
+    return os.path.join(directory, f"{stem}.{suffix}{data_format.extension}")
+
+
+def _import_pyarrow() -> Any:
+    try:
+        import pyarrow
+        import pyarrow.dataset  # noqa: F401
+        import pyarrow.fs  # noqa: F401
+        import pyarrow.ipc  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+    except ImportError as e:
+        raise ImportError(
+            "Reading and writing Parquet or Arrow files requires pyarrow, "
+            "install it with 'pip install dar[arrow]'."
+        ) from e
+    return pyarrow
+
+
+def _open_dataset(path: str, data_format: DataFormat, memory_map: bool) -> Any:
+    pa = _import_pyarrow()
+    return pa.dataset.dataset(
+        path,
+        format="parquet" if data_format is DataFormat.PARQUET else "ipc",
+        filesystem=pa.fs.LocalFileSystem(use_mmap=memory_map),
+    )
+
+
+def read_table(
+    path: str, columns: Optional[List[str]] = None, memory_map: bool = True
+) -> pd.DataFrame:
+    """
+    Reads a CSV, Parquet or Arrow IPC file (or a directory of Parquet / Arrow IPC
+    part files) into a dataframe. The format is deduced from the extension.
+
+    Args:
+        path: Path to the file or directory
+        columns: Columns to read, all of them if None
+        memory_map: Whether to memory-map Parquet and Arrow files instead of
+                    reading them into memory
+
+    Returns:
+        The dataframe
+    """
+    data_format = DataFormat.from_path(path)
+    if data_format is DataFormat.CSV:
+        return pd.read_csv(path, usecols=columns)
+
+    dataset = _open_dataset(path, data_format, memory_map)
+    return dataset.to_table(columns=columns).to_pandas()
+
+
+def iter_table_chunks(
+    path: str,
+    chunk_size: int,
+    columns: Optional[List[str]] = None,
+    memory_map: bool = True,
+) -> Iterator[pd.DataFrame]:
+    """
+    Streams a CSV, Parquet or Arrow IPC file (or a directory of Parquet / Arrow
+    IPC part files) in dataframes of chunk_size rows (except for the last one).
+
+    Args:
+        path: Path to the file or directory
+        chunk_size: Number of rows per chunk
+        columns: Columns to read, all of them if None
+        memory_map: Whether to memory-map Parquet and Arrow files
+
+    Returns:
+        Iterator over the chunks, with a running index as for 'pd.read_csv'
+    """
+    data_format = DataFormat.from_path(path)
+    if data_format is DataFormat.CSV:
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunk_size)
+        return
+
+    pa = _import_pyarrow()
+    dataset = _open_dataset(path, data_format, memory_map)
+
+    # Record batches follow the row groups of the files; they are regrouped so
+    # that the chunks do not depend on how the files were written
+    start = 0
+    pending: List[Any] = []
+    num_pending = 0
+    for batch in dataset.to_batches(columns=columns, batch_size=chunk_size):
+        pending.append(batch)
+        num_pending += batch.num_rows
+        while num_pending >= chunk_size:
+            table = pa.Table.from_batches(pending)
+            chunk = table.slice(0, chunk_size)
+            rest = table.slice(chunk_size)
+            pending = rest.to_batches()
+            num_pending = rest.num_rows
+            yield _to_pandas(chunk, start)
+            start += chunk_size
+    if num_pending:
+        yield _to_pandas(pa.Table.from_batches(pending), start)
+
+
+def _to_pandas(table: Any, start: int) -> pd.DataFrame:
+    df = table.to_pandas()
+    df.index = pd.RangeIndex(start, start + len(df))
+    return df
+
+
+def get_arrow_schema(df: pd.DataFrame) -> Any:
+    """
+    Arrow schema with compact types for a dataframe of the pipeline: see
+    'COMPACT_COLUMN_TYPES'; the other text columns are stored as strings even
+    when they only contain missing values, so that all chunks share the schema.
+
+    Args:
+        df: Dataframe, typically the first chunk written to a file
+
+    Returns:
+        pyarrow.Schema for the dataframe
+    """
+    pa = _import_pyarrow()
+    fields = []
+    for column, dtype in df.dtypes.items():
+        if column in COMPACT_COLUMN_TYPES and pd.api.types.is_integer_dtype(dtype):
+            arrow_type = pa.from_numpy_dtype(COMPACT_COLUMN_TYPES[column])
+        elif pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
+            arrow_type = pa.string()
+        else:
+            arrow_type = (
+                pa.Schema.from_pandas(df[[column]], preserve_index=False)
+                .field(column)
+                .type
+            )
+        fields.append(pa.field(str(column), arrow_type))
+    return pa.schema(fields)
+
+
+class TableWriter:
+    """
+    Writes dataframes chunk by chunk to a single CSV, Parquet or Arrow IPC file.
+    The format is deduced from the extension, the schema from the first chunk.
+
+    Parquet and Arrow files are only complete once the writer is closed, which
+    the context manager takes care of.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.data_format = DataFormat.from_path(path)
+        self.num_rows = 0
+        self._started = False
+        self._writer: Any = None
+        self._schema: Any = None
+
+    def write(self, df: pd.DataFrame) -> None:
+        """Appends the rows of a dataframe to the file."""
+        if self.data_format is DataFormat.CSV:
+            df.to_csv(
+                self.path,
+                header=not self._started,
+                index=False,
+                mode="a" if self._started else "w",
+            )
+            self._started = True
+            self.num_rows += len(df)
+            return
+
+        pa = _import_pyarrow()
+        if self._writer is None:
+            self._schema = get_arrow_schema(df)
+            if self.data_format is DataFormat.PARQUET:
+                self._writer = pa.parquet.ParquetWriter(self.path, self._schema)
+            else:
+                self._writer = pa.ipc.new_file(self.path, self._schema)
+        # Mixed columns, such as the number of tags of the statistics ('10+'), are
+        # stored as text, as they would be read back from a CSV file
+        mixed_columns = {
+            column: df[column].where(df[column].isna(), df[column].astype(str))
+            for column, dtype in df.dtypes.items()
+            if pd.api.types.is_object_dtype(dtype)
+        }
+        if mixed_columns:
+            df = df.assign(**mixed_columns)
+        self._writer.write_table(
+            pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+        )
+        self.num_rows += len(df)
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self) -> "TableWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def write_part(
+    df: pd.DataFrame, directory: str, index: int, data_format: DataFormat
+) -> str:
+    """
+    Writes a dataframe as one part file of a Parquet or Arrow IPC dataset
+    directory, which 'read_table' and 'iter_table_chunks' read as a whole. The
+    file is written under a temporary name first, so that an interrupted write
+    never leaves an incomplete part.
+
+    Args:
+        df: Dataframe to write
+        directory: Dataset directory, created if needed
+        index: Index of the part, determining its file name
+        data_format: Format of the part files
+
+    Returns:
+        Path to the part file
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"part-{index:05d}{data_format.extension}")
+    # The temporary file name is ignored when reading the directory
+    tmp_path = os.path.join(directory, f".part-{index:05d}{data_format.extension}")
+    with TableWriter(tmp_path) as writer:
+        writer.write(df)
+    os.replace(tmp_path, path)
+    return path
+
+
+def write_table(df: pd.DataFrame, path: str) -> None:
+    """
+    Writes a dataframe to a CSV, Parquet or Arrow IPC file, deducing the format
+    from the extension.
+
+    Args:
+        df: Dataframe to write
+        path: Path to the file
+    """
+    with TableWriter(path) as writer:
+        writer.write(df)
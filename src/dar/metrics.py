@@ -0,0 +1,219 @@
+"""
+Lightweight counters and timers for the preprocessing stages.
+
+Metrics are disabled by default, in which case recording them costs a function
+call and a flag check. Once enabled (e.g. with the --metrics_file option of the
+scripts), they are collected in a process-wide registry and can be exported as
+JSON or in the Prometheus text format:
+
+    metrics.enable()
+    with metrics.stage("tagging", rows=len(data)):
+        ...
+    metrics.increment("failures", function="tag_reaction", reason="ValueError")
+    metrics.write_metrics("run.metrics.json")
+
+Metrics recorded in worker processes are sent back to the parent process by
+'imap_ordered' and 'MapperPool' (see 'call_with_metrics').
+"""
+
+import json
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple, TypeVar
+
+R = TypeVar("R")
+
+# Metric name and sorted (label, value) pairs
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+_enabled = False
+_counters: Dict[MetricKey, float] = {}
+# Number of observations and total duration in seconds
+_timers: Dict[MetricKey, Tuple[int, float]] = {}
+
+
+def enable() -> None:
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset() -> None:
+    """Forgets all the recorded metrics."""
+    _counters.clear()
+    _timers.clear()
+
+
+def init_worker() -> None:
+    """
+    Enables metrics in a worker process, without the metrics inherited from the
+    parent process when forked (which would be counted twice).
+    """
+    reset()
+    enable()
+
+
+def _key(name: str, labels: Dict[str, Any]) -> MetricKey:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def increment(name: str, value: float = 1, **labels: Any) -> None:
+    """
+    Increments a counter, if metrics are enabled.
+
+    Args:
+        name: Name of the counter, e.g. 'rdkit_parses'
+        value: Increment
+        labels: Labels distinguishing the series of the counter, e.g. reason='...'
+    """
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, seconds: float, **labels: Any) -> None:
+    """Records a duration for a timer, if metrics are enabled."""
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    count, total = _timers.get(key, (0, 0.0))
+    _timers[key] = (count + 1, total + seconds)
+
+
+@contextmanager
+def timer(name: str, **labels: Any) -> Iterator[None]:
+    """Context manager recording the duration of its block, see 'observe'."""
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+@contextmanager
+def stage(name: str, rows: int) -> Iterator[None]:
+    """
+    Context manager recording the duration of a pipeline stage and the number of
+    rows it processed, from which the rows per second are derived on export.
+
+    Args:
+        name: Name of the stage, e.g. 'tagging'
+        rows: Number of rows processed in the block
+    """
+    with timer("stage_seconds", stage=name):
+        yield
+    increment("stage_rows", rows, stage=name)
+
+
+def snapshot() -> Dict[str, Any]:
+    """Picklable copy of the recorded metrics, see 'merge'."""
+    return {"counters": dict(_counters), "timers": dict(_timers)}
+
+
+def merge(other: Dict[str, Any]) -> None:
+    """Adds metrics recorded elsewhere, e.g. in a worker process."""
+    for key, value in other["counters"].items():
+        _counters[key] = _counters.get(key, 0) + value
+    for key, (count, total) in other["timers"].items():
+        previous_count, previous_total = _timers.get(key, (0, 0.0))
+        _timers[key] = (previous_count + count, previous_total + total)
+
+
+def call_with_metrics(
+    function: Callable[..., R], *args: Any
+) -> Tuple[R, Optional[Dict[str, Any]]]:
+    """
+    Calls a function and returns the metrics recorded during the call, which are
+    removed from the registry. Used in worker processes, the metrics being merged
+    into the registry of the parent process.
+
+    Returns:
+        Tuple of the result of the function and the recorded metrics, None if
+        metrics are disabled
+    """
+    result = function(*args)
+    if not _enabled:
+        return result, None
+    recorded = snapshot()
+    reset()
+    return result, recorded
+
+
+def _format_key(key: MetricKey) -> str:
+    name, labels = key
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+
+def get_rows_per_second() -> Dict[str, float]:
+    """Throughput of the stages recorded with 'stage'."""
+    rates = {}
+    for (name, labels), (_, total) in _timers.items():
+        if name == "stage_seconds" and total > 0:
+            rows = _counters.get(("stage_rows", labels), 0)
+            rates[dict(labels)["stage"]] = rows / total
+    return rates
+
+
+def to_dict() -> Dict[str, Any]:
+    """Recorded metrics as a JSON-serialisable dictionary."""
+    return {
+        "counters": {_format_key(key): value for key, value in _counters.items()},
+        "timers": {
+            _format_key(key): {"count": count, "total_seconds": total}
+            for key, (count, total) in _timers.items()
+        },
+        "rows_per_second": get_rows_per_second(),
+    }
+
+
+def to_prometheus(prefix: str = "dar") -> str:
+    """Recorded metrics in the Prometheus text exposition format."""
+    lines = []
+    for name in sorted({name for name, _ in _counters}):
+        lines.append(f"# TYPE {prefix}_{name}_total counter")
+        for (counter_name, labels), value in sorted(_counters.items()):
+            if counter_name == name:
+                key = (f"{prefix}_{name}_total", labels)
+                lines.append(f"{_format_key(key)} {value:g}")
+    for name in sorted({name for name, _ in _timers}):
+        lines.append(f"# TYPE {prefix}_{name} summary")
+        for (timer_name, labels), (count, total) in sorted(_timers.items()):
+            if timer_name == name:
+                sum_key = (f"{prefix}_{name}_sum", labels)
+                count_key = (f"{prefix}_{name}_count", labels)
+                lines.append(f"{_format_key(sum_key)} {total:g}")
+                lines.append(f"{_format_key(count_key)} {count}")
+    rates = get_rows_per_second()
+    if rates:
+        lines.append(f"# TYPE {prefix}_stage_rows_per_second gauge")
+        for stage_name, rate in sorted(rates.items()):
+            lines.append(
+                f'{prefix}_stage_rows_per_second{{stage="{stage_name}"}} {rate:g}'
+            )
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(path: str) -> None:
+    """
+    Writes the recorded metrics to a file, in the Prometheus text format if its
+    extension is '.prom', as JSON otherwise.
+    """
+    with open(path, "w") as f:
+        if path.endswith(".prom"):
+            f.write(to_prometheus())
+        else:
+            json.dump(to_dict(), f, indent=2)
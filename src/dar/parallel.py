@@ -0,0 +1,112 @@
+import multiprocessing
+import multiprocessing.pool
+from collections import deque
+from itertools import islice
+from typing import Any, Callable, Deque, Iterable, Iterator, List, Optional, TypeVar
+
+from dar import metrics
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def create_pool(n_workers: int) -> Optional[multiprocessing.pool.Pool]:
+    """
+    Creates a pool of worker processes to pass to 'imap_ordered' (and to the
+    functions built on it), so that the same workers are reused across calls,
+    e.g. for all the chunks of a streamed dataset. If metrics are enabled, they
+    must be enabled before the pool is created.
+
+    Args:
+        n_workers: Number of worker processes
+    Returns:
+        The pool, to be closed by the caller (e.g. as a context manager), or None
+        if n_workers <= 1, i.e. processing in the current process
+    """
+    if n_workers <= 1:
+        return None
+    if metrics.is_enabled():
+        return multiprocessing.Pool(
+            processes=n_workers, initializer=metrics.init_worker
+        )
+    return multiprocessing.Pool(processes=n_workers)
+
+
+def imap_ordered(
+    function: Callable[[T], R],
+    iterable: Iterable[T],
+    n_workers: int = 1,
+    chunksize: int = 64,
+    pool: Optional[multiprocessing.pool.Pool] = None,
+) -> Iterator[R]:
+    """
+    Lazily applies a function to every item of an iterable, optionally fanning the
+    work out to a pool of processes. Results are yielded in input order.
+
+    A fixed number of chunks (a few per worker) is kept in flight: a new chunk is
+    submitted as soon as the oldest one has been processed, so that the workers
+    never wait for the consumer to drain a window, and memory stays bounded when
+    streaming large inputs ('Pool.imap' would otherwise read the whole iterable
+    ahead of the workers). If metrics are enabled, those recorded by the workers
+    are merged into the ones of the current process.
+
+    Args:
+        function: Function to apply, must be picklable (i.e. defined at module level)
+                  when n_workers > 1
+        iterable: Items to process
+        n_workers: Number of worker processes. With 1 (or less) and no pool, the
+                   items are processed in the current process.
+        chunksize: Number of items sent to a worker at once
+        pool: Pool from 'create_pool', with n_workers processes, reused instead of
+              creating a new pool for this call
+    Returns:
+        Iterator over the results, in the same order as the input items
+    """
+    if pool is None and n_workers <= 1:
+        for item in iterable:
+            yield function(item)
+        return
+
+    if pool is not None:
+        yield from _imap_pool(pool, function, iterable, n_workers, chunksize)
+        return
+    new_pool = create_pool(n_workers)
+    assert new_pool is not None
+    with new_pool:
+        yield from _imap_pool(new_pool, function, iterable, n_workers, chunksize)
+
+
+def _imap_pool(
+    pool: multiprocessing.pool.Pool,
+    function: Callable[[T], R],
+    iterable: Iterable[T],
+    n_workers: int,
+    chunksize: int,
+) -> Iterator[R]:
+    iterator = iter(iterable)
+    max_pending = 4 * max(n_workers, 1)
+    pending: Deque[Any] = deque()
+
+    def submit() -> bool:
+        chunk = list(islice(iterator, chunksize))
+        if chunk:
+            pending.append(
+                pool.apply_async(
+                    metrics.call_with_metrics, (_apply_to_chunk, function, chunk)
+                )
+            )
+        return bool(chunk)
+
+    while len(pending) < max_pending and submit():
+        pass
+    while pending:
+        results, recorded = pending.popleft().get()
+        # Keeps the workers busy while the results are consumed
+        submit()
+        if recorded is not None:
+            metrics.merge(recorded)
+        yield from results
+
+
+def _apply_to_chunk(function: Callable[[T], R], chunk: List[T]) -> List[R]:
+    return [function(item) for item in chunk]
@@ -0,0 +1,548 @@
+"""
+Execution of the map -> tag pipeline over hash-partitioned shards of a dataset,
+on any number of nodes coordinated through a shared filesystem only.
+
+Layout of a work directory:
+
+    manifest.json               input file, number of shards, rows of each shard
+    shards/
+        shard-00000.csv         input rows of the shard, with the '_row_id' column
+        ...
+    claims/
+        shard-00000.0           claim of the shard (generation 0), see 'ShardClaim'
+    runs/
+        shard-00000.0/          outputs of the stages run under a claim generation
+            shard-00000.csv     link to the input of the shard
+            shard-00000.mapped.csv
+            ...                 outputs named as for a single file
+    outputs/
+        shard-00000/            the run of the shard that completed first, renamed
+    done/
+        shard-00000             created once the outputs of the shard are complete
+
+The reactions are assigned to the shards by the hash of their SMILES, so that
+the duplicates of a reaction are in the same shard, and the split only depends
+on the input and the number of shards. The '_row_id' column (the row index in
+the input) is carried through the stages, and the outputs of the shards are
+merged back in input order into the files of a single-node run.
+
+Each claim generation runs the stages in its own directory, so that a node that
+lost its claim (e.g. it was only slow to refresh it) never writes to the files of
+the node that took the shard over. A shard taken over starts again from scratch.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+
+from dar.dedup import reaction_hash
+from dar.io import DataFormat, TableWriter, get_output_path, iter_table_chunks
+from dar.stats import get_stats_path, merge_stats_files, write_reports
+from dar.templates import TemplateTable
+
+ROW_ID_COLUMN = "_row_id"
+MANIFEST_FILE = "manifest.json"
+SHARDS_DIRECTORY = "shards"
+CLAIMS_DIRECTORY = "claims"
+RUNS_DIRECTORY = "runs"
+OUTPUTS_DIRECTORY = "outputs"
+DONE_DIRECTORY = "done"
+
+# Outputs of the stages merged row by row, in the order of the pipeline
+MERGED_OUTPUTS = ["mapped", "tagged", "tagged_filtered"]
+
+
+def get_shard_index(reaction: str, num_shards: int) -> int:
+    """
+    Args:
+        reaction: Reaction SMILES
+        num_shards: Number of shards
+    Returns:
+        Index of the shard of the reaction, the same on every node and run
+    """
+    digest = hashlib.sha256(reaction.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+
+class ShardManifest(NamedTuple):
+    """
+    Description of the split of a dataset, see 'split_dataset'.
+
+    Attributes:
+        file_path: Absolute path to the input file
+        num_shards: Number of shards
+        reaction_column: Column of the reactions the shards were assigned from
+        shard_rows: Number of input rows in each shard
+    """
+
+    file_path: str
+    num_shards: int
+    reaction_column: str
+    shard_rows: List[int]
+
+    @property
+    def num_rows(self) -> int:
+        return sum(self.shard_rows)
+
+    @property
+    def shard_names(self) -> List[str]:
+        return [f"shard-{i:05d}" for i in range(self.num_shards)]
+
+    def save(self, work_dir: str) -> None:
+        # The manifest is written last, and never incomplete: once it exists, the
+        # split is complete
+        path = os.path.join(work_dir, MANIFEST_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._asdict(), f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, work_dir: str) -> "ShardManifest":
+        path = os.path.join(work_dir, MANIFEST_FILE)
+        if not os.path.exists(path):
+            raise FileNotFoundError(
+                f"No shard manifest in {work_dir}: the dataset has not been split."
+            )
+        with open(path) as f:
+            return cls(**json.load(f))
+
+
+def get_shard_input_path(work_dir: str, shard_name: str) -> str:
+    return os.path.join(work_dir, SHARDS_DIRECTORY, f"{shard_name}.csv")
+
+
+def split_dataset(
+    file_path: str,
+    work_dir: str,
+    num_shards: int,
+    reaction_column: str = "rxn",
+    chunk_size: int = 100000,
+) -> ShardManifest:
+    """
+    Splits a dataset into hash-partitioned CSV shards, streaming it in chunks.
+    The rows of each shard keep their input order, with their input row index in
+    the '_row_id' column. Splitting an already split dataset again with the same
+    parameters returns its manifest.
+
+    Args:
+        file_path: CSV, Parquet or Arrow file containing the reactions
+        work_dir: Work directory, created if needed
+        num_shards: Number of shards
+        reaction_column: Column containing the reactions
+        chunk_size: Number of rows read from the input file at once
+
+    Returns:
+        The manifest of the split
+    """
+    file_path = os.path.abspath(file_path)
+    if os.path.exists(os.path.join(work_dir, MANIFEST_FILE)):
+        manifest = ShardManifest.load(work_dir)
+        if (manifest.file_path, manifest.num_shards, manifest.reaction_column) != (
+            file_path,
+            num_shards,
+            reaction_column,
+        ):
+            raise ValueError(
+                f"{work_dir} already contains the {manifest.num_shards} shards of "
+                f"{manifest.file_path} (column '{manifest.reaction_column}')."
+            )
+        return manifest
+
+    os.makedirs(os.path.join(work_dir, SHARDS_DIRECTORY), exist_ok=True)
+    shard_names = [f"shard-{i:05d}" for i in range(num_shards)]
+    writers = [
+        TableWriter(get_shard_input_path(work_dir, name)) for name in shard_names
+    ]
+    shard_rows = [0] * num_shards
+    columns: List[str] = []
+    num_rows = 0
+    for chunk in iter_table_chunks(file_path, chunk_size):
+        chunk[ROW_ID_COLUMN] = np.arange(num_rows, num_rows + len(chunk))
+        columns = chunk.columns.to_list()
+        shard_indices = np.array(
+            [get_shard_index(str(rxn), num_shards) for rxn in chunk[reaction_column]]
+        )
+        for index in np.unique(shard_indices):
+            writers[index].write(chunk[shard_indices == index])
+            shard_rows[index] += int((shard_indices == index).sum())
+        num_rows += len(chunk)
+
+    for writer, num_shard_rows in zip(writers, shard_rows):
+        if num_shard_rows == 0:
+            # Empty shards still have the columns of the dataset
+            writer.write(pd.DataFrame(columns=columns))
+        writer.close()
+
+    manifest = ShardManifest(file_path, num_shards, reaction_column, shard_rows)
+    manifest.save(work_dir)
+    return manifest
+
+
+class ShardClaim:
+    """
+    Exclusive claim of a shard by one node, through files of the claims
+    directory created with O_CREAT | O_EXCL, an atomic operation on shared
+    filesystems.
+
+    The claims of a shard are numbered by generation: 'shard-00000.0', then
+    'shard-00000.1' if the claim of generation 0 became stale (its node stopped
+    refreshing it, e.g. after a crash), and so on. Exactly one node creates each
+    generation, and the node holding the highest one owns the shard. While the
+    claim is held (as a context manager), a thread refreshes its modification
+    time every heartbeat seconds.
+    """
+
+    def __init__(self, path: str, heartbeat: float = 60.0):
+        self.path = path
+        self.heartbeat = heartbeat
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def acquire(
+        cls,
+        work_dir: str,
+        shard_name: str,
+        stale_after: Optional[float] = None,
+        heartbeat: float = 60.0,
+    ) -> Optional["ShardClaim"]:
+        """
+        Args:
+            work_dir: Work directory of the split
+            shard_name: Name of the shard, e.g. 'shard-00000'
+            stale_after: Number of seconds after which a claim that was not
+                         refreshed can be taken over; never if None
+            heartbeat: Number of seconds between refreshes of the claim
+
+        Returns:
+            The claim, or None if another node holds the shard
+        """
+        directory = os.path.join(work_dir, CLAIMS_DIRECTORY)
+        os.makedirs(directory, exist_ok=True)
+
+        generation = 0
+        generations = _get_claim_generations(directory, shard_name)
+        if generations:
+            generation = max(generations)
+            if stale_after is None:
+                return None
+            try:
+                age = time.time() - os.path.getmtime(
+                    os.path.join(directory, f"{shard_name}.{generation}")
+                )
+            except FileNotFoundError:
+                return None
+            if age < stale_after:
+                return None
+            generation += 1
+
+        path = os.path.join(directory, f"{shard_name}.{generation}")
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # Another node claimed the shard first
+            return None
+        with os.fdopen(fd, "w") as f:
+            json.dump(_get_owner(), f)
+        return cls(path, heartbeat=heartbeat)
+
+    @property
+    def shard_name(self) -> str:
+        return os.path.basename(self.path).rsplit(".", 1)[0]
+
+    @property
+    def generation(self) -> int:
+        return int(self.path.rsplit(".", 1)[1])
+
+    @property
+    def owned(self) -> bool:
+        """Whether no other node took over the shard since it was claimed."""
+        generations = _get_claim_generations(
+            os.path.dirname(self.path), self.shard_name
+        )
+        return bool(generations) and max(generations) == self.generation
+
+    def release(self) -> None:
+        """
+        Gives the shard up, e.g. after a failure, so that it can be claimed again
+        by any node. Does nothing if the claim was taken over.
+        """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _refresh(self) -> None:
+        while not self._stop.wait(self.heartbeat):
+            os.utime(self.path)
+
+    def __enter__(self) -> "ShardClaim":
+        self._thread = threading.Thread(target=self._refresh, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def _get_claim_generations(directory: str, shard_name: str) -> List[int]:
+    prefix = shard_name + "."
+    return [
+        int(name[len(prefix) :])
+        for name in os.listdir(directory)
+        if name.startswith(prefix) and name[len(prefix) :].isdigit()
+    ]
+
+
+def _get_owner() -> Dict[str, Any]:
+    return {"host": socket.gethostname(), "pid": os.getpid(), "time": time.time()}
+
+
+def create_shard_run(work_dir: str, claim: ShardClaim) -> str:
+    """
+    Creates the run directory of a claim generation, if it does not exist yet
+    (e.g. the claim was released after a failure, and acquired again).
+
+    Args:
+        work_dir: Work directory of the split
+        claim: Claim of the shard
+    Returns:
+        Path to the input of the run, a link to the input of the shard: the
+        outputs of the stages run on it are written to the run directory
+    """
+    run_directory = _get_run_directory(work_dir, claim)
+    os.makedirs(run_directory, exist_ok=True)
+    input_path = os.path.join(run_directory, f"{claim.shard_name}.csv")
+    if not os.path.lexists(input_path):
+        # Relative, so that it is still valid once the run is promoted
+        os.symlink(
+            os.path.relpath(
+                get_shard_input_path(work_dir, claim.shard_name), run_directory
+            ),
+            input_path,
+        )
+    return input_path
+
+
+def promote_shard_run(work_dir: str, claim: ShardClaim) -> bool:
+    """
+    Makes the outputs of a completed run the outputs of the shard, by renaming
+    its directory, an atomic operation. If another run of the shard was promoted
+    first, the run is removed instead: both have the same outputs.
+
+    Args:
+        work_dir: Work directory of the split
+        claim: Claim under which the run completed
+    Returns:
+        Whether the run was promoted
+    """
+    run_directory = _get_run_directory(work_dir, claim)
+    output_directory = os.path.dirname(
+        get_shard_output_path(work_dir, claim.shard_name)
+    )
+    os.makedirs(os.path.dirname(output_directory), exist_ok=True)
+    try:
+        os.rename(run_directory, output_directory)
+    except OSError:
+        if not os.path.exists(output_directory):
+            raise
+        shutil.rmtree(run_directory)
+        return False
+    return True
+
+
+def remove_shard_run(work_dir: str, claim: ShardClaim) -> None:
+    """Removes the run directory of a claim, e.g. after the shard was taken over."""
+    shutil.rmtree(_get_run_directory(work_dir, claim), ignore_errors=True)
+
+
+def _get_run_directory(work_dir: str, claim: ShardClaim) -> str:
+    return os.path.join(
+        work_dir, RUNS_DIRECTORY, f"{claim.shard_name}.{claim.generation}"
+    )
+
+
+def get_shard_output_path(work_dir: str, shard_name: str) -> str:
+    """
+    Path from which the paths of the promoted outputs of a shard are derived,
+    see 'get_output_path'.
+    """
+    return os.path.join(work_dir, OUTPUTS_DIRECTORY, shard_name, f"{shard_name}.csv")
+
+
+def is_shard_done(work_dir: str, shard_name: str) -> bool:
+    return os.path.exists(os.path.join(work_dir, DONE_DIRECTORY, shard_name))
+
+
+def mark_shard_done(work_dir: str, shard_name: str) -> None:
+    directory = os.path.join(work_dir, DONE_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, shard_name), "w") as f:
+        json.dump(_get_owner(), f)
+
+
+def merge_sorted_tables(
+    paths: List[str], output_path: str, chunk_size: int = 100000
+) -> int:
+    """
+    Merges tables sorted by their '_row_id' column into one table in the order of
+    the row ids, without the '_row_id' column, streaming them in chunks.
+
+    Args:
+        paths: Tables to merge, e.g. the tagged outputs of all the shards
+        output_path: Merged table
+        chunk_size: Number of rows read from each table at once
+
+    Returns:
+        Number of rows of the merged table
+    """
+    columns: List[str] = []
+
+    def next_chunk(reader: Iterator[pd.DataFrame]) -> Optional[pd.DataFrame]:
+        for chunk in reader:
+            if not columns:
+                columns.extend(c for c in chunk.columns if c != ROW_ID_COLUMN)
+            if len(chunk) > 0:
+                return chunk
+        return None
+
+    readers = [iter_table_chunks(path, chunk_size) for path in paths]
+    buffers: Dict[int, pd.DataFrame] = {}
+    for i, reader in enumerate(readers):
+        chunk = next_chunk(reader)
+        if chunk is not None:
+            buffers[i] = chunk
+
+    num_rows = 0
+    with TableWriter(output_path) as writer:
+        while buffers:
+            # All the rows up to the end of the buffer ending first are available
+            end = min(
+                int(buffer[ROW_ID_COLUMN].iloc[-1]) for buffer in buffers.values()
+            )
+            pieces = []
+            for i, buffer in list(buffers.items()):
+                is_ready = (buffer[ROW_ID_COLUMN] <= end).to_numpy()
+                pieces.append(buffer[is_ready])
+                if is_ready.all():
+                    chunk = next_chunk(readers[i])
+                    if chunk is None:
+                        del buffers[i]
+                    else:
+                        buffers[i] = chunk
+                else:
+                    buffers[i] = buffer[~is_ready]
+
+            merged = pd.concat(pieces).sort_values(ROW_ID_COLUMN, kind="stable")
+            writer.write(merged[columns])
+            num_rows += len(merged)
+        if num_rows == 0:
+            writer.write(pd.DataFrame(columns=columns))
+    return num_rows
+
+
+def merge_template_tables(
+    paths: List[str], tagged_path: str, output_path: str, chunk_size: int = 100000
+) -> int:
+    """
+    Merges the template tables of the shards into the one of a single-node run:
+    the templates are counted again over the merged tagged output, so that they
+    are in the order in which they first appear in the dataset, with the same
+    example reactions.
+
+    Args:
+        paths: Template tables of the shards, see 'TemplateTable'
+        tagged_path: Merged tagged output, with the 'template_hash' column
+        output_path: Merged template table
+        chunk_size: Number of rows read at once
+
+    Returns:
+        Number of distinct templates
+    """
+    templates: Dict[str, str] = {}
+    for path in paths:
+        for chunk in iter_table_chunks(path, chunk_size, columns=["retro_template"]):
+            templates.update(
+                (reaction_hash(template, canonical=False), template)
+                for template in chunk["retro_template"]
+            )
+
+    with TemplateTable(output_path) as table:
+        for chunk in iter_table_chunks(
+            tagged_path, chunk_size, columns=["mapped_rxn", "template_hash"]
+        ):
+            for reaction, template_hash in zip(
+                chunk["mapped_rxn"].fillna(""), chunk["template_hash"]
+            ):
+                if isinstance(template_hash, str) and template_hash:
+                    table.add(templates[template_hash], reaction)
+    return len(table)
+
+
+def merge_shards(
+    work_dir: str,
+    output_path: Optional[str] = None,
+    data_format: Optional[DataFormat] = None,
+    num_tag_rows: int = 10,
+    chunk_size: int = 100000,
+) -> None:
+    """
+    Merges the outputs of all the shards into the files of a single-node run on
+    the input dataset: the mapped, tagged and tagged_filtered tables, the tag
+    statistics and reports, and the template table if the templates were
+    extracted.
+
+    Args:
+        work_dir: Work directory of the split, with all the shards done
+        output_path: Path from which the output paths are derived, see
+                     'get_output_path'; the input file if None
+        data_format: Format of the outputs of the shards, CSV if None
+        num_tag_rows: Numbers of tags below this value are reported individually
+        chunk_size: Number of rows read from each shard at once
+    """
+    manifest = ShardManifest.load(work_dir)
+    missing = [
+        name for name in manifest.shard_names if not is_shard_done(work_dir, name)
+    ]
+    if missing:
+        raise ValueError(f"{len(missing)} shards are not done yet, e.g. {missing[0]}.")
+    if output_path is None:
+        output_path = manifest.file_path
+
+    shard_paths = [
+        get_shard_output_path(work_dir, name) for name in manifest.shard_names
+    ]
+    for suffix in MERGED_OUTPUTS:
+        merge_sorted_tables(
+            [get_output_path(path, suffix, data_format) for path in shard_paths],
+            get_output_path(output_path, suffix, data_format),
+            chunk_size=chunk_size,
+        )
+
+    stats = merge_stats_files(get_stats_path(path) for path in shard_paths)
+    stats.save(get_stats_path(output_path))
+    write_reports(stats, output_path, data_format, num_rows=num_tag_rows)
+
+    template_paths = [
+        get_output_path(path, "templates", data_format) for path in shard_paths
+    ]
+    if all(os.path.exists(path) for path in template_paths):
+        merge_template_tables(
+            template_paths,
+            get_output_path(output_path, "tagged", data_format),
+            get_output_path(output_path, "templates", data_format),
+            chunk_size=chunk_size,
+        )
@@ -0,0 +1,282 @@
+"""
+Binary shards of tokenised training data, so that the data for a new tagging
+variant or vocabulary is rebuilt by copying arrays instead of tokenising text.
+
+Layout of a shard directory:
+
+    vocab.json              merged vocabulary, see 'build_vocab'
+    shard-00000/
+        vocab.json          tokens of the shard with their counts
+        src_ids.npy         token ids (in the shard vocabulary) of the sources
+        src_offsets.npy     start of each source in src_ids, and the total length
+        tgt_ids.npy         same for the targets
+        tgt_offsets.npy
+    shard-00001/
+        ...
+
+The shards are written independently, each with its own vocabulary; the merged
+vocabulary is built from their token counts, and 'ShardReader' maps the ids of
+each shard to the merged vocabulary when reading them.
+"""
+
+import json
+import os
+import shutil
+from array import array
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from dar.io import iter_table_chunks
+from dar.tokenisation import tokenize_reactions
+
+# Special tokens of OpenNMT, first in the merged vocabulary
+SPECIAL_TOKENS = ["<unk>", "<blank>", "<s>", "</s>"]
+UNK_ID = 0
+
+SIDES = ("src", "tgt")
+VOCAB_FILE = "vocab.json"
+
+
+def _shard_directories(directory: str) -> List[str]:
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.startswith("shard-")
+    )
+
+
+def write_shard(directory: str, pairs: Iterable[Tuple[str, str]]) -> int:
+    """
+    Writes tokenised (source, target) pairs to a shard directory. The shard is
+    written under a temporary name first, so that an interrupted write never
+    leaves an incomplete shard.
+
+    Args:
+        directory: Shard directory, e.g. '<output_dir>/shard-00000'
+        pairs: Tokenised sources and targets (tokens separated by spaces)
+    Returns:
+        Number of pairs written
+    """
+    token_ids: Dict[str, int] = {}
+    counts: List[int] = []
+    ids = {side: array("i") for side in SIDES}
+    offsets = {side: array("q", [0]) for side in SIDES}
+
+    num_pairs = 0
+    for pair in pairs:
+        for side, tokens in zip(SIDES, pair):
+            for token in tokens.split():
+                token_id = token_ids.get(token)
+                if token_id is None:
+                    token_id = token_ids[token] = len(counts)
+                    counts.append(0)
+                counts[token_id] += 1
+                ids[side].append(token_id)
+            offsets[side].append(len(ids[side]))
+        num_pairs += 1
+
+    parent, name = os.path.split(directory.rstrip(os.sep))
+    tmp_directory = os.path.join(parent, f".{name}")
+    os.makedirs(tmp_directory, exist_ok=True)
+    for side in SIDES:
+        np.save(
+            os.path.join(tmp_directory, f"{side}_ids.npy"),
+            np.frombuffer(ids[side], dtype=np.int32),
+        )
+        np.save(
+            os.path.join(tmp_directory, f"{side}_offsets.npy"),
+            np.frombuffer(offsets[side], dtype=np.int64),
+        )
+    with open(os.path.join(tmp_directory, VOCAB_FILE), "w") as f:
+        json.dump({"tokens": list(token_ids), "counts": counts}, f)
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.replace(tmp_directory, directory)
+
+    return num_pairs
+
+
+def build_vocab(directory: str, max_size: Optional[int] = None) -> List[str]:
+    """
+    Merges the token counts of all the shards of a directory into a vocabulary,
+    saved to '<directory>/vocab.json': the special tokens, then the tokens from the
+    most to the least frequent.
+
+    Args:
+        directory: Directory containing the shards
+        max_size: Maximal number of tokens (without the special tokens); the
+                  least frequent ones are read as '<unk>'
+    Returns:
+        The tokens of the vocabulary, the index of each token being its id
+    """
+    counts: Dict[str, int] = {}
+    for shard_directory in _shard_directories(directory):
+        with open(os.path.join(shard_directory, VOCAB_FILE)) as f:
+            shard_vocab = json.load(f)
+        for token, count in zip(shard_vocab["tokens"], shard_vocab["counts"]):
+            counts[token] = counts.get(token, 0) + count
+
+    tokens = sorted(counts, key=lambda token: (-counts[token], token))
+    if max_size is not None:
+        tokens = tokens[:max_size]
+    with open(os.path.join(directory, VOCAB_FILE), "w") as f:
+        json.dump(
+            {
+                "tokens": SPECIAL_TOKENS + tokens,
+                "counts": [0] * len(SPECIAL_TOKENS) + [counts[t] for t in tokens],
+            },
+            f,
+        )
+    return SPECIAL_TOKENS + tokens
+
+
+def write_shards(
+    file_path: str,
+    output_dir: str,
+    shard_size: int = 100000,
+    reaction_column: str = "tagged_rxn",
+    enzymatic: bool = False,
+    n_workers: int = 1,
+    chunk_size: int = 100000,
+    max_vocab_size: Optional[int] = None,
+) -> int:
+    """
+    Streams a tagged (filtered) dataset and writes the tokenised products (source)
+    and precursors (target) to binary shards, then builds the merged vocabulary.
+    Reactions that cannot be tokenised are skipped, and the existing shards of the
+    output directory replaced.
+
+    Args:
+        file_path: CSV, Parquet or Arrow file containing the reactions
+        output_dir: Directory for the shards, created if needed
+        shard_size: Number of pairs per shard
+        reaction_column: Column containing the reactions
+        enzymatic: Whether the reactions contain EC numbers, see
+                   'tokenize_and_split_reaction_smiles'
+        n_workers: Number of tokenisation processes
+        chunk_size: Number of rows read from the input file at once
+        max_vocab_size: Maximal size of the merged vocabulary, see 'build_vocab'
+    Returns:
+        Number of pairs written
+    """
+
+    def reactions() -> Iterator[str]:
+        for chunk in iter_table_chunks(
+            file_path, chunk_size, columns=[reaction_column]
+        ):
+            yield from chunk[reaction_column]
+
+    def pairs() -> Iterator[Tuple[str, str]]:
+        for _, tokens in tokenize_reactions(
+            reactions(), enzymatic=enzymatic, n_workers=n_workers
+        ):
+            if tokens is not None:
+                precursors_tokens, products_tokens = tokens
+                yield products_tokens, precursors_tokens
+
+    os.makedirs(output_dir, exist_ok=True)
+    # Shards of a previous run would otherwise be read with the new ones
+    for shard_directory in _shard_directories(output_dir):
+        shutil.rmtree(shard_directory)
+
+    num_pairs = 0
+    index = 0
+    pair_iterator = pairs()
+    while True:
+        shard_pairs = list(islice(pair_iterator, shard_size))
+        if not shard_pairs:
+            break
+        num_pairs += write_shard(
+            os.path.join(output_dir, f"shard-{index:05d}"), shard_pairs
+        )
+        index += 1
+
+    build_vocab(output_dir, max_size=max_vocab_size)
+    return num_pairs
+
+
+class ShardReader:
+    """
+    Random access to the pairs of a shard directory, as arrays of ids in the
+    merged vocabulary. The arrays of the shards are memory-mapped.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Args:
+            directory: Directory containing the shards and the merged vocabulary
+        """
+        with open(os.path.join(directory, VOCAB_FILE)) as f:
+            self.tokens: List[str] = json.load(f)["tokens"]
+        token_ids = {token: i for i, token in enumerate(self.tokens)}
+
+        self._ids: List[Dict[str, np.ndarray]] = []
+        self._offsets: List[Dict[str, np.ndarray]] = []
+        # Merged id of each id of a shard
+        self._lookups: List[np.ndarray] = []
+        sizes = []
+        for shard_directory in _shard_directories(directory):
+            self._ids.append(
+                {
+                    side: np.load(
+                        os.path.join(shard_directory, f"{side}_ids.npy"), mmap_mode="r"
+                    )
+                    for side in SIDES
+                }
+            )
+            self._offsets.append(
+                {
+                    side: np.load(
+                        os.path.join(shard_directory, f"{side}_offsets.npy"),
+                        mmap_mode="r",
+                    )
+                    for side in SIDES
+                }
+            )
+            with open(os.path.join(shard_directory, VOCAB_FILE)) as f:
+                shard_tokens = json.load(f)["tokens"]
+            self._lookups.append(
+                np.array(
+                    [token_ids.get(token, UNK_ID) for token in shard_tokens],
+                    dtype=np.int32,
+                )
+            )
+            sizes.append(len(self._offsets[-1]["src"]) - 1)
+        # Index of the first pair of each shard, and the total number of pairs
+        self._starts = np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)])
+
+    def __len__(self) -> int:
+        return int(self._starts[-1])
+
+    def __getitem__(self, index: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Args:
+            index: Index of the pair, over all the shards
+        Returns:
+            Ids of the source and target tokens in the merged vocabulary
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Pair index out of range: {index}")
+        shard = int(np.searchsorted(self._starts, index, side="right")) - 1
+        i = index - int(self._starts[shard])
+        src, tgt = (
+            self._lookups[shard][
+                self._ids[shard][side][
+                    self._offsets[shard][side][i] : self._offsets[shard][side][i + 1]
+                ]
+            ]
+            for side in SIDES
+        )
+        return src, tgt
+
+    def __iter__(self) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def decode(self, ids: Iterable[int]) -> str:
+        """Tokens (separated by spaces) corresponding to ids."""
+        return " ".join(self.tokens[i] for i in ids)
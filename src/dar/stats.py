@@ -0,0 +1,216 @@
+"""
+Statistics of a tagged dataset as mergeable partial aggregates, so that the
+statistics of a dataset processed in shards (or on several nodes) are computed
+without ever holding the full table:
+
+    # for each shard
+    stats = TagStatistics()
+    for chunk in chunks:
+        stats.update(tag_data(chunk, ...))
+    stats.save("shard-00000.tag_stats.json")
+
+    # reducer
+    stats = merge_stats_files(glob("*.tag_stats.json"))
+    write_reports(stats, "data/uspto.csv")
+
+Merging the statistics of the shards gives the same result as computing them
+over the whole dataset at once, in any order.
+"""
+
+import json
+import os
+import re
+from collections import Counter
+from typing import Any, Dict, Iterable, Optional
+
+import pandas as pd
+
+from dar.io import DataFormat, get_output_path, write_table
+
+# Element symbol of a tagged bracket atom, e.g. 'C' for '[CH2:1]' or 'n' for '[nH:1]'
+_TAGGED_ATOM_REGEX = re.compile(r"\[\d*([A-Z][a-z]?|se|as|te|[bcnops])[^\]]*:1\]")
+
+
+class TagStatistics:
+    """
+    Histograms of a tagged dataset:
+        num_tags: Number of reactions for each number of tagged atoms
+        tag_combinations: Number of reactions for each number of tag combinations
+        tagged_elements: Number of tagged atoms for each element
+    """
+
+    def __init__(
+        self,
+        num_tags: Optional[Dict[int, int]] = None,
+        tag_combinations: Optional[Dict[int, int]] = None,
+        tagged_elements: Optional[Dict[str, int]] = None,
+    ):
+        self.num_tags: Counter = Counter(num_tags or {})
+        self.tag_combinations: Counter = Counter(tag_combinations or {})
+        self.tagged_elements: Counter = Counter(tagged_elements or {})
+
+    def update(self, data: pd.DataFrame) -> None:
+        """
+        Adds the reactions of a dataframe to the statistics.
+
+        Args:
+            data: Dataframe output from 'tag_data', with the num_tags,
+                  tag_combinations and tagged_products columns
+        """
+        self.num_tags.update(int(n) for n in data["num_tags"])
+        self.tag_combinations.update(int(n) for n in data["tag_combinations"])
+        for tagged_products in data["tagged_products"]:
+            if isinstance(tagged_products, str):
+                self.tagged_elements.update(
+                    element.capitalize()
+                    for element in _TAGGED_ATOM_REGEX.findall(tagged_products)
+                )
+
+    def merge(self, other: "TagStatistics") -> None:
+        """Adds the statistics of another shard to these ones."""
+        self.num_tags.update(other.num_tags)
+        self.tag_combinations.update(other.tag_combinations)
+        self.tagged_elements.update(other.tagged_elements)
+
+    @property
+    def num_reactions(self) -> int:
+        return sum(self.num_tags.values())
+
+    def to_dict(self) -> Dict[str, Any]:
+        # JSON keys are strings
+        return {
+            "num_tags": {str(k): v for k, v in sorted(self.num_tags.items())},
+            "tag_combinations": {
+                str(k): v for k, v in sorted(self.tag_combinations.items())
+            },
+            "tagged_elements": dict(sorted(self.tagged_elements.items())),
+        }
+
+    @classmethod
+    def from_dict(cls, stats: Dict[str, Any]) -> "TagStatistics":
+        return cls(
+            num_tags=Counter({int(k): v for k, v in stats["num_tags"].items()}),
+            tag_combinations=Counter(
+                {int(k): v for k, v in stats["tag_combinations"].items()}
+            ),
+            tagged_elements=Counter(stats["tagged_elements"]),
+        )
+
+    def save(self, path: str) -> None:
+        """Saves the statistics to a JSON file."""
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path: str) -> "TagStatistics":
+        """Loads statistics saved with 'save'."""
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    def get_tag_report(self, num_rows: int = 10) -> pd.DataFrame:
+        """
+        Generates the report on the distribution of atom tags in the dataset.
+
+        Args:
+            num_rows: Numbers of tags below this value are reported individually
+
+        Returns:
+            Dataframe with the counts and dataset fraction for each observed number
+            of tags below num_rows, and the reactions with num_rows tags or more
+            in a '<num_rows>+' row
+        """
+        tag_stats = sorted(self.num_tags.items())
+        tag_stats_df = pd.DataFrame(
+            [(n, counts) for n, counts in tag_stats if n < num_rows],
+            columns=["num_tags", "counts"],
+        )
+        counts_remaining = sum(counts for n, counts in tag_stats if n >= num_rows)
+        tag_stats_df.loc[len(tag_stats_df.index)] = [f"{num_rows}+", counts_remaining]
+        tag_stats_df["dataset_fraction"] = _get_fractions(tag_stats_df["counts"])
+        return tag_stats_df
+
+    def get_combination_report(self) -> pd.DataFrame:
+        """
+        Returns:
+            Dataframe with the number of reactions and dataset fraction for each
+            number of tag combinations
+        """
+        df = pd.DataFrame(
+            sorted(self.tag_combinations.items()),
+            columns=["tag_combinations", "counts"],
+        )
+        df["dataset_fraction"] = _get_fractions(df["counts"])
+        return df
+
+    def get_element_report(self) -> pd.DataFrame:
+        """
+        Returns:
+            Dataframe with the number and fraction of tagged atoms for each
+            element, from the most to the least tagged
+        """
+        df = pd.DataFrame(
+            sorted(self.tagged_elements.items(), key=lambda item: (-item[1], item[0])),
+            columns=["element", "counts"],
+        )
+        df["tagged_atom_fraction"] = _get_fractions(df["counts"])
+        return df
+
+
+def _get_fractions(counts: pd.Series) -> pd.Series:
+    """Percentages of the total, rounded to two decimals, 0.0 if the total is 0."""
+    total = counts.sum()
+    if total == 0:
+        return counts.apply(lambda x: 0.0)
+    return counts.apply(lambda x: round(x / total * 100, 2))
+
+
+def get_stats_path(input_path: str) -> str:
+    """
+    Path of the statistics file of a dataset, e.g. 'data/uspto.mapped.csv' ->
+    'data/uspto.tag_stats.json', see 'get_output_path'.
+    """
+    return os.path.splitext(get_output_path(input_path, "tag_stats"))[0] + ".json"
+
+
+def merge_stats_files(paths: Iterable[str]) -> TagStatistics:
+    """
+    Args:
+        paths: Statistics files saved with 'TagStatistics.save'
+
+    Returns:
+        The merged statistics
+    """
+    stats = TagStatistics()
+    for path in paths:
+        stats.merge(TagStatistics.load(path))
+    return stats
+
+
+def write_reports(
+    stats: TagStatistics,
+    input_path: str,
+    data_format: Optional[DataFormat] = None,
+    num_rows: int = 10,
+) -> None:
+    """
+    Writes the 'tagged_stats', 'tag_combination_stats' and 'tagged_element_stats'
+    reports next to a dataset, see 'get_output_path'.
+
+    Args:
+        stats: Statistics of the dataset
+        input_path: Path to the dataset, from which the report paths are derived
+        data_format: Format of the reports, CSV if None
+        num_rows: Numbers of tags below this value are reported individually
+    """
+    write_table(
+        stats.get_tag_report(num_rows),
+        get_output_path(input_path, "tagged_stats", data_format),
+    )
+    write_table(
+        stats.get_combination_report(),
+        get_output_path(input_path, "tag_combination_stats", data_format),
+    )
+    write_table(
+        stats.get_element_report(),
+        get_output_path(input_path, "tagged_element_stats", data_format),
+    )
@@ -1,41 +1,225 @@
+import multiprocessing.pool
 import random
 import re
+from collections import OrderedDict
+from enum import Enum, auto, unique
+from functools import partial
 from itertools import chain, combinations
-from typing import Dict, List, Tuple
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    overload,
+)
 
 from rdkit import Chem
+from rxn.chemutils.tokenization import detokenize_smiles
 
-from dar.chem import AtomEnvironment, get_atom_list
+from dar import metrics
+from dar.chem import AtomEnvironment, compare_bond_arrays, get_mol_bond_array
+from dar.parallel import imap_ordered
+from dar.templates import get_mol_template
 
 
-def get_tagged_products(precursor_smiles: str, product_smiles: str) -> str:
+class TaggedProduct(NamedTuple):
+    """
+    Result of tagging the product of an atom-mapped reaction.
+
+    Attributes:
+        tagged_products: SMILES of the product containing tags corresponding to
+                         atoms changed in the reaction using [<atom>:1]
+        changed_atoms: Atom-map numbers for which the atomic environment has changed
+        num_tags: Number of tagged atoms in the product
+        tag_combinations: Number of possible tag combinations, see
+                          'count_tag_combinations'
+        template: Retro template of the reaction, if requested and extracted, see
+                  'get_mol_template'
+    """
+
+    tagged_products: str
+    changed_atoms: Set[int]
+    num_tags: int
+    tag_combinations: int
+    template: Optional[str] = None
+
+
+class TaggingResult(NamedTuple):
+    """
+    Outcome of tagging one reaction with 'tag_reactions'.
+
+    Attributes:
+        reaction: The atom-mapped reaction SMILES that was tagged
+        tagged: The tagging result, or None if tagging failed
+        error: Description of the error if tagging failed, None otherwise
+    """
+
+    reaction: str
+    tagged: Optional[TaggedProduct]
+    error: Optional[str] = None
+
+    @property
+    def success(self) -> bool:
+        return self.tagged is not None
+
+
+def tag_reaction(
+    precursor_smiles: str,
+    product_smiles: str,
+    max_tags: int = 4,
+    template_radius: Optional[int] = None,
+) -> TaggedProduct:
     """
     Given two sets of SMILES strings corresponding to a set of precursors and products,
-    tags the changed atoms in the product molecule.
+    tags the changed atoms in the product molecule and counts the tags.
+
+    Each side of the reaction is parsed exactly once: the product molecule used to
+    determine the atomic neighbourhoods is the one that is tagged and written out,
+    and the one the template is extracted from.
 
     Args:
         precursor_smiles: Atom-mapped SMILES string for the precursor(s)
         product_smiles: Atom-mapped SMILES string for the product(s)
+        max_tags: Tag combinations of max_tags or more tags are not counted
+        template_radius: If not None, also extracts the retro template with this
+                         radius. A failed extraction leaves the template empty.
 
     Returns:
-        SMILES of the product containing tags corresponding to atoms changed in the
-        reaction using [<atom>:1]
+        TaggedProduct with the tagged product SMILES, the changed atom-map numbers,
+        the number of tags, the number of tag combinations and the template
     """
 
+    metrics.increment("rdkit_parses", 2, function="tag_reaction")
+    precursors_mol = Chem.MolFromSmiles(precursor_smiles, sanitize=False)
     products_mol = Chem.MolFromSmiles(product_smiles, sanitize=False)
-    atom_list = get_atom_list(
-        precursor_smiles, product_smiles, atom_environment=AtomEnvironment.CHANGED
+    if precursors_mol is None:
+        raise ValueError(f"Invalid precursor SMILES: {precursor_smiles}")
+    if products_mol is None:
+        raise ValueError(f"Invalid product SMILES: {product_smiles}")
+
+    changed_atoms = set(
+        compare_bond_arrays(
+            get_mol_bond_array(precursors_mol),
+            get_mol_bond_array(products_mol),
+            atom_environment=AtomEnvironment.CHANGED,
+        ).tolist()
     )
 
     # Set atoms in product with a different combing env to 1
-    [
-        atom.SetAtomMapNum(1)
-        if atom.GetAtomMapNum() in atom_list
-        else atom.SetAtomMapNum(0)
-        for atom in products_mol.GetAtoms()
-    ]
+    product_maps = [atom.GetAtomMapNum() for atom in products_mol.GetAtoms()]
+    num_tags = 0
+    for atom in products_mol.GetAtoms():
+        if atom.GetAtomMapNum() in changed_atoms:
+            atom.SetAtomMapNum(1)
+            num_tags += 1
+        else:
+            atom.SetAtomMapNum(0)
+    tagged_products = Chem.MolToSmiles(products_mol)
+
+    template = None
+    if template_radius is not None:
+        for atom, atom_map in zip(products_mol.GetAtoms(), product_maps):
+            atom.SetAtomMapNum(atom_map)
+        template = _get_template_with_error_handling(
+            precursors_mol, products_mol, changed_atoms, template_radius
+        )
+
+    return TaggedProduct(
+        tagged_products=tagged_products,
+        changed_atoms=changed_atoms,
+        num_tags=num_tags,
+        tag_combinations=count_tag_combinations(num_tags, max_tags=max_tags),
+        template=template,
+    )
+
+
+def _get_template_with_error_handling(
+    precursors_mol: Chem.rdchem.Mol,
+    products_mol: Chem.rdchem.Mol,
+    changed_atoms: Set[int],
+    radius: int,
+) -> Optional[str]:
+    try:
+        return get_mol_template(precursors_mol, products_mol, changed_atoms, radius)
+    except Exception as e:
+        metrics.increment(
+            "failures", function="extract_template", reason=e.__class__.__name__
+        )
+        return None
+
+
+def tag_reactions(
+    reactions: Iterable[str],
+    n_workers: int = 1,
+    chunksize: int = 64,
+    max_tags: int = 4,
+    template_radius: Optional[int] = None,
+    pool: Optional[multiprocessing.pool.Pool] = None,
+) -> Iterator[TaggingResult]:
+    """
+    Tags the products of many atom-mapped reactions, optionally in parallel.
+    Failures do not raise but are reported in the corresponding result.
+
+    Args:
+        reactions: Atom-mapped reaction SMILES, e.g. the 'mapped_rxn' column
+        n_workers: Number of worker processes, 1 to tag in the current process
+        chunksize: Number of reactions sent to a worker at once
+        max_tags: Tag combinations of max_tags or more tags are not counted
+        template_radius: If not None, also extracts the retro templates with this
+                         radius, see 'tag_reaction'
+        pool: Pool of n_workers processes reused across calls, see 'create_pool'
+    Returns:
+        Iterator over TaggingResult, in the same order as the input reactions
+    """
+    return imap_ordered(
+        partial(
+            _tag_reaction_with_error_handling,
+            max_tags=max_tags,
+            template_radius=template_radius,
+        ),
+        reactions,
+        n_workers=n_workers,
+        chunksize=chunksize,
+        pool=pool,
+    )
+
+
+def _tag_reaction_with_error_handling(
+    reaction: str, max_tags: int, template_radius: Optional[int] = None
+) -> TaggingResult:
+    try:
+        precursor_smiles, product_smiles = reaction.split(">>")
+        return TaggingResult(
+            reaction,
+            tag_reaction(precursor_smiles, product_smiles, max_tags, template_radius),
+        )
+    except Exception as e:
+        metrics.increment(
+            "failures", function="tag_reaction", reason=e.__class__.__name__
+        )
+        return TaggingResult(reaction, None, f"{e.__class__.__name__}: {e}")
 
-    return Chem.MolToSmiles(products_mol)
+
+def get_tagged_products(precursor_smiles: str, product_smiles: str) -> str:
+    """
+    Given two sets of SMILES strings corresponding to a set of precursors and products,
+    tags the changed atoms in the product molecule.
+
+    Args:
+        precursor_smiles: Atom-mapped SMILES string for the precursor(s)
+        product_smiles: Atom-mapped SMILES string for the product(s)
+
+    Returns:
+        SMILES of the product containing tags corresponding to atoms changed in the
+        reaction using [<atom>:1]
+    """
+
+    return tag_reaction(precursor_smiles, product_smiles).tagged_products
 
 
 def find_number_tags(smiles: str) -> int:
@@ -51,7 +235,10 @@ def find_number_tags(smiles: str) -> int:
     try:
         pattern = r":1\]"
         return len(re.findall(pattern, smiles))
-    except Exception:
+    except Exception as e:
+        metrics.increment(
+            "failures", function="find_number_tags", reason=e.__class__.__name__
+        )
         return 0
 
 
@@ -76,49 +263,109 @@ def get_changed_ids(mol: Chem.rdchem.Mol) -> List[int]:
     return changed_ids
 
 
-def permute_tags(smiles: str) -> List[Tuple[int, ...]]:
+class TagCombinations(Sequence[Tuple[int, ...]]):
+    """
+    Lazy sequence of the combinations of a given size of tagged atomIdxs, in the
+    order of 'itertools.combinations'. Combinations are unranked on access, so
+    indexing and sampling never build the full list.
+    """
+
+    def __init__(self, ids: Sequence[int], size: int):
+        self.ids = tuple(ids)
+        self.size = size
+
+    def __len__(self) -> int:
+        return _binomial(len(self.ids), self.size)
+
+    @overload
+    def __getitem__(self, index: int) -> Tuple[int, ...]: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List[Tuple[int, ...]]: ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("TagCombinations index out of range")
+        return unrank_combination(self.ids, self.size, index)
+
+    def __iter__(self) -> Iterator[Tuple[int, ...]]:
+        return combinations(self.ids, self.size)
+
+    def __repr__(self) -> str:
+        return f"TagCombinations(ids={self.ids}, size={self.size})"
+
+
+def unrank_combination(items: Sequence[int], size: int, rank: int) -> Tuple[int, ...]:
+    """
+    Obtains the combination at a given position of 'itertools.combinations',
+    without generating the preceding combinations.
+
+    Args:
+        items: Items to combine
+        size: Number of items in the combination
+        rank: Position of the combination, between 0 and C(len(items), size) - 1
+    Returns:
+        The combination, as a tuple of items
+    """
+    combination = []
+    start = 0
+    for remaining in range(size, 0, -1):
+        for position in range(start, len(items)):
+            # Number of combinations starting with the item at this position
+            count = _binomial(len(items) - position - 1, remaining - 1)
+            if rank < count:
+                combination.append(items[position])
+                start = position + 1
+                break
+            rank -= count
+    return tuple(combination)
+
+
+def permute_tags(smiles: str, max_tags: int = 4) -> List[Tuple[int, ...]]:
     """
-    Given a SMILES string determines how many tag combinations are possible.
-    Only considers combinations upto 4 tags.
+    Given a SMILES string lists the possible tag combinations. Combinations
+    contain between 1 and min(number of tags, max_tags) - 1 tags.
 
     Args:
         smiles: The SMILES string
+        max_tags: Combinations of max_tags or more tags are not considered
     Returns:
         List of tag combinations (int) or 0 if there was an issue processing the string.
     """
     # Get tagged combinations
     tagging_combos: List[Tuple[int, ...]] = []
     try:
+        metrics.increment("rdkit_parses", function="permute_tags")
         mol = Chem.MolFromSmiles(smiles)
 
-        # Get tagged atoms
-        changed_ids = get_changed_ids(mol)
-
-        if len(changed_ids) > 4:
-            max_tags = 4
-        else:
-            max_tags = len(changed_ids)
-
-        for n in range(1, max_tags):
-            for i in combinations(changed_ids, n):
-                tagging_combos.append(i)
+        for combos in get_tag_combinations_id_dict(mol, max_tags=max_tags).values():
+            tagging_combos.extend(combos)
 
         return tagging_combos
-    except Exception:
+    except Exception as e:
+        metrics.increment(
+            "failures", function="permute_tags", reason=e.__class__.__name__
+        )
         return tagging_combos
 
 
 def get_tag_combinations_id_dict(
-    mol: Chem.rdchem.Mol,
-) -> Dict[
-    int, List[Tuple[int, ...]]
-]:  # tuple can contain variable number of ints min 1
+    mol: Chem.rdchem.Mol, max_tags: int = 4
+) -> Dict[int, TagCombinations]:
     """
     From a molecule object with tagged atoms, obtain a dictionary containing
-    possible atomIdx permutations of the tagged atoms.
+    possible atomIdx permutations of the tagged atoms. The permutations are
+    generated lazily, see 'TagCombinations'.
 
     Args:
         mol: RdKit molecule object
+        max_tags: Combinations of max_tags or more tags are not considered
     Returns:
         Dictionary containing possible atomIdx permutations of the tagged atoms.
     """
@@ -126,27 +373,15 @@ def get_tag_combinations_id_dict(
     # Get tagged atoms
     changed_ids = get_changed_ids(mol)
 
-    if len(changed_ids) > 4:
-        max_tags = 4
-    else:
-        max_tags = len(changed_ids)
-
-    # Get tagged combinations
-    tagging_combos = {}
-
-    for n in range(1, max_tags):
-        combos = []
-        for i in combinations(changed_ids, n):
-            combos.append(i)
+    max_tags = min(len(changed_ids), max_tags)
 
-        tagging_combos[n] = combos
-
-    return tagging_combos
+    return {n: TagCombinations(changed_ids, n) for n in range(1, max_tags)}
 
 
 def sample_from_permutation_ids(
-    tag_combination_id_dict: Dict[int, List[Tuple[int, ...]]],
+    tag_combination_id_dict: Dict[int, TagCombinations],
     number_of_permutations: int = 1,
+    rng: Optional[random.Random] = None,
 ) -> List[Tuple[int, ...]]:
     """
     Given a dictionary containing the tag combinations, sample 'size' permutations
@@ -155,35 +390,73 @@ def sample_from_permutation_ids(
         tag_combination_id_dict: Dictionary of {num_tags: [combinations]},
                                  from 'get_tag_combinations_id_dict'
         number_of_permutations: number of permutations to return
+        rng: Random number generator, defaults to the global one of 'random'
     Returns:
         List of Tuples of atomIdxs to permute for the given sample
     """
+    sample = random.sample if rng is None else rng.sample
     permutation_ids = []
 
     if len(tag_combination_id_dict) != 0:
         for max_tag, id_list in tag_combination_id_dict.items():
-            permutation = random.sample(id_list, number_of_permutations)
+            permutation = sample(id_list, number_of_permutations)
             permutation_ids.append(permutation)
 
     return list(chain(*permutation_ids))
 
 
-def return_tag_combinations(smiles: str) -> int:
+def return_tag_combinations(smiles: str, max_tags: int = 4) -> int:
     """
-    Given a SMILES string determines how many tag combinations are possible.
-    Only considers combinations upto 4 tags.
+    Given a SMILES string determines how many tag combinations are possible,
+    see 'count_tag_combinations'.
 
     Args:
         smiles: The SMILES string
+        max_tags: Combinations of max_tags or more tags are not considered
     Returns:
         Number of tag combinations (int) or 0 if there was an issue processing the
         string.
     """
-    tagging_combos = permute_tags(smiles)
-    if isinstance(tagging_combos, list):
-        return len(tagging_combos)
-    else:
+    try:
+        metrics.increment("rdkit_parses", function="return_tag_combinations")
+        mol = Chem.MolFromSmiles(smiles)
+        return count_tag_combinations(len(get_changed_ids(mol)), max_tags=max_tags)
+    except Exception as e:
+        metrics.increment(
+            "failures", function="return_tag_combinations", reason=e.__class__.__name__
+        )
+        return 0
+
+
+def count_tag_combinations(num_tags: int, max_tags: int = 4) -> int:
+    """
+    Given a number of tags determines how many tag combinations are possible,
+    without building the combinations. Combinations contain between 1 and
+    min(num_tags, max_tags) - 1 tags.
+
+    Unlike 'return_tag_combinations', the tagged SMILES is not re-parsed, so no
+    sanitization check is applied.
+
+    Args:
+        num_tags: Number of tagged atoms
+        max_tags: Combinations of max_tags or more tags are not considered
+    Returns:
+        Number of tag combinations (int)
+    """
+    max_tags = min(num_tags, max_tags)
+
+    return sum(_binomial(num_tags, n) for n in range(1, max_tags))
+
+
+def _binomial(n: int, k: int) -> int:
+    """Binomial coefficient, 'math.comb' is not available in python 3.7."""
+    if k < 0 or k > n:
         return 0
+    k = min(k, n - k)
+    result = 1
+    for i in range(1, k + 1):
+        result = result * (n - k + i) // i
+    return result
 
 
 def permute_tagged_mol(
@@ -202,31 +475,201 @@ def permute_tagged_mol(
     permuted_tagged_smiles = []
     for ids in permutation_ids:
         for atom in mol.GetAtoms():
-            if atom.GetIdx() in ids:
-                atom.SetAtomMapNum(1)
-            else:
-                atom.SetAtomMapNum(0)
+            atom.SetAtomMapNum(0)
+        for idx in ids:
+            mol.GetAtomWithIdx(idx).SetAtomMapNum(1)
 
         permuted_tagged_smiles.append(Chem.MolToSmiles(mol))
 
     return permuted_tagged_smiles
 
 
-def permute_tagged_smiles(smiles: str, number_of_permutations: int = 1) -> List[str]:
+def permute_tagged_smiles(
+    smiles: str,
+    number_of_permutations: int = 1,
+    max_tags: int = 4,
+    rng: Optional[random.Random] = None,
+) -> List[str]:
     """
     Permute the atom tags of a tagged molecule
 
     Args:
         smiles: Tagged SMILES string
         number_of_permutations: number of permutations to obtain
+        max_tags: Combinations of max_tags or more tags are not considered
+        rng: Random number generator, defaults to the global one of 'random'
     Returns:
         List of tag permuted SMILES strings
     """
+    metrics.increment("rdkit_parses", function="permute_tagged_smiles")
     mol = Chem.MolFromSmiles(smiles)
-    tag_combinations = get_tag_combinations_id_dict(mol)
+    tag_combinations = get_tag_combinations_id_dict(mol, max_tags=max_tags)
     permutation_ids = sample_from_permutation_ids(
-        tag_combinations, number_of_permutations=number_of_permutations
+        tag_combinations, number_of_permutations=number_of_permutations, rng=rng
     )
     permuted_smiles = permute_tagged_mol(mol, permutation_ids)
 
     return permuted_smiles
+
+
+@unique
+class CandidateStatus(Enum):
+    VALID = auto()
+    # Not a valid SMILES
+    INVALID_SMILES = auto()
+    # No tags, or atom map numbers other than 1
+    INVALID_TAGS = auto()
+    # The untagged molecule differs from the product
+    SKELETON_MISMATCH = auto()
+    # Same canonical tagged SMILES as a previous candidate of the product
+    DUPLICATE = auto()
+
+
+class TaggedCandidate(NamedTuple):
+    """
+    Validation result for a tagged product predicted by the AutoTag model.
+
+    Attributes:
+        candidate: The prediction, as given (possibly tokenised)
+        tagged_smiles: Canonical tagged SMILES, None if the SMILES is invalid
+        status: Whether the candidate is valid, or why it is not
+    """
+
+    candidate: str
+    tagged_smiles: Optional[str]
+    status: CandidateStatus
+
+    @property
+    def valid(self) -> bool:
+        return self.status is CandidateStatus.VALID
+
+
+class _ParsedTaggedSmiles(NamedTuple):
+    tagged_smiles: Optional[str]
+    skeleton: Optional[str]
+    valid_tags: bool
+
+
+class TaggedSmilesCache:
+    """
+    Bounded LRU cache of the canonical forms (with and without tags) of tagged
+    SMILES. AutoTag predicts the same tagged products, often written differently,
+    many times for a given product; each distinct string is parsed only once.
+    """
+
+    def __init__(self, max_size: int = 100000):
+        """
+        Args:
+            max_size: Maximal number of SMILES kept in the cache
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._parsed: OrderedDict[str, _ParsedTaggedSmiles] = OrderedDict()
+
+    def parse(self, smiles: str) -> _ParsedTaggedSmiles:
+        try:
+            parsed = self._parsed[smiles]
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._parsed.move_to_end(smiles)
+            return parsed
+
+        parsed = _parse_tagged_smiles(smiles)
+        self._parsed[smiles] = parsed
+        if len(self._parsed) > self.max_size:
+            self._parsed.popitem(last=False)
+        return parsed
+
+    def __len__(self) -> int:
+        return len(self._parsed)
+
+
+def _parse_tagged_smiles(smiles: str) -> _ParsedTaggedSmiles:
+    metrics.increment("rdkit_parses", function="validate_tagged_candidates")
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        return _ParsedTaggedSmiles(None, None, False)
+
+    tagged_smiles = Chem.MolToSmiles(mol)
+    tags = [atom.GetAtomMapNum() for atom in mol.GetAtoms()]
+    for atom in mol.GetAtoms():
+        atom.SetAtomMapNum(0)
+    skeleton = Chem.MolToSmiles(mol)
+    return _ParsedTaggedSmiles(tagged_smiles, skeleton, set(tags) - {0} == {1})
+
+
+# Cache used by default in the current process
+tagged_smiles_cache = TaggedSmilesCache()
+
+
+def validate_tagged_candidates(
+    product: str,
+    candidates: Sequence[str],
+    cache: Optional[TaggedSmilesCache] = None,
+) -> List[TaggedCandidate]:
+    """
+    Detokenises, validates and canonicalises (keeping the tags) the tagged
+    products predicted by the AutoTag model for a product. Valid candidates are
+    tagged ([<atom>:1] only) versions of the product; the duplicates of a previous
+    candidate are flagged as such.
+
+    Args:
+        product: The product SMILES given to AutoTag, possibly tokenised
+        candidates: The predictions for the product, possibly tokenised
+        cache: Cache of parsed SMILES, the module-level 'tagged_smiles_cache' if
+               None
+    Returns:
+        One result per candidate, in the same order
+    """
+    if cache is None:
+        cache = tagged_smiles_cache
+
+    product_skeleton = cache.parse(detokenize_smiles(product)).skeleton
+    seen: Set[str] = set()
+    results = []
+    for candidate in candidates:
+        parsed = cache.parse(detokenize_smiles(candidate))
+        if parsed.tagged_smiles is None:
+            status = CandidateStatus.INVALID_SMILES
+        elif not parsed.valid_tags:
+            status = CandidateStatus.INVALID_TAGS
+        elif parsed.skeleton != product_skeleton:
+            status = CandidateStatus.SKELETON_MISMATCH
+        elif parsed.tagged_smiles in seen:
+            status = CandidateStatus.DUPLICATE
+        else:
+            status = CandidateStatus.VALID
+            seen.add(parsed.tagged_smiles)
+        metrics.increment("tagged_candidates", status=status.name.lower())
+        results.append(TaggedCandidate(candidate, parsed.tagged_smiles, status))
+    return results
+
+
+def validate_tagged_candidate_batch(
+    products: Sequence[str],
+    candidates: Sequence[Sequence[str]],
+    cache: Optional[TaggedSmilesCache] = None,
+) -> List[List[TaggedCandidate]]:
+    """
+    Batch version of 'validate_tagged_candidates', e.g. for the n-best predictions
+    of AutoTag for a batch of products.
+
+    Args:
+        products: The product SMILES given to AutoTag, possibly tokenised
+        candidates: The predictions for each product, possibly tokenised
+        cache: Cache of parsed SMILES, the module-level 'tagged_smiles_cache' if
+               None
+    Returns:
+        The results for the candidates of each product
+    """
+    if len(products) != len(candidates):
+        raise ValueError(
+            f"Got candidates for {len(candidates)} products instead of {len(products)}."
+        )
+    return [
+        validate_tagged_candidates(product, product_candidates, cache=cache)
+        for product, product_candidates in zip(products, candidates)
+    ]
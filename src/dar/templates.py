@@ -0,0 +1,333 @@
+"""
+Extraction of retrosynthetic reaction templates from atom-mapped reactions, and
+counting of the distinct templates of a dataset.
+
+A template is built around the reaction centre of 'dar.chem', i.e. the atoms
+tagged by 'get_tagged_products', extended by the mapped atoms within a given
+radius and, on the precursor side, by the unmapped leaving groups:
+
+    [C:1]-[NH:2]>>[Cl]-[C:1].[NH2:2]
+
+The atom maps of a template are renumbered in the canonical order of its product
+side, so that the templates of different reactions are identical strings when
+they describe the same transformation.
+
+The extractor of rdchiral (an install requirement) is not used, because:
+- its reaction centre is defined by comparing atom SMARTS, so it includes atoms
+  that only change charge, hydrogen count or chirality, and adds special groups.
+  The templates here are centred on exactly the atoms that the tagging step
+  tags, so that they match the disconnection tags the models are trained on;
+- it parses the reaction SMILES again, while the templates here are extracted
+  from the molecules already parsed for tagging (see 'tag_reaction'). On a
+  sample of mapped reactions, it was about 8 times slower.
+The templates do not encode stereochemistry; they are meant for counting the
+distinct transformations of a dataset, and apply back to their example
+reactions (with RDKit) up to stereochemistry.
+"""
+
+import os
+from functools import partial
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set
+
+import pandas as pd
+from rdkit import Chem
+
+from dar import metrics
+from dar.chem import ReactionCentre, get_mol_bond_array
+from dar.dedup import reaction_hash
+from dar.io import TableWriter, iter_table_chunks
+from dar.parallel import imap_ordered
+
+TEMPLATE_COLUMNS = ["template_hash", "retro_template", "count", "example_rxn"]
+
+
+class TemplateResult(NamedTuple):
+    """
+    Outcome of the template extraction for one reaction, see 'extract_templates'.
+
+    Attributes:
+        reaction: The input reaction SMILES
+        template: The retro template, or None if the extraction failed
+        error: Description of the error, if the extraction failed
+    """
+
+    reaction: str
+    template: Optional[str]
+    error: Optional[str] = None
+
+    @property
+    def success(self) -> bool:
+        return self.template is not None
+
+
+def extract_template(
+    precursor_smiles: str, product_smiles: str, radius: int = 1
+) -> str:
+    """
+    Extracts the retro template ('products>>precursors') of an atom-mapped
+    reaction. Each side of the reaction is parsed exactly once.
+
+    Args:
+        precursor_smiles: Atom-mapped SMILES string for the precursor(s)
+        product_smiles: Atom-mapped SMILES string for the product(s)
+        radius: Number of bonds around the changed atoms included in the template
+
+    Returns:
+        The retro template, with canonical atom maps
+    """
+    metrics.increment("rdkit_parses", 2, function="extract_template")
+    precursors_mol = Chem.MolFromSmiles(precursor_smiles, sanitize=False)
+    products_mol = Chem.MolFromSmiles(product_smiles, sanitize=False)
+    if precursors_mol is None:
+        raise ValueError(f"Invalid precursor SMILES: {precursor_smiles}")
+    if products_mol is None:
+        raise ValueError(f"Invalid product SMILES: {product_smiles}")
+
+    centre = ReactionCentre.from_bond_arrays(
+        get_mol_bond_array(precursors_mol), get_mol_bond_array(products_mol)
+    )
+    return get_mol_template(
+        precursors_mol, products_mol, set(centre.changed_atoms.tolist()), radius
+    )
+
+
+def get_mol_template(
+    precursors_mol: Chem.rdchem.Mol,
+    products_mol: Chem.rdchem.Mol,
+    changed_atoms: Set[int],
+    radius: int = 1,
+) -> str:
+    """
+    Extracts the retro template of a reaction from its parsed sides, e.g. the
+    molecules already parsed for tagging, see 'tag_reaction'. The atom maps of
+    the molecules are modified.
+
+    Args:
+        precursors_mol: Atom-mapped precursor(s), parsed without sanitization
+        products_mol: Atom-mapped product(s), parsed without sanitization
+        changed_atoms: Atom maps of the reaction centre, see 'compare_bond_arrays'
+        radius: Number of bonds around the changed atoms included in the template
+
+    Returns:
+        The retro template, with canonical atom maps
+    """
+    if len(changed_atoms) == 0:
+        raise ValueError("No reaction centre: the reaction does not change any bond")
+    # Hydrogen counts of the unmapped atoms, written out explicitly
+    precursors_mol.UpdatePropertyCache(strict=False)
+    products_mol.UpdatePropertyCache(strict=False)
+
+    template_maps = set(changed_atoms)
+    for _ in range(radius):
+        template_maps |= _get_neighbour_maps(
+            products_mol, template_maps
+        ) | _get_neighbour_maps(precursors_mol, template_maps)
+
+    product_atoms = [
+        atom.GetIdx()
+        for atom in products_mol.GetAtoms()
+        if atom.GetAtomMapNum() in template_maps
+    ]
+    precursor_atoms = _get_atoms_with_leaving_groups(precursors_mol, template_maps)
+
+    new_maps = _get_canonical_maps(products_mol, product_atoms)
+    product_template = _get_fragment_smiles(products_mol, product_atoms, new_maps)
+    precursor_template = _get_fragment_smiles(precursors_mol, precursor_atoms, new_maps)
+    return f"{product_template}>>{precursor_template}"
+
+
+def _get_neighbour_maps(mol: Chem.rdchem.Mol, atom_maps: Set[int]) -> Set[int]:
+    """Atom maps of the mapped neighbours of the atoms with the given maps."""
+    neighbour_maps = {
+        neighbour.GetAtomMapNum()
+        for atom in mol.GetAtoms()
+        if atom.GetAtomMapNum() in atom_maps
+        for neighbour in atom.GetNeighbors()
+    }
+    neighbour_maps.discard(0)
+    return neighbour_maps
+
+
+def _get_atoms_with_leaving_groups(
+    mol: Chem.rdchem.Mol, atom_maps: Set[int]
+) -> List[int]:
+    """
+    Indices of the atoms with the given maps, and of the unmapped atoms connected
+    to them through unmapped atoms only.
+    """
+    atoms = [
+        atom.GetIdx() for atom in mol.GetAtoms() if atom.GetAtomMapNum() in atom_maps
+    ]
+    seen = set(atoms)
+    to_visit = list(atoms)
+    while to_visit:
+        atom = mol.GetAtomWithIdx(to_visit.pop())
+        for neighbour in atom.GetNeighbors():
+            idx = neighbour.GetIdx()
+            if neighbour.GetAtomMapNum() == 0 and idx not in seen:
+                seen.add(idx)
+                atoms.append(idx)
+                to_visit.append(idx)
+    return sorted(atoms)
+
+
+def _get_canonical_maps(mol: Chem.rdchem.Mol, atoms: List[int]) -> Dict[int, int]:
+    """
+    New atom maps (1, 2, ...) of the mapped atoms of a fragment, following the
+    canonical order of the fragment without atom maps.
+    """
+    old_maps = [atom.GetAtomMapNum() for atom in mol.GetAtoms()]
+    for atom in mol.GetAtoms():
+        atom.SetAtomMapNum(0)
+    Chem.MolFragmentToSmiles(mol, atoms, canonical=True, allHsExplicit=True)
+    output_order = list(mol.GetPropsAsDict(True, True)["_smilesAtomOutputOrder"])
+    for atom, old_map in zip(mol.GetAtoms(), old_maps):
+        atom.SetAtomMapNum(old_map)
+
+    new_maps: Dict[int, int] = {}
+    for idx in output_order:
+        if old_maps[idx] != 0:
+            new_maps[old_maps[idx]] = len(new_maps) + 1
+    return new_maps
+
+
+def _get_fragment_smiles(
+    mol: Chem.rdchem.Mol, atoms: List[int], new_maps: Dict[int, int]
+) -> str:
+    """Canonical SMILES of a fragment, with the atom maps replaced by new_maps."""
+    for atom in mol.GetAtoms():
+        atom.SetAtomMapNum(new_maps.get(atom.GetAtomMapNum(), 0))
+    return Chem.MolFragmentToSmiles(
+        mol, atoms, canonical=True, allHsExplicit=True, allBondsExplicit=True
+    )
+
+
+def extract_templates(
+    reactions: Iterable[str],
+    radius: int = 1,
+    n_workers: int = 1,
+    chunksize: int = 64,
+) -> Iterator[TemplateResult]:
+    """
+    Extracts the templates of many atom-mapped reactions, optionally in parallel.
+    Failures do not raise but are reported in the corresponding result.
+
+    Args:
+        reactions: Atom-mapped reaction SMILES, e.g. the 'mapped_rxn' column
+        radius: Number of bonds around the changed atoms included in the templates
+        n_workers: Number of worker processes, 1 to extract in the current process
+        chunksize: Number of reactions sent to a worker at once
+    Returns:
+        Iterator over TemplateResult, in the same order as the input reactions
+    """
+    return imap_ordered(
+        partial(_extract_template_with_error_handling, radius=radius),
+        reactions,
+        n_workers=n_workers,
+        chunksize=chunksize,
+    )
+
+
+def _extract_template_with_error_handling(reaction: str, radius: int) -> TemplateResult:
+    try:
+        precursor_smiles, product_smiles = reaction.split(">>")
+        return TemplateResult(
+            reaction, extract_template(precursor_smiles, product_smiles, radius)
+        )
+    except Exception as e:
+        metrics.increment(
+            "failures", function="extract_template", reason=e.__class__.__name__
+        )
+        return TemplateResult(reaction, None, f"{e.__class__.__name__}: {e}")
+
+
+class TemplateTable:
+    """
+    Counts the distinct templates of a dataset, keeping only their hashes and
+    counts in memory. New templates are appended to a temporary file as they are
+    found, with the first reaction they were extracted from; 'close' writes the
+    table with the columns 'template_hash', 'retro_template', 'count' and
+    'example_rxn', in the order in which the templates were found.
+
+        with TemplateTable("data/uspto.templates.csv") as table:
+            for result in extract_templates(reactions, n_workers=8):
+                if result.success:
+                    table.add(result.template, result.reaction)
+    """
+
+    def __init__(self, path: str, buffer_size: int = 10000):
+        """
+        Args:
+            path: Output CSV, Parquet or Arrow file
+            buffer_size: Number of new templates written to the temporary file at
+                         once
+        """
+        self.path = path
+        self.buffer_size = buffer_size
+        directory, name = os.path.split(path)
+        self._tmp_path = os.path.join(directory, f".{name}")
+        self._writer = TableWriter(self._tmp_path)
+        # Insertion order is the order of the rows in the temporary file
+        self._counts: Dict[str, int] = {}
+        self._buffer: List[Dict[str, str]] = []
+
+    def add(self, template: str, example: str, count: int = 1) -> str:
+        """
+        Counts a template.
+
+        Args:
+            template: Retro template, see 'extract_template'
+            example: Reaction the template was extracted from, kept if the
+                     template is new
+            count: Number of reactions with this template
+
+        Returns:
+            Hash of the template
+        """
+        template_hash = reaction_hash(template, canonical=False)
+        if template_hash in self._counts:
+            self._counts[template_hash] += count
+            return template_hash
+
+        self._counts[template_hash] = count
+        self._buffer.append({"retro_template": template, "example_rxn": example})
+        if len(self._buffer) >= self.buffer_size:
+            self._flush()
+        return template_hash
+
+    def _flush(self) -> None:
+        if self._buffer:
+            self._writer.write(pd.DataFrame(self._buffer))
+            self._buffer = []
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def close(self, chunk_size: int = 100000) -> None:
+        """
+        Writes the final table, and removes the temporary file.
+
+        Args:
+            chunk_size: Number of templates copied from the temporary file at once
+        """
+        self._flush()
+        self._writer.close()
+        hashes = list(self._counts)
+        with TableWriter(self.path) as writer:
+            if not hashes:
+                writer.write(pd.DataFrame(columns=TEMPLATE_COLUMNS))
+                return
+            start = 0
+            for chunk in iter_table_chunks(self._tmp_path, chunk_size):
+                chunk_hashes = hashes[start : start + len(chunk)]
+                chunk["template_hash"] = chunk_hashes
+                chunk["count"] = [self._counts[h] for h in chunk_hashes]
+                writer.write(chunk[TEMPLATE_COLUMNS])
+                start += len(chunk)
+        os.remove(self._tmp_path)
+
+    def __enter__(self) -> "TemplateTable":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -1,10 +1,20 @@
-from typing import Tuple
+import logging
+from functools import partial
+from typing import Iterable, Iterator, Optional, Tuple
 
+from rxn.chemutils.tokenization import tokenize_smiles
 from rxn_biocatalysis_tools import (
     detokenize_enzymatic_reaction_smiles,
     tokenize_enzymatic_reaction_smiles,
 )
 
+from dar import metrics
+from dar.io import iter_table_chunks
+from dar.parallel import imap_ordered
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
 
 def tokenize_and_split_enzymatic_reaction_smiles(rxn: str) -> Tuple[str, str]:
     """
@@ -34,9 +44,120 @@ def detokenize_and_split_enzymatic_reaction_smiles(rxn: str) -> Tuple[str, str,
     reactants, products = [
         x.strip() for x in detokenize_enzymatic_reaction_smiles(rxn).split(">>")
     ]
-    print(reactants, flush=True)
     if "|" in reactants:
         reactants, ec = [x.strip() for x in reactants.split("|")]
     else:
         ec = None
     return reactants, ec, products
+
+
+def tokenize_and_split_reaction_smiles(
+    rxn: str, enzymatic: bool = False
+) -> Tuple[str, str]:
+    """
+    Given a reaction SMILES, e.g. a tagged reaction, tokenises and splits it into
+    reactants and products
+
+    Args:
+        rxn: Reaction SMILES
+        enzymatic: Whether the reaction contains an EC number ('reactants|EC>>
+                   products'), tokenised with the reactants
+    Returns:
+        Tuple of reactants, products
+    """
+    if enzymatic:
+        return tokenize_and_split_enzymatic_reaction_smiles(rxn)
+    reactants, products = rxn.split(">>")
+    return tokenize_smiles(reactants), tokenize_smiles(products)
+
+
+def _tokenize_with_error_handling(
+    rxn: str, enzymatic: bool
+) -> Tuple[str, Optional[Tuple[str, str]]]:
+    try:
+        return rxn, tokenize_and_split_reaction_smiles(rxn, enzymatic=enzymatic)
+    except Exception as e:
+        metrics.increment("failures", function="tokenize", reason=e.__class__.__name__)
+        return rxn, None
+
+
+def tokenize_reactions(
+    reactions: Iterable[str],
+    enzymatic: bool = False,
+    n_workers: int = 1,
+    chunksize: int = 1000,
+) -> Iterator[Tuple[str, Optional[Tuple[str, str]]]]:
+    """
+    Tokenises reactions lazily, optionally in parallel, see
+    'tokenize_and_split_reaction_smiles'.
+
+    Args:
+        reactions: Reaction SMILES
+        enzymatic: Whether the reactions contain EC numbers
+        n_workers: Number of worker processes
+        chunksize: Number of reactions sent to a worker at once
+    Returns:
+        Iterator over the reactions and their tokenised reactants and products
+        (None if the reaction could not be tokenised), in the input order
+    """
+    return imap_ordered(
+        partial(_tokenize_with_error_handling, enzymatic=enzymatic),
+        reactions,
+        n_workers=n_workers,
+        chunksize=chunksize,
+    )
+
+
+def write_token_files(
+    file_path: str,
+    output_prefix: str,
+    reaction_column: str = "tagged_rxn",
+    enzymatic: bool = False,
+    n_workers: int = 1,
+    chunk_size: int = 100000,
+) -> int:
+    """
+    Streams a tagged (filtered) dataset and writes the tokenised products and
+    precursors to the source and target files expected by 'onmt_preprocess', in
+    the order of the dataset. Reactions that cannot be tokenised are skipped.
+
+    Args:
+        file_path: CSV, Parquet or Arrow file containing the reactions
+        output_prefix: Prefix of the output files, '.products_tokens' and
+                       '.precursors_tokens' are appended to it
+        reaction_column: Column containing the reactions
+        enzymatic: Whether the reactions contain EC numbers, which are then
+                   tokenised with the precursors
+        n_workers: Number of worker processes
+        chunk_size: Number of rows read from the input file at once
+    Returns:
+        Number of (source, target) pairs written
+    """
+
+    def reactions() -> Iterator[str]:
+        for chunk in iter_table_chunks(
+            file_path, chunk_size, columns=[reaction_column]
+        ):
+            yield from chunk[reaction_column]
+
+    num_pairs = 0
+    num_failed = 0
+    with open(f"{output_prefix}.products_tokens", "w") as src, open(
+        f"{output_prefix}.precursors_tokens", "w"
+    ) as tgt:
+        for rxn, tokens in tokenize_reactions(
+            reactions(), enzymatic=enzymatic, n_workers=n_workers
+        ):
+            if tokens is None:
+                num_failed += 1
+                logger.info(f"Could not tokenise {rxn}")
+                continue
+            precursors_tokens, products_tokens = tokens
+            src.write(products_tokens + "\n")
+            tgt.write(precursors_tokens + "\n")
+            num_pairs += 1
+
+    if num_failed:
+        logger.warning(f"Could not tokenise {num_failed} reactions.")
+
+    return num_pairs
@@ -0,0 +1,237 @@
+import os
+import sqlite3
+import tempfile
+import time
+from typing import Dict, List, cast
+
+from rxnmapper import RXNMapper
+
+import dar.aam
+from dar.aam import (
+    MapperPool,
+    MappingCache,
+    MappingResult,
+    MappingStatistics,
+    count_reaction_tokens,
+    map_reactions_in_token_batches,
+    map_reactions_with_cache,
+    map_reactions_with_error_handling,
+)
+
+
+class FakeMapper:
+    """Mapper failing on any batch containing a reaction with "bad" in it."""
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.batches: List[List[str]] = []
+
+    def get_attention_guided_atom_maps(
+        self, reactions: List[str], canonicalize_rxns: bool = True
+    ) -> List[Dict]:
+        self.calls += 1
+        self.batches.append(reactions)
+        if any("bad" in reaction for reaction in reactions):
+            raise ValueError("Too many tokens")
+        return [
+            {"mapped_rxn": f"mapped {reaction}", "confidence": 0.5}
+            for reaction in reactions
+        ]
+
+
+class SlowFakeMapper(FakeMapper):
+    """FakeMapper taking longer for the first reactions of the tests."""
+
+    def get_attention_guided_atom_maps(
+        self, reactions: List[str], canonicalize_rxns: bool = True
+    ) -> List[Dict]:
+        if "CC>>C" in reactions:
+            time.sleep(0.5)
+        return super().get_attention_guided_atom_maps(reactions, canonicalize_rxns)
+
+
+def test_map_reactions_with_error_handling():
+    reactions = [f"rxn{i}" for i in range(64)]
+    reactions[37] = "bad"
+
+    fake_mapper = FakeMapper()
+    mapper = cast(RXNMapper, fake_mapper)
+    statistics = MappingStatistics()
+    mapped = map_reactions_with_error_handling(mapper, reactions, statistics)
+
+    assert mapped == [
+        ">>" if reaction == "bad" else f"mapped {reaction}" for reaction in reactions
+    ]
+    # One call for the full chunk, then two calls per bisection level
+    assert fake_mapper.calls == 1 + 2 * 6
+    assert statistics == MappingStatistics(
+        batch_calls=13, failed_batch_calls=7, failed_reactions=1
+    )
+
+
+def test_map_reactions_with_error_handling_without_errors():
+    fake_mapper = FakeMapper()
+    mapper = cast(RXNMapper, fake_mapper)
+    reactions = ["rxn1", "rxn2", "rxn3"]
+
+    assert map_reactions_with_error_handling(mapper, reactions) == [
+        "mapped rxn1",
+        "mapped rxn2",
+        "mapped rxn3",
+    ]
+    assert fake_mapper.calls == 1
+    assert map_reactions_with_error_handling(mapper, []) == []
+
+
+def test_count_reaction_tokens():
+    assert count_reaction_tokens("CC(C)(C)O[Cl:18].CCO>>[Na+].c1ccccc1%10") == 28
+
+
+def test_map_reactions_in_token_batches():
+    reactions = ["C" * 50 + ">>C", "CC>>C", "C" * 600 + ">>C", "CCC>>C", "bad>>C"]
+
+    fake_mapper = FakeMapper()
+    statistics = MappingStatistics()
+    mapped = map_reactions_in_token_batches(
+        cast(RXNMapper, fake_mapper),
+        reactions,
+        token_budget=60,
+        max_batch_size=2,
+        statistics=statistics,
+    )
+
+    assert mapped == [
+        "mapped " + "C" * 50 + ">>C",
+        "mapped CC>>C",
+        ">>",
+        "mapped CCC>>C",
+        ">>",
+    ]
+    # Sorted by length, at most 2 reactions and 60 padded tokens per batch;
+    # the first batch is bisected after its failure
+    assert fake_mapper.batches == [
+        ["bad>>C", "CC>>C"],
+        ["bad>>C"],
+        ["CC>>C"],
+        ["CCC>>C"],
+        ["C" * 50 + ">>C"],
+    ]
+    assert statistics == MappingStatistics(
+        batch_calls=5, failed_batch_calls=2, failed_reactions=1, rejected_reactions=1
+    )
+
+
+def test_mapping_cache():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "cache.sqlite")
+        with MappingCache(path, max_entries=2, touch_interval=0) as cache:
+            assert cache.get_many(["CC>>C", "CCC>>C"]) == [None, None]
+
+            cache.put_many(["CC>>C", "CCC>>C"], [MappingResult("a", 0.5)] * 2)
+            cache.get_many(["CC>>C"])
+            cache.put_many(["CCCC>>C"], [MappingResult("b", 0.9)])
+
+            # The least recently used entry was evicted
+            assert len(cache) == 2
+            assert cache.get_many(["CC>>C", "CCC>>C", "CCCC>>C"]) == [
+                MappingResult("a", 0.5),
+                None,
+                MappingResult("b", 0.9),
+            ]
+            assert (cache.hits, cache.misses) == (3, 3)
+
+        # Results persist across instances, and are separated by namespace
+        with MappingCache(path) as cache:
+            assert cache.get_many(["CCCC>>C"]) == [MappingResult("b", 0.9)]
+        with MappingCache(path, namespace="other") as cache:
+            assert cache.get_many(["CCCC>>C"]) == [None]
+
+        # Entries used recently are not touched again by lookups
+        def get_last_access() -> List[float]:
+            with sqlite3.connect(path) as connection:
+                return [
+                    row[0]
+                    for row in connection.execute(
+                        "SELECT last_access FROM mappings ORDER BY key"
+                    )
+                ]
+
+        last_access = get_last_access()
+        with MappingCache(path, touch_interval=3600) as cache:
+            assert cache.get_many(["CC>>C", "CCCC>>C"]) == [
+                MappingResult("a", 0.5),
+                MappingResult("b", 0.9),
+            ]
+        assert get_last_access() == last_access
+
+
+def test_map_reactions_with_cache():
+    reactions = ["CC>>C", "bad>>C", "CCC>>C", "CC>>C"]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = MappingCache(os.path.join(tmpdir, "cache.sqlite"))
+        expected = ["mapped CC>>C", ">>", "mapped CCC>>C", "mapped CC>>C"]
+
+        fake_mapper = FakeMapper()
+        mapper = cast(RXNMapper, fake_mapper)
+        assert map_reactions_with_cache(mapper, reactions, cache) == expected
+        # Failed reactions are not cached
+        assert len(cache) == 2
+
+        fake_mapper.batches = []
+        assert map_reactions_with_cache(mapper, reactions, cache) == expected
+        assert fake_mapper.batches == [["bad>>C"]]
+        cache.close()
+
+
+def test_mapper_pool_in_process(monkeypatch):
+    monkeypatch.setattr(dar.aam, "RXNMapper", FakeMapper)
+    reactions = ["CC>>C", "bad>>C", "CCC>>C", "CCCC>>C", "C>>C"]
+
+    statistics = MappingStatistics()
+    with MapperPool(n_workers=1, chunk_size=2) as mapper_pool:
+        mapped = mapper_pool.map_reactions(reactions, statistics=statistics)
+
+    assert mapped == [
+        "mapped CC>>C",
+        ">>",
+        "mapped CCC>>C",
+        "mapped CCCC>>C",
+        "mapped C>>C",
+    ]
+    # Chunks of 2 reactions, the first one being bisected
+    assert statistics == MappingStatistics(
+        batch_calls=5, failed_batch_calls=2, failed_reactions=1
+    )
+
+
+def test_mapping_statistics_merge():
+    statistics = MappingStatistics(batch_calls=2, failed_reactions=1)
+    statistics.merge(MappingStatistics(batch_calls=3, rejected_reactions=4))
+    assert statistics == MappingStatistics(
+        batch_calls=5, failed_reactions=1, rejected_reactions=4
+    )
+
+
+def test_mapper_pool_with_workers():
+    reactions = ["CC>>C", "bad>>C", "CCC>>C", "CCCC>>C", "C>>C", "bad>>CC"]
+
+    statistics = MappingStatistics()
+    with MapperPool(
+        n_workers=2, chunk_size=1, mapper_class=SlowFakeMapper
+    ) as mapper_pool:
+        mapped = mapper_pool.map_reactions(reactions, statistics=statistics)
+
+    # Input order, although the first chunk is mapped last
+    assert mapped == [
+        "mapped CC>>C",
+        ">>",
+        "mapped CCC>>C",
+        "mapped CCCC>>C",
+        "mapped C>>C",
+        ">>",
+    ]
+    # Failures in the workers are counted in the statistics of the pool
+    assert statistics == MappingStatistics(
+        batch_calls=6, failed_batch_calls=2, failed_reactions=2
+    )
@@ -0,0 +1,79 @@
+from typing import Any
+
+from dar.augmentation import (
+    augment_tagged_reaction,
+    augment_tagged_reactions,
+    get_row_seed,
+)
+from dar.tagging import find_number_tags
+
+TAGGED_RXNS = [
+    "CC(C)C(=O)Cl.Nc1ccccc1>>CC(C)[C:1](=O)[NH:1]c1ccccc1",
+    "Nc1ccc(C(=O)O)c([N+](=O)[O-])c1.O=C(Cl)C1CCC1>>O=C(O)c1ccc([NH:1][C:1](=O)"
+    "C2CCC2)cc1[N+](=O)[O-]",
+    "CCOC(C)=O.O[c:1]1[cH:1][cH:1]cc[c:1]1>>CC[c:1]1[cH:1][c:1]([NH2:1])[cH:1][cH:1]"
+    "[c:1]1[OH:1]",
+    "not a tagged reaction",
+]
+
+
+def test_get_row_seed():
+    assert get_row_seed(42, TAGGED_RXNS[0]) == get_row_seed(42, TAGGED_RXNS[0])
+    assert get_row_seed(42, TAGGED_RXNS[0]) != get_row_seed(43, TAGGED_RXNS[0])
+    assert get_row_seed(42, TAGGED_RXNS[0]) != get_row_seed(42, TAGGED_RXNS[1])
+
+
+def test_augment_tagged_reaction():
+    result = augment_tagged_reaction(TAGGED_RXNS[0], number_of_permutations=5)
+
+    # Only 2 single-tag combinations exist for 2 tags
+    assert result.error is None
+    assert result.pairs[0] == ("CC(C)[C:1](=O)[NH:1]c1ccccc1", "CC(C)C(=O)Cl.Nc1ccccc1")
+    assert sorted(product for product, _ in result.pairs[1:]) == [
+        "CC(C)C(=O)[NH:1]c1ccccc1",
+        "CC(C)[C:1](=O)Nc1ccccc1",
+    ]
+
+    result = augment_tagged_reaction(TAGGED_RXNS[2], number_of_permutations=2)
+    assert [find_number_tags(product) for product, _ in result.pairs] == [
+        8,
+        1,
+        1,
+        2,
+        2,
+        3,
+        3,
+    ]
+
+    result = augment_tagged_reaction(TAGGED_RXNS[3], tokenize=True)
+    assert result.pairs == []
+    assert result.error is not None
+
+    # Empty CSV cell
+    nan: Any = float("nan")
+    result = augment_tagged_reaction(nan)
+    assert result.pairs == []
+    assert result.error is not None
+
+
+def test_augment_tagged_reactions():
+    results = [
+        list(
+            augment_tagged_reactions(
+                TAGGED_RXNS * 3,
+                number_of_permutations=2,
+                seed=7,
+                n_workers=n_workers,
+                chunksize=2,
+                tokenize=True,
+            )
+        )
+        for n_workers in [1, 3]
+    ]
+
+    assert results[0] == results[1]
+    assert [result.tagged_rxn for result in results[0]] == TAGGED_RXNS * 3
+    assert results[0][0].pairs[0] == (
+        "C C ( C ) [C:1] ( = O ) [NH:1] c 1 c c c c c 1",
+        "C C ( C ) C ( = O ) Cl . N c 1 c c c c c 1",
+    )
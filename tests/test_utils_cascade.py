@@ -0,0 +1,136 @@
+import argparse
+import sys
+import types
+from typing import Any, Dict, List
+
+import pytest
+
+from dar.cascade import CascadePrediction, OnmtTranslator, StubTranslator, run_cascade
+
+AUTOTAG_PREDICTIONS = {
+    "C C O": [
+        "C C [OH:1]",
+        "[CH3:1] C O",
+        # Invalid SMILES, duplicate, and other skeleton
+        "C C (",
+        "[OH:1] C C",
+        "C C [O:1]",
+    ],
+    "C C N": ["C C [NH2:1]", "C [CH2:1] N"],
+}
+
+
+def _autotag(source: str) -> List[str]:
+    return AUTOTAG_PREDICTIONS[source]
+
+
+def _disconnection(source: str) -> List[str]:
+    return [source + " . O", source]
+
+
+def test_run_cascade():
+    autotag = StubTranslator(_autotag)
+    disconnection = StubTranslator(_disconnection)
+
+    results = list(
+        run_cascade(
+            ["CCO", "CCN", "CCO"],
+            autotag,
+            disconnection,
+            n_best=5,
+            disconnection_n_best=2,
+            batch_size=2,
+        )
+    )
+
+    assert [result.product for result in results] == ["CCO", "CCN", "CCO"]
+    assert [result.num_candidates for result in results] == [5, 2, 5]
+    assert results[0].predictions == [
+        CascadePrediction("CC[OH:1]", ["CC[OH:1].O", "CC[OH:1]"]),
+        CascadePrediction("OC[CH3:1]", ["OC[CH3:1].O", "OC[CH3:1]"]),
+    ]
+    assert [p.tagged_product for p in results[1].predictions] == [
+        "CC[NH2:1]",
+        "C[CH2:1]N",
+    ]
+    assert results[2] == results[0]
+    assert autotag.batch_sizes == [2, 1]
+    # Micro-batches of at most batch_size tagged products, per batch of products
+    assert disconnection.batch_sizes == [2, 2, 2]
+
+
+def test_run_cascade_n_best():
+    autotag = StubTranslator(_autotag)
+    disconnection = StubTranslator(_disconnection)
+
+    (result,) = run_cascade(["CCO"], autotag, disconnection, n_best=1)
+
+    assert result.num_candidates == 1
+    assert result.predictions == [CascadePrediction("CC[OH:1]", ["CC[OH:1].O"])]
+
+
+class FakeOnmtTranslator:
+    """Returns beam_size predictions per source, as OpenNMT's translator."""
+
+    def __init__(self, opt: argparse.Namespace):
+        self.opt = opt
+        self.calls: List[Dict[str, Any]] = []
+
+    def translate(self, src: List[str], batch_size: int):
+        self.calls.append({"src": src, "batch_size": batch_size})
+        predictions = [
+            [f"{source} {i} " for i in range(self.opt.n_best)] for source in src
+        ]
+        return [[0.0] * self.opt.n_best for _ in src], predictions
+
+
+class FakeArgumentParser(argparse.ArgumentParser):
+    """Parser of the OpenNMT options given by OnmtTranslator."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        for option in ["-model", "-src", "-gpu"]:
+            self.add_argument(option)
+        for option in ["-beam_size", "-n_best", "-max_length", "-batch_size"]:
+            self.add_argument(option, type=int)
+        self.add_argument("-replace_unk", action="store_true")
+
+    @staticmethod
+    def validate_translate_opts(opt: argparse.Namespace) -> None:
+        pass
+
+
+@pytest.fixture
+def fake_onmt(monkeypatch):
+    """OpenNMT modules imported by OnmtTranslator."""
+    modules = {
+        "onmt": types.ModuleType("onmt"),
+        "onmt.opts": types.SimpleNamespace(
+            config_opts=lambda parser: None, translate_opts=lambda parser: None
+        ),
+        "onmt.translate": types.ModuleType("onmt.translate"),
+        "onmt.translate.translator": types.SimpleNamespace(
+            build_translator=lambda opt, report_score, out_file: FakeOnmtTranslator(opt)
+        ),
+        "onmt.utils": types.ModuleType("onmt.utils"),
+        "onmt.utils.parse": types.SimpleNamespace(ArgumentParser=FakeArgumentParser),
+    }
+    modules["onmt"].opts = modules["onmt.opts"]  # type: ignore[attr-defined]
+    for name, module in modules.items():
+        monkeypatch.setitem(sys.modules, name, module)
+
+
+def test_onmt_translator(fake_onmt):
+    with OnmtTranslator("model.pt", beam_size=3, batch_size=16) as translator:
+        assert translator.translate([]) == []
+        assert translator.translate(["C C", "C N"], n_best=2) == [
+            ["C C 0", "C C 1"],
+            ["C N 0", "C N 1"],
+        ]
+        assert translator._translator.calls == [
+            {"src": ["C C", "C N"], "batch_size": 16}
+        ]
+        assert translator._opt.n_best == 3
+        with pytest.raises(ValueError):
+            translator.translate(["C C"], n_best=4)
+    assert translator._devnull.closed
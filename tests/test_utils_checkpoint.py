@@ -0,0 +1,35 @@
+import os
+import tempfile
+
+import pytest
+
+from dar.checkpoint import ChunkCheckpoint
+
+
+def test_chunk_checkpoint_resume():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output_path = os.path.join(tmpdir, "out.csv")
+        parameters = {"chunk_size": 2}
+
+        checkpoint = ChunkCheckpoint(output_path, parameters)
+        assert not checkpoint.resuming
+        with checkpoint.open_output() as output:
+            output.write("a\n1\n2\n")
+            checkpoint.chunk_done(output)
+            # Interrupted while writing the second chunk
+            output.write("3\n")
+
+        checkpoint = ChunkCheckpoint(output_path, parameters)
+        assert checkpoint.resuming
+        assert checkpoint.completed_chunks == 1
+        with checkpoint.open_output() as output:
+            output.write("3\n4\n")
+            checkpoint.chunk_done(output)
+        checkpoint.job_done()
+
+        with open(output_path) as f:
+            assert f.read() == "a\n1\n2\n3\n4\n"
+        assert ChunkCheckpoint(output_path, parameters).finished
+
+        with pytest.raises(ValueError):
+            ChunkCheckpoint(output_path, {"chunk_size": 3})
@@ -1,10 +1,24 @@
+import os
+import tempfile
 from collections import OrderedDict
 
+import numpy as np
+from rxn.chemutils.utils import remove_atom_mapping
+
 from dar.chem import (
     AtomEnvironment,
+    FragmentCache,
+    ReactionCentre,
+    clean_mapped_component,
+    clean_mapped_components,
+    compare_bond_arrays,
+    fragment_cache,
     get_all_atom_indices,
     get_atom_list,
     get_atomic_neighbourhoods,
+    get_bond_array,
+    get_reaction_centre,
+    get_reaction_centres,
     remove_mapping,
     remove_rxn_mapping,
     remove_unmapped_components,
@@ -113,6 +127,37 @@ def test_standardise_reaction_compnent():
     )
 
 
+def test_standardise_reaction_component_with_cache():
+    cache = FragmentCache(max_size=2)
+    assert standardise_reaction_component("OCC.O.OCC", cache) == "CCO.CCO.O"
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    # Fragments connected by ring bonds are canonicalised together
+    assert standardise_reaction_component("C1.C1", cache) == "CC"
+    assert standardise_reaction_component("CCO.x", cache) == ""
+
+
+def test_fragment_cache():
+    cache = FragmentCache(max_size=2)
+    assert cache.canonicalize("OCC") == "CCO"
+    assert cache.canonicalize("C(C)O") == "CCO"
+    assert cache.canonicalize("OCC") == "CCO"
+    # Evicts the least recently used fragment
+    assert cache.canonicalize("O=C=O") == "O=C=O"
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (1, 3)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "fragments.json")
+        cache.save(path)
+
+        new_cache = FragmentCache()
+        new_cache.load(path)
+        assert new_cache.canonicalize("OCC") == "CCO"
+        assert new_cache.canonicalize("O=C=O") == "O=C=O"
+        assert (new_cache.hits, new_cache.misses) == (2, 0)
+
+
 def test_remove_unmapped_components():
     assert (
         remove_unmapped_components(
@@ -144,6 +189,61 @@ def test_remove_unmapped_components():
     )
 
 
+def test_clean_mapped_component():
+    components = [
+        "C1CCC2=NCCCN2CC1.C1CCOC1.CO.O.O[CH2:2][c:3]1[cH:4][c:5]([Cl:6])[cH:7]"
+        "[cH:8][c:9]1[CH:10]1[CH2:11][CH2:12][N:13]1[C:14](=[O:15])[O:16][CH2:17]"
+        "[C:18]([Cl:19])([Cl:20])[Cl:21].[N-]=[N+]=[N:1]P(=O)(c1ccccc1)c1ccccc1."
+        "[Na+].[OH-].c1ccc(P(c2ccccc2)c2ccccc2)cc1",
+        "CO.O=C(OCc1ccccc1)[NH:9][C@@H:7]([C:5]([NH:4][CH:2]([CH3:1])[CH3:3])="
+        "[O:6])[CH3:8].[H][H].[Pd]",
+        "[H:3]Cl.[CH3:1][OH:2]",
+        "[CH3:1][C@H](O)[CH3:2].[*:4]C",
+        "c1cccc1.[CH3:1]O",
+        "",
+    ]
+    for component in components:
+        for remove_unmapped in [True, False]:
+            expected = component
+            if remove_unmapped:
+                expected = remove_unmapped_components(expected)
+            expected = standardise_reaction_component(remove_atom_mapping(expected))
+            assert clean_mapped_component(component, remove_unmapped) == expected
+
+    assert (
+        clean_mapped_component(components[1]) == "CC(C)NC(=O)[C@@H](C)NC(=O)OCc1ccccc1"
+    )
+
+
+def test_clean_mapped_components():
+    components = [
+        "CO.O[CH2:2][c:3]1[cH:4][cH:5][cH:6][cH:7][cH:8]1.[Na+].[OH-]",
+        "CO.O=C(OCc1ccccc1)[NH:9][C@@H:7]([CH3:8])[C:5](=[O:6])[OH:4].[Pd]",
+        "[CH3:1][C@H](O)[CH3:2].[*:4]C",
+        "c1cccc1.[CH3:1]O",
+        "",
+    ] * 3
+
+    for remove_unmapped in [True, False]:
+        expected = [
+            clean_mapped_component(component, remove_unmapped)
+            for component in components
+        ]
+        fragment_cache.clear()
+        cleaned = list(
+            clean_mapped_components(
+                components, remove_unmapped, n_workers=2, chunksize=2
+            )
+        )
+        assert cleaned == expected
+        # The fragments canonicalised by the workers end up in the parent cache
+        assert len(fragment_cache) > 0
+        assert fragment_cache.misses >= len(fragment_cache)
+        assert fragment_cache.canonicalize("OC") == "CO"
+        assert fragment_cache.hits > 0
+    fragment_cache.clear()
+
+
 def test_get_atomic_neighbourhoods():
     example_1 = (
         "C1CCOC1.CO.COC(C)(C)C.Cl[Ni]Cl.[BH4-].[CH3:1][O:2][C:3](=[O:4])[CH:5]"
@@ -422,3 +522,90 @@ def test_get_atom_list():
         )
         == 0
     )
+
+
+def test_get_bond_array():
+    bond_array = get_bond_array("CC(C)(C)[S@@](=O)[NH:1][C@H:2]1[CH2:3][CH2:4]1.Cl")
+
+    assert bond_array.tolist() == [
+        [0, 1, 1],
+        [1, 2, 1],
+        [2, 3, 1],
+        [3, 4, 1],
+        [2, 4, 1],
+    ]
+
+    # Each row corresponds to an entry of 'get_atomic_neighbourhoods' for every
+    # mapped atom of the bond
+    smiles = (
+        "C1COCCO1.CC(C)(C)[S@@](=O)[NH:1][C@H:2]1[CH2:3][CH2:4][CH2:5][N:6]"
+        "([C:7](=[O:8])[O:9][CH2:10][c:11]2[cH:12][cH:13][cH:14][cH:15][cH:16]2)"
+        "[CH2:17][CH2:18]1.CO.Cl"
+    )
+    bond_types = {1: "SINGLE", 2: "DOUBLE", 12: "AROMATIC"}
+    neighbourhood_bonds = sorted(
+        bond for bonds in get_atomic_neighbourhoods(smiles).values() for bond in bonds
+    )
+    array_bonds = sorted(
+        f"{lo}_{hi}_{bond_types[code]}"
+        for lo, hi, code in get_bond_array(smiles).tolist()
+        for _ in range(1 if lo == 0 else 2)
+    )
+    assert array_bonds == neighbourhood_bonds
+
+
+def test_compare_bond_arrays():
+    precursor_bonds = np.array([[0, 5, 1], [0, 5, 1], [5, 6, 1], [6, 7, 2]])
+    product_bonds = np.array([[0, 5, 1], [5, 6, 1], [6, 7, 1]])
+
+    # Atom 5 lost one of its two bonds to unmapped atoms, and the bond 6-7
+    # changed order
+    assert compare_bond_arrays(
+        precursor_bonds, product_bonds, AtomEnvironment.CHANGED
+    ).tolist() == [5, 6, 7]
+    assert (
+        compare_bond_arrays(
+            precursor_bonds, product_bonds, AtomEnvironment.SAME
+        ).tolist()
+        == []
+    )
+    assert compare_bond_arrays(
+        precursor_bonds[1:], product_bonds, AtomEnvironment.SAME
+    ).tolist() == [5]
+
+
+def test_reaction_centre_from_bond_arrays():
+    precursor_bonds = np.array([[0, 5, 1], [0, 5, 1], [5, 6, 1], [6, 7, 2]])
+    product_bonds = np.array([[0, 5, 1], [5, 6, 1], [6, 7, 1], [7, 8, 1]])
+
+    centre = ReactionCentre.from_bond_arrays(precursor_bonds, product_bonds)
+    assert centre.broken_bonds.tolist() == [[0, 5, 1]]
+    assert centre.formed_bonds.tolist() == [[7, 8, 1]]
+    assert centre.order_changed_bonds.tolist() == [[6, 7, 2, 1]]
+    assert centre.changed_atoms.tolist() == [5, 6, 7, 8]
+    assert centre.unchanged_atoms.tolist() == []
+    for atom_environment in AtomEnvironment:
+        assert (
+            centre.get_atoms(atom_environment).tolist()
+            == compare_bond_arrays(
+                precursor_bonds, product_bonds, atom_environment
+            ).tolist()
+        )
+
+
+def test_get_reaction_centre():
+    rxn = (
+        "[CH3:1][C:2](=[O:3])[OH:4].[CH3:5][CH2:6][OH:7]"
+        ">>[CH3:1][C:2](=[O:3])[O:7][CH2:6][CH3:5]"
+    )
+    centre = get_reaction_centre(*rxn.split(">>"))
+    assert centre.broken_bonds.tolist() == [[2, 4, 1]]
+    assert centre.formed_bonds.tolist() == [[2, 7, 1]]
+    assert centre.order_changed_bonds.shape == (0, 4)
+    assert centre.changed_atoms.tolist() == [2, 4, 7]
+    assert centre.unchanged_atoms.tolist() == [1, 3, 5, 6]
+
+    centres = list(get_reaction_centres([rxn, "not a reaction"], n_workers=2))
+    assert [
+        None if centre is None else centre.changed_atoms.tolist() for centre in centres
+    ] == [[2, 4, 7], None]
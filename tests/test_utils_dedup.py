@@ -0,0 +1,110 @@
+import pytest
+
+from dar.dedup import (
+    DuplicateStore,
+    canonicalize_reaction,
+    deduplicate_reactions,
+    reaction_hash,
+)
+
+
+def test_canonicalize_reaction():
+    assert canonicalize_reaction("OCC.CC(=O)O>>CCOC(C)=O") == "CC(=O)O.CCO>>CCOC(C)=O"
+    assert canonicalize_reaction("CCO.CC(=O)O>O>O=C(C)OCC") == (
+        "CC(=O)O.CCO>O>CCOC(C)=O"
+    )
+    # Invalid reactions are left as they are
+    assert canonicalize_reaction("invalid>>CC") == "invalid>>CC"
+
+
+def test_reaction_hash():
+    assert reaction_hash("OCC.CC(=O)O>>CCOC(C)=O") == reaction_hash(
+        "CC(=O)O.CCO>>O=C(C)OCC"
+    )
+    assert reaction_hash("OCC.CC(=O)O>>CCOC(C)=O", canonical=False) != reaction_hash(
+        "CC(=O)O.CCO>>O=C(C)OCC", canonical=False
+    )
+
+
+def test_deduplicate_reactions():
+    reactions = [
+        "OCC.CC(=O)O>>CCOC(C)=O",
+        "CC>>CC",
+        "CC(=O)O.CCO>>O=C(C)OCC",
+        "CC>>CC",
+        "invalid",
+    ]
+
+    unique = deduplicate_reactions(reactions)
+    assert unique.reactions == ["OCC.CC(=O)O>>CCOC(C)=O", "CC>>CC", "invalid"]
+    assert unique.indices == [0, 1, 4]
+    assert unique.num_duplicates == 2
+    assert unique.row_counts() == [2, 2, 2, 2, 1]
+    assert unique.broadcast(["a", "b", "c"]) == ["a", "b", "a", "b", "c"]
+    with pytest.raises(ValueError):
+        unique.broadcast(["a", "b"])
+
+    unique = deduplicate_reactions(reactions, canonical=False)
+    assert unique.reactions == [
+        "OCC.CC(=O)O>>CCOC(C)=O",
+        "CC>>CC",
+        "CC(=O)O.CCO>>O=C(C)OCC",
+        "invalid",
+    ]
+    assert unique.row_counts() == [1, 2, 1, 2, 1]
+
+
+def test_duplicate_store():
+    chunks = [
+        ["OCC.CC(=O)O>>CCOC(C)=O", "CC>>CC", "CC>>CC"],
+        ["CC(=O)O.CCO>>O=C(C)OCC", "CCO>>CC=O"],
+        ["CC>>CC", "CCO>>CC=O", "CCO>>CC=O"],
+    ]
+    processed = []
+
+    def process(stored):
+        reactions = [stored.unique.reactions[i] for i in stored.missing]
+        processed.extend(reactions)
+        return stored.fill([f"result {len(processed)}" for _ in reactions])
+
+    with DuplicateStore(max_results=1) as store:
+        for chunk in chunks:
+            store.count(chunk)
+
+        stored = store.deduplicate(chunks[0])
+        assert stored.missing == [0, 1]
+        assert stored.first == [True, True]
+        assert stored.unique.row_counts() == [2, 3, 3]
+        results = process(stored)
+        store.put(stored, results)
+        assert stored.unique.broadcast(results) == ["result 2"] * 3
+        # The oldest result is dropped
+        assert len(store) == 1
+
+        stored = store.deduplicate(chunks[1])
+        assert stored.missing == [0, 1]
+        assert stored.first == [False, True]
+        assert stored.remaining == [0, 2]
+        results = process(stored)
+        store.put(stored, results)
+        assert len(store) == 1
+
+        # The duplicates of the previous chunks reuse their results
+        stored = store.deduplicate(chunks[2])
+        assert stored.missing == [0]
+        assert stored.unique.row_counts() == [3, 3, 3]
+        assert stored.remaining == [0, 0]
+        assert stored.results == [None, "result 4"]
+        store.put(stored, process(stored))
+        assert len(store) == 0
+
+        assert processed == [
+            "OCC.CC(=O)O>>CCOC(C)=O",
+            "CC>>CC",
+            "CC(=O)O.CCO>>O=C(C)OCC",
+            "CCO>>CC=O",
+            "CC>>CC",
+        ]
+
+        with pytest.raises(ValueError):
+            store.deduplicate(["C>>C"])
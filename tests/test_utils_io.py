@@ -0,0 +1,78 @@
+import os
+import tempfile
+
+import pandas as pd
+import pytest
+
+from dar.io import (
+    DataFormat,
+    TableWriter,
+    get_output_path,
+    iter_table_chunks,
+    read_table,
+    write_part,
+)
+
+
+@pytest.fixture
+def tagged_df() -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "tagged_products": ["CC[Cl:1]", "C[O:1]C", "", "CCC"],
+            "num_tags": [1, 1, 0, 0],
+            "tag_combinations": [1, 1, 0, 0],
+        }
+    )
+
+
+def test_get_output_path():
+    assert get_output_path("data/uspto.mapped.csv", "tagged") == os.path.join(
+        "data", "uspto.tagged.csv"
+    )
+    assert get_output_path(
+        "/data/v1.2/uspto.csv", "tagged", DataFormat.PARQUET
+    ) == os.path.join("/data/v1.2", "uspto.tagged.parquet")
+
+
+def test_data_format_from_path():
+    assert DataFormat.from_path("a.mapped.csv") is DataFormat.CSV
+    assert DataFormat.from_path("a.mapped.parquet/") is DataFormat.PARQUET
+    assert DataFormat.from_path("a.feather") is DataFormat.ARROW
+
+
+@pytest.mark.parametrize("data_format", list(DataFormat))
+def test_table_writer(tagged_df, data_format):
+    if data_format is not DataFormat.CSV:
+        pytest.importorskip("pyarrow")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "data.tagged" + data_format.extension)
+        with TableWriter(path) as writer:
+            writer.write(tagged_df.iloc[:3])
+            writer.write(tagged_df.iloc[3:])
+
+        df = read_table(path, columns=["tagged_products", "num_tags"])
+        assert df["tagged_products"].fillna("").to_list() == [
+            "CC[Cl:1]",
+            "C[O:1]C",
+            "",
+            "CCC",
+        ]
+        assert df["num_tags"].to_list() == [1, 1, 0, 0]
+        if data_format is not DataFormat.CSV:
+            assert df["num_tags"].dtype == "int16"
+
+        chunks = list(iter_table_chunks(path, chunk_size=3, columns=["num_tags"]))
+        assert [chunk.index.to_list() for chunk in chunks] == [[0, 1, 2], [3]]
+
+
+def test_write_part(tagged_df):
+    pytest.importorskip("pyarrow")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "data.mapped.parquet")
+        write_part(tagged_df.iloc[:2], path, 0, DataFormat.PARQUET)
+        write_part(tagged_df.iloc[2:], path, 1, DataFormat.PARQUET)
+
+        assert sorted(os.listdir(path)) == ["part-00000.parquet", "part-00001.parquet"]
+        assert read_table(path)["tag_combinations"].to_list() == [1, 1, 0, 0]
@@ -0,0 +1,116 @@
+import json
+import os
+import tempfile
+from typing import Any
+
+import pytest
+
+from dar import metrics
+from dar.chem import FragmentCache, standardise_reaction_component
+from dar.parallel import imap_ordered
+from dar.tagging import find_number_tags, tag_reactions
+
+
+@pytest.fixture
+def enabled_metrics():
+    metrics.reset()
+    metrics.enable()
+    yield
+    metrics.disable()
+    metrics.reset()
+
+
+def _count_tags(smiles: Any) -> int:
+    metrics.increment("calls")
+    return find_number_tags(smiles)
+
+
+def test_disabled_metrics_are_not_recorded():
+    metrics.reset()
+    metrics.increment("rdkit_parses", function="test")
+    with metrics.stage("test", rows=10):
+        pass
+    assert metrics.to_dict() == {"counters": {}, "timers": {}, "rows_per_second": {}}
+
+
+def test_counters_and_stages(enabled_metrics):
+    metrics.increment("failures", function="f", reason="ValueError")
+    metrics.increment("failures", 2, reason="ValueError", function="f")
+    with metrics.stage("tagging", rows=10):
+        pass
+
+    recorded = metrics.to_dict()
+    assert recorded["counters"]['failures{function="f",reason="ValueError"}'] == 3
+    assert recorded["counters"]['stage_rows{stage="tagging"}'] == 10
+    assert recorded["timers"]['stage_seconds{stage="tagging"}']["count"] == 1
+    assert recorded["rows_per_second"]["tagging"] > 0
+
+
+def test_library_metrics(enabled_metrics):
+    cache = FragmentCache()
+    standardise_reaction_component("OCC.O.OCC", cache=cache)
+    standardise_reaction_component("C1.C1", cache=cache)
+    standardise_reaction_component("C1.C", cache=cache)
+    find_number_tags(float("nan"))  # type: ignore
+    list(tag_reactions(["CC[Cl:1]>>CC[Cl:1]", "invalid"]))
+
+    counters = metrics.to_dict()["counters"]
+    assert counters["fragment_cache_hits"] == 1
+    assert counters["fragment_cache_misses"] == 4
+    assert (
+        counters[
+            'fallbacks{function="standardise_reaction_component",'
+            'reason="whole_component"}'
+        ]
+        == 2
+    )
+    assert (
+        counters[
+            'failures{function="standardise_reaction_component",'
+            'reason="InvalidSmiles"}'
+        ]
+        == 1
+    )
+    assert counters['failures{function="find_number_tags",reason="TypeError"}'] == 1
+    assert counters['failures{function="tag_reaction",reason="ValueError"}'] == 1
+    assert counters['rdkit_parses{function="tag_reaction"}'] == 2
+
+
+def test_worker_metrics_are_merged(enabled_metrics):
+    metrics.increment("calls")
+    results = list(imap_ordered(_count_tags, ["[C:1]", "C", 3], n_workers=2))
+
+    assert results == [1, 0, 0]
+    counters = metrics.to_dict()["counters"]
+    assert counters["calls"] == 4
+    assert counters['failures{function="find_number_tags",reason="TypeError"}'] == 1
+
+
+def test_write_metrics(enabled_metrics):
+    metrics.increment("rdkit_parses", 3, function="tag_reaction")
+    with metrics.stage("tagging", rows=5):
+        pass
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        json_path = os.path.join(tmpdir, "metrics.json")
+        metrics.write_metrics(json_path)
+        with open(json_path) as f:
+            assert json.load(f)["counters"] == {
+                'rdkit_parses{function="tag_reaction"}': 3,
+                'stage_rows{stage="tagging"}': 5,
+            }
+
+        prometheus_path = os.path.join(tmpdir, "metrics.prom")
+        metrics.write_metrics(prometheus_path)
+        with open(prometheus_path) as f:
+            lines = f.read().splitlines()
+
+        # Any other extension is JSON, as documented by the --metrics_file options
+        text_path = os.path.join(tmpdir, "metrics.txt")
+        metrics.write_metrics(text_path)
+        with open(text_path) as f:
+            assert "counters" in json.load(f)
+    assert "# TYPE dar_rdkit_parses_total counter" in lines
+    assert 'dar_rdkit_parses_total{function="tag_reaction"} 3' in lines
+    assert 'dar_stage_seconds_count{stage="tagging"} 1' in lines
+    assert any(line.startswith("dar_stage_rows_per_second") for line in lines)
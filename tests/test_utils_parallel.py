@@ -0,0 +1,37 @@
+from itertools import islice
+
+from dar.parallel import create_pool, imap_ordered
+
+
+def _square(x: int) -> int:
+    return x * x
+
+
+def test_imap_ordered():
+    expected = [x * x for x in range(100)]
+    assert list(imap_ordered(_square, range(100))) == expected
+    assert list(imap_ordered(_square, range(100), n_workers=2, chunksize=3)) == expected
+    assert list(imap_ordered(_square, [], n_workers=2)) == []
+
+    # Stops consuming the input when the results are not consumed anymore
+    assert list(
+        islice(imap_ordered(_square, range(10**9), n_workers=2, chunksize=4), 5)
+    ) == [0, 1, 4, 9, 16]
+
+
+def test_imap_ordered_with_pool():
+    assert create_pool(1) is None
+
+    pool = create_pool(2)
+    assert pool is not None
+    with pool:
+        for start in range(3):
+            assert list(
+                imap_ordered(
+                    _square,
+                    range(start, start + 10),
+                    n_workers=2,
+                    chunksize=2,
+                    pool=pool,
+                )
+            ) == [x * x for x in range(start, start + 10)]
@@ -0,0 +1,241 @@
+import filecmp
+import os
+import subprocess
+import sys
+import tempfile
+
+import pandas as pd
+import pytest
+
+from dar.io import get_output_path
+from dar.sharding import (
+    ROW_ID_COLUMN,
+    ShardClaim,
+    ShardManifest,
+    create_shard_run,
+    get_shard_index,
+    get_shard_input_path,
+    get_shard_output_path,
+    mark_shard_done,
+    merge_shards,
+    merge_sorted_tables,
+    promote_shard_run,
+    split_dataset,
+)
+from dar.stats import get_stats_path
+
+REACTIONS = [
+    "CC(=O)O.OCC>>CCOC(C)=O",
+    "CC(=O)Cl.Nc1ccccc1>>CC(=O)Nc1ccccc1",
+    "CCBr.Oc1ccccc1>>CCOc1ccccc1",
+    "CC(=O)O.OCC>>CCOC(C)=O",
+    "O=C(O)c1ccccc1.OC>>COC(=O)c1ccccc1",
+]
+
+MAPPED_REACTIONS = [
+    "Cl[C:2]([CH3:1])=[O:3].[NH2:4][CH3:5]>>[CH3:1][C:2](=[O:3])[NH:4][CH3:5]",
+    "[CH3:9][NH2:8].[CH3:6][C:7](Cl)=[O:10]>>[CH3:6][C:7](=[O:10])[NH:8][CH3:9]",
+    "CCBr.[OH:1][c:2]1[cH:3][cH:4][cH:5][cH:6][cH:7]1>>"
+    "CC[O:1][c:2]1[cH:3][cH:4][cH:5][cH:6][cH:7]1",
+    "[CH3:1][OH:2]>>[CH3:1][OH:2]",
+    "Cl[C:2]([CH3:1])=[O:3].[NH2:4][CH3:5]>>[CH3:1][C:2](=[O:3])[NH:4][CH3:5]",
+    ">>",
+]
+
+TAG_ANALYSIS_SCRIPT = os.path.join(
+    os.path.dirname(__file__), os.pardir, "notebooks_and_scripts", "tag_analysis.py"
+)
+
+
+def _write_mapped(input_path: str) -> str:
+    """Mapped output of a file of already mapped reactions, as map_reactions.py."""
+    data = pd.read_csv(input_path)
+    data["mapped_rxn"] = data["rxn"]
+    mapped_path = get_output_path(input_path, "mapped")
+    data.to_csv(mapped_path, index=False)
+    return mapped_path
+
+
+def _tag(mapped_path: str) -> None:
+    subprocess.run(
+        [
+            sys.executable,
+            TAG_ANALYSIS_SCRIPT,
+            "--file_path",
+            mapped_path,
+            "--chunk_size",
+            "2",
+            "--n_workers",
+            "2",
+            "--deduplicate",
+            "--extract_templates",
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def test_get_shard_index():
+    assert get_shard_index(REACTIONS[0], 3) == get_shard_index(REACTIONS[3], 3)
+    assert all(0 <= get_shard_index(rxn, 3) < 3 for rxn in REACTIONS)
+    assert get_shard_index(REACTIONS[1], 1) == 0
+
+
+def test_split_dataset():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file_path = os.path.join(tmpdir, "data.csv")
+        pd.DataFrame({"rxn": REACTIONS, "source": list("abcde")}).to_csv(
+            file_path, index=False
+        )
+        work_dir = os.path.join(tmpdir, "work")
+
+        manifest = split_dataset(file_path, work_dir, num_shards=3, chunk_size=2)
+        assert ShardManifest.load(work_dir) == manifest
+        assert manifest.num_rows == 5
+
+        shards = [
+            pd.read_csv(get_shard_input_path(work_dir, name))
+            for name in manifest.shard_names
+        ]
+        assert [len(shard) for shard in shards] == manifest.shard_rows
+        for i, shard in enumerate(shards):
+            assert shard.columns.tolist() == ["rxn", "source", ROW_ID_COLUMN]
+            assert shard[ROW_ID_COLUMN].is_monotonic_increasing
+            assert all(get_shard_index(rxn, 3) == i for rxn in shard["rxn"])
+        merged = pd.concat(shards).sort_values(ROW_ID_COLUMN)
+        assert merged["rxn"].tolist() == REACTIONS
+
+        # Splitting again returns the existing shards
+        assert split_dataset(file_path, work_dir, num_shards=3) == manifest
+        with pytest.raises(ValueError):
+            split_dataset(file_path, work_dir, num_shards=2)
+
+
+def test_shard_claim():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        claim = ShardClaim.acquire(tmpdir, "shard-00000")
+        assert claim is not None
+        assert ShardClaim.acquire(tmpdir, "shard-00000") is None
+        assert ShardClaim.acquire(tmpdir, "shard-00000", stale_after=3600) is None
+        assert ShardClaim.acquire(tmpdir, "shard-00001") is not None
+
+        # Claim not refreshed for longer than stale_after, taken over
+        new_claim = ShardClaim.acquire(tmpdir, "shard-00000", stale_after=0)
+        assert new_claim is not None
+        assert new_claim.path.endswith("shard-00000.1")
+        assert new_claim.owned
+        assert not claim.owned
+
+        with new_claim:
+            pass
+
+        # Released claims can be acquired again, stale or not
+        claim.release()
+        assert new_claim.owned
+        new_claim.release()
+        claim = ShardClaim.acquire(tmpdir, "shard-00000")
+        assert claim is not None and claim.owned
+
+
+def test_merge_sorted_tables():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = [os.path.join(tmpdir, f"shard-{i}.csv") for i in range(3)]
+        row_ids = [[0, 3, 4, 8], [1, 2, 9], []]
+        for path, ids in zip(paths, row_ids):
+            pd.DataFrame(
+                {"value": [f"row {i}" for i in ids], ROW_ID_COLUMN: ids},
+                columns=["value", ROW_ID_COLUMN],
+            ).to_csv(path, index=False)
+        output_path = os.path.join(tmpdir, "merged.csv")
+
+        assert merge_sorted_tables(paths, output_path, chunk_size=2) == 7
+        merged = pd.read_csv(output_path)
+        assert merged.columns.tolist() == ["value"]
+        assert merged["value"].tolist() == [f"row {i}" for i in [0, 1, 2, 3, 4, 8, 9]]
+
+        assert merge_sorted_tables(paths[2:], output_path) == 0
+        assert pd.read_csv(output_path).columns.tolist() == ["value"]
+
+
+def test_merge_shards():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file_path = os.path.join(tmpdir, "data.csv")
+        pd.DataFrame({"rxn": MAPPED_REACTIONS, "source": list("abcdef")}).to_csv(
+            file_path, index=False
+        )
+
+        # Single-node run
+        _tag(_write_mapped(file_path))
+        # The duplicates are counted over the chunks
+        tagged = pd.read_csv(os.path.join(tmpdir, "data.tagged.csv"))
+        assert tagged["duplicate_count"].tolist() == [2, 1, 1, 1, 2, 1]
+
+        work_dir = os.path.join(tmpdir, "work")
+        manifest = split_dataset(file_path, work_dir, num_shards=4)
+        assert 0 in manifest.shard_rows
+        for name in manifest.shard_names:
+            claim = ShardClaim.acquire(work_dir, name)
+            assert claim is not None
+            _tag(_write_mapped(create_shard_run(work_dir, claim)))
+            assert promote_shard_run(work_dir, claim)
+            mark_shard_done(work_dir, name)
+        output_path = os.path.join(tmpdir, "merged", "data.csv")
+        os.makedirs(os.path.dirname(output_path))
+        merge_shards(work_dir, output_path, chunk_size=2)
+
+        # The same outputs, empty shard included
+        for suffix in [
+            "mapped",
+            "tagged",
+            "tagged_filtered",
+            "templates",
+            "tagged_stats",
+            "tag_combination_stats",
+            "tagged_element_stats",
+        ]:
+            name = f"data.{suffix}.csv"
+            assert filecmp.cmp(
+                os.path.join(tmpdir, name),
+                os.path.join(tmpdir, "merged", name),
+                shallow=False,
+            ), name
+        assert filecmp.cmp(
+            get_stats_path(file_path), get_stats_path(output_path), shallow=False
+        )
+        assert (
+            len(pd.read_csv(os.path.join(tmpdir, "merged", "data.templates.csv"))) == 2
+        )
+
+
+def test_shard_runs():
+    with tempfile.TemporaryDirectory() as work_dir:
+        file_path = os.path.join(work_dir, "data.csv")
+        pd.DataFrame({"rxn": REACTIONS}).to_csv(file_path, index=False)
+        split_dataset(file_path, work_dir, num_shards=1)
+
+        old_claim = ShardClaim.acquire(work_dir, "shard-00000")
+        assert old_claim is not None
+        old_input_path = create_shard_run(work_dir, old_claim)
+        # Taken over while the old node still runs
+        new_claim = ShardClaim.acquire(work_dir, "shard-00000", stale_after=0)
+        assert new_claim is not None
+        new_input_path = create_shard_run(work_dir, new_claim)
+
+        # Each claim writes its outputs next to its own link to the shard input
+        assert os.path.dirname(old_input_path) != os.path.dirname(new_input_path)
+        for input_path in [old_input_path, new_input_path]:
+            assert pd.read_csv(input_path)["rxn"].tolist() == REACTIONS
+            pd.DataFrame({"run": [input_path]}).to_csv(
+                get_output_path(input_path, "mapped"), index=False
+            )
+        assert create_shard_run(work_dir, new_claim) == new_input_path
+
+        # The first run to complete is promoted
+        assert promote_shard_run(work_dir, new_claim)
+        assert not promote_shard_run(work_dir, old_claim)
+        assert not os.path.exists(os.path.dirname(old_input_path))
+        output_path = get_shard_output_path(work_dir, "shard-00000")
+        assert pd.read_csv(output_path)["rxn"].tolist() == REACTIONS
+        assert pd.read_csv(get_output_path(output_path, "mapped"))["run"].tolist() == [
+            new_input_path
+        ]
@@ -0,0 +1,73 @@
+import json
+import os
+import tempfile
+
+import pandas as pd
+import pytest
+
+from dar.shards import (
+    SPECIAL_TOKENS,
+    ShardReader,
+    build_vocab,
+    write_shard,
+    write_shards,
+)
+from dar.tokenisation import tokenize_and_split_reaction_smiles
+
+TAGGED_RXNS = [
+    "CC(C)C(=O)Cl.Nc1ccccc1>>CC(C)[C:1](=O)[NH:1]c1ccccc1",
+    "not a tagged reaction",
+    "CCO.CC(=O)O>>CC[O:1]C(C)=O",
+    "CCBr.Oc1ccccc1>>CC[O:1]c1ccccc1",
+]
+
+
+def test_build_vocab():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_shard(os.path.join(tmpdir, "shard-00000"), [("C C O", "C . O")])
+        write_shard(os.path.join(tmpdir, "shard-00001"), [("N", "C N")])
+
+        # Most frequent tokens first, ties broken alphabetically
+        assert build_vocab(tmpdir) == SPECIAL_TOKENS + ["C", "N", "O", "."]
+        assert build_vocab(tmpdir, max_size=1) == SPECIAL_TOKENS + ["C"]
+        with open(os.path.join(tmpdir, "vocab.json")) as f:
+            assert json.load(f)["counts"] == [0, 0, 0, 0, 4]
+
+        reader = ShardReader(tmpdir)
+        src, tgt = reader[1]
+        assert reader.decode(src) == "<unk>"
+        assert reader.decode(tgt) == "C <unk>"
+
+
+def test_write_shards():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file_path = os.path.join(tmpdir, "data.tagged_filtered.csv")
+        pd.DataFrame({"tagged_rxn": TAGGED_RXNS}).to_csv(file_path, index=False)
+        output_dir = os.path.join(tmpdir, "shards")
+
+        # Shards of a previous run are replaced
+        write_shards(file_path, output_dir, shard_size=1)
+        assert write_shards(file_path, output_dir, shard_size=2) == 3
+        assert sorted(os.listdir(output_dir)) == [
+            "shard-00000",
+            "shard-00001",
+            "vocab.json",
+        ]
+
+        reader = ShardReader(output_dir)
+        assert len(reader) == 3
+        expected = [
+            tokenize_and_split_reaction_smiles(rxn)
+            for rxn in TAGGED_RXNS
+            if rxn != "not a tagged reaction"
+        ]
+        for i in [2, 0, -2]:
+            src, tgt = reader[i]
+            precursors_tokens, products_tokens = expected[i]
+            assert reader.decode(src) == products_tokens
+            assert reader.decode(tgt) == precursors_tokens
+        assert [reader.decode(src) for src, _ in reader] == [
+            products_tokens for _, products_tokens in expected
+        ]
+        with pytest.raises(IndexError):
+            reader[3]
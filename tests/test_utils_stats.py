@@ -0,0 +1,81 @@
+import os
+import tempfile
+import warnings
+
+import pandas as pd
+
+from dar.stats import TagStatistics, get_stats_path, merge_stats_files
+
+TAGGED_DATA = pd.DataFrame(
+    {
+        "tagged_products": [
+            "CC(C)[C:1](=O)[NH:1]c1ccccc1",
+            "CC[O:1]C(C)=O",
+            "",
+            "Cl[c:1]1[cH:1]c[nH:1]c1",
+        ],
+        "num_tags": [2, 1, 0, 3],
+        "tag_combinations": [2, 1, 0, 6],
+    }
+)
+
+
+def test_tag_statistics_update():
+    stats = TagStatistics()
+    stats.update(TAGGED_DATA)
+
+    assert stats.num_reactions == 4
+    assert stats.num_tags == {0: 1, 1: 1, 2: 1, 3: 1}
+    assert stats.tag_combinations == {0: 1, 1: 1, 2: 1, 6: 1}
+    assert stats.tagged_elements == {"C": 3, "N": 2, "O": 1}
+
+
+def test_merge_stats_files():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = []
+        for i in range(2):
+            shard_stats = TagStatistics()
+            shard_stats.update(TAGGED_DATA.iloc[2 * i : 2 * i + 2])
+            paths.append(os.path.join(tmpdir, f"shard-{i}.tag_stats.json"))
+            shard_stats.save(paths[-1])
+
+        stats = TagStatistics()
+        stats.update(TAGGED_DATA)
+        merged_stats = merge_stats_files(paths)
+
+        assert merged_stats.to_dict() == stats.to_dict()
+        assert merged_stats.get_tag_report().equals(stats.get_tag_report())
+
+
+def test_get_tag_report():
+    stats = TagStatistics(num_tags={n: 1 for n in range(12)})
+    stats.num_tags[0] = 8
+
+    report = stats.get_tag_report()
+    assert report["num_tags"].tolist() == list(range(10)) + ["10+"]
+    assert report["counts"].tolist() == [8] + [1] * 9 + [2]
+    assert report["dataset_fraction"].tolist()[0] == 42.11
+
+    report = stats.get_tag_report(num_rows=2)
+    assert report["num_tags"].tolist() == [0, 1, "2+"]
+    assert report["counts"].tolist() == [8, 1, 10]
+
+    # Bucketed by value, not by rank
+    stats = TagStatistics(num_tags={0: 4, 1: 3, 3: 2, 5: 1})
+    report = stats.get_tag_report(num_rows=3)
+    assert report["num_tags"].tolist() == [0, 1, "3+"]
+    assert report["counts"].tolist() == [4, 3, 3]
+    assert report["dataset_fraction"].tolist() == [40.0, 30.0, 30.0]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        report = TagStatistics().get_tag_report(num_rows=3)
+    assert report["num_tags"].tolist() == ["3+"]
+    assert report["counts"].tolist() == [0]
+    assert report["dataset_fraction"].tolist() == [0.0]
+
+
+def test_get_stats_path():
+    assert get_stats_path("data/uspto.mapped.csv") == os.path.join(
+        "data", "uspto.tag_stats.json"
+    )
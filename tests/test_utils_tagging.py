@@ -1,4 +1,25 @@
-from dar.tagging import find_number_tags, get_tagged_products, return_tag_combinations
+import random
+from itertools import combinations
+
+import pytest
+from rdkit import Chem
+
+from dar.tagging import (
+    CandidateStatus,
+    TagCombinations,
+    TaggedSmilesCache,
+    count_tag_combinations,
+    find_number_tags,
+    get_tag_combinations_id_dict,
+    get_tagged_products,
+    permute_tagged_smiles,
+    return_tag_combinations,
+    tag_reaction,
+    tag_reactions,
+    unrank_combination,
+    validate_tagged_candidate_batch,
+    validate_tagged_candidates,
+)
 
 
 def test_get_tagged_products():
@@ -85,3 +106,149 @@ def test_return_tag_combinations():
         return_tag_combinations("CC[c:1]1[cH:1][c:1]([NH2:1])[cH:1][cH:1][c:1]1[OH:1]")
         == 92
     )
+
+
+def test_tag_reaction():
+    rxn = (
+        "CCN(C(C)C)C(C)C.CN(C)C=O.Cc1ccc(S(=O)(=O)O[CH2:10][CH2:11][CH:12]2"
+        "[CH2:13][O:14][c:15]3[cH:16][cH:17][cH:18][cH:19][c:20]3[O:21]2)cc1.[CH3:1]"
+        "[CH2:2][O:3][C:4](=[O:5])[CH:6]1[CH2:7][CH2:8][NH:9][CH2:22][CH2:23]1>>[CH3:1]"
+        "[CH2:2][O:3][C:4](=[O:5])[CH:6]1[CH2:7][CH2:8][N:9]([CH2:10][CH2:11][CH:12]2"
+        "[CH2:13][O:14][c:15]3[cH:16][cH:17][cH:18][cH:19][c:20]3[O:21]2)[CH2:22]"
+        "[CH2:23]1"
+    )
+    precursors, products = rxn.split(">>")
+
+    result = tag_reaction(precursors, products)
+
+    assert result.tagged_products == get_tagged_products(precursors, products)
+    assert result.tagged_products == "CCOC(=O)C1CC[N:1]([CH2:1]CC2COc3ccccc3O2)CC1"
+    assert result.changed_atoms == {9, 10}
+    assert result.num_tags == find_number_tags(result.tagged_products)
+    assert result.tag_combinations == return_tag_combinations(result.tagged_products)
+
+
+def test_count_tag_combinations():
+    assert count_tag_combinations(0) == 0
+    assert count_tag_combinations(1) == 0
+    assert count_tag_combinations(2) == 2
+    assert count_tag_combinations(4) == 14
+    assert count_tag_combinations(8) == 92
+    assert count_tag_combinations(8, max_tags=6) == 8 + 28 + 56 + 70 + 56
+    assert count_tag_combinations(30, max_tags=12) == sum(
+        len(TagCombinations(range(30), n)) for n in range(1, 12)
+    )
+
+
+def test_unrank_combination():
+    items = [3, 5, 8, 13, 21, 34]
+    for size in range(1, len(items) + 1):
+        assert [
+            unrank_combination(items, size, rank)
+            for rank in range(len(TagCombinations(items, size)))
+        ] == list(combinations(items, size))
+
+
+def test_get_tag_combinations_id_dict():
+    mol = Chem.MolFromSmiles("CC[c:1]1[cH:1][c:1]([NH2:1])[cH:1][cH:1][c:1]1[OH:1]")
+    tag_combinations = get_tag_combinations_id_dict(mol, max_tags=5)
+
+    assert list(tag_combinations.keys()) == [1, 2, 3, 4]
+    assert list(tag_combinations[2]) == list(combinations([2, 3, 4, 5, 6, 7, 8, 9], 2))
+    assert tag_combinations[3][-1] == (7, 8, 9)
+
+
+def test_permute_tagged_smiles():
+    smiles = "CC[c:1]1[cH:1][c:1]([NH2:1])[cH:1][cH:1][c:1]1[OH:1]"
+
+    permuted = permute_tagged_smiles(smiles, 2, rng=random.Random(42))
+    assert len(permuted) == 6
+    assert [find_number_tags(s) for s in permuted] == [1, 1, 2, 2, 3, 3]
+    assert permuted == permute_tagged_smiles(smiles, 2, rng=random.Random(42))
+
+    # Sampling from a very large number of combinations
+    smiles = "C" + "[CH2:1]" * 40 + "C"
+    permuted = permute_tagged_smiles(smiles, 3, max_tags=20, rng=random.Random(0))
+    assert len(permuted) == 3 * 19
+    assert [find_number_tags(s) for s in permuted[-3:]] == [19, 19, 19]
+
+
+def test_tag_reactions():
+    reactions = [
+        "O=P(Cl)(Cl)[Cl:12].O[c:11]1[c:6]([C:4]([O:3][CH2:2][CH3:1])=[O:5])[cH:7]"
+        "[n:8][c:9]2[c:10]1[CH2:13][CH2:14][CH2:15][CH2:16][CH2:17][CH2:18]2>>[CH3:1]"
+        "[CH2:2][O:3][C:4](=[O:5])[c:6]1[cH:7][n:8][c:9]2[c:10]([c:11]1[Cl:12])"
+        "[CH2:13][CH2:14][CH2:15][CH2:16][CH2:17][CH2:18]2",
+        "not a reaction",
+        "C1CC[CH2:1]>>[CH3:1]x",
+        "ClC(Cl)Cl.O=S(Cl)[Cl:5].O[CH2:4][C:2]([CH3:1])([CH3:3])[NH:6][C:7]1=[N:8]"
+        "[CH2:9][CH2:10][NH:11]1.[IH:12]>>[CH3:1][C:2]([CH3:3])([CH2:4][Cl:5])[NH:6]"
+        "[C:7]1=[N:8][CH2:9][CH2:10][NH:11]1",
+    ]
+    expected_tagged = [
+        "CCOC(=O)c1cnc2c([c:1]1[Cl:1])CCCCCC2",
+        None,
+        None,
+        "CC(C)(NC1=NCCN1)[CH2:1][Cl:1]",
+    ]
+
+    for n_workers in [1, 2]:
+        results = list(tag_reactions(reactions, n_workers=n_workers, chunksize=1))
+
+        assert [result.reaction for result in results] == reactions
+        assert [
+            result.tagged.tagged_products if result.tagged is not None else None
+            for result in results
+        ] == expected_tagged
+        assert [result.success for result in results] == [True, False, False, True]
+        assert results[1].error is not None and results[1].error.startswith(
+            "ValueError"
+        )
+
+
+def test_validate_tagged_candidates():
+    candidates = [
+        "C C [OH:1]",
+        "C C (",
+        "C C O",
+        "C C [OH:2]",
+        "C C [O:1]",
+        "[OH:1] C C",
+        "[CH3:1] C O",
+    ]
+    results = validate_tagged_candidates("C C O", candidates, cache=TaggedSmilesCache())
+
+    assert [result.candidate for result in results] == candidates
+    assert [result.tagged_smiles for result in results] == [
+        "CC[OH:1]",
+        None,
+        "CCO",
+        "CC[OH:2]",
+        "CC[O:1]",
+        "CC[OH:1]",
+        "OC[CH3:1]",
+    ]
+    assert [result.status for result in results] == [
+        CandidateStatus.VALID,
+        CandidateStatus.INVALID_SMILES,
+        CandidateStatus.INVALID_TAGS,
+        CandidateStatus.INVALID_TAGS,
+        CandidateStatus.SKELETON_MISMATCH,
+        CandidateStatus.DUPLICATE,
+        CandidateStatus.VALID,
+    ]
+
+
+def test_validate_tagged_candidate_batch():
+    cache = TaggedSmilesCache(max_size=3)
+    results = validate_tagged_candidate_batch(
+        ["CCO", "OCC"], [["CC[OH:1]", "[OH:1]CC"], ["CC[OH:1]"]], cache=cache
+    )
+
+    assert [[result.valid for result in r] for r in results] == [[True, False], [True]]
+    # Product and candidates of the first product, then the second product
+    assert (cache.misses, cache.hits) == (4, 1)
+    assert len(cache) == 3
+
+    with pytest.raises(ValueError):
+        validate_tagged_candidate_batch(["CCO"], [])
@@ -0,0 +1,123 @@
+import os
+import tempfile
+
+import pandas as pd
+from rdkit import Chem
+from rdkit.Chem import rdChemReactions
+from rxn.chemutils.conversion import canonicalize_smiles
+from rxn.chemutils.utils import remove_atom_mapping
+
+from dar.tagging import tag_reaction
+from dar.templates import (
+    TEMPLATE_COLUMNS,
+    TemplateTable,
+    extract_template,
+    extract_templates,
+)
+
+AMIDE_RXNS = [
+    "Cl[C:2]([CH3:1])=[O:3].[NH2:4][CH3:5]>>[CH3:1][C:2](=[O:3])[NH:4][CH3:5]",
+    "[CH3:9][NH2:8].[CH3:6][C:7](Cl)=[O:10]>>[CH3:6][C:7](=[O:10])[NH:8][CH3:9]",
+]
+
+
+def test_extract_template():
+    # Same template, whatever the atom maps of the reaction
+    for rxn in AMIDE_RXNS:
+        precursors, products = rxn.split(">>")
+        assert extract_template(precursors, products, radius=0) == (
+            "[C:1]-[NH:2]>>[Cl]-[C:1].[NH2:2]"
+        )
+        assert extract_template(precursors, products) == (
+            "[CH3:1]-[NH:2]-[C:3](-[CH3:4])=[O:5]"
+            ">>[Cl]-[C:3](-[CH3:4])=[O:5].[CH3:1]-[NH2:2]"
+        )
+
+
+APPLICABLE_RXNS = AMIDE_RXNS + [
+    # Chlorination, with leaving groups on the precursor side
+    "O=P(Cl)(Cl)[Cl:12].O[c:11]1[c:6]([C:4]([O:3][CH2:2][CH3:1])=[O:5])[cH:7]"
+    "[n:8][c:9]2[c:10]1[CH2:13][CH2:14][CH2:15][CH2:16][CH2:17][CH2:18]2>>[CH3:1]"
+    "[CH2:2][O:3][C:4](=[O:5])[c:6]1[cH:7][n:8][c:9]2[c:10]([c:11]1[Cl:12])"
+    "[CH2:13][CH2:14][CH2:15][CH2:16][CH2:17][CH2:18]2",
+    # Deprotection, with an unmapped protecting group
+    "CC(C)(C)[O:1][C:2](=[O:3])[NH:4][CH2:5][c:6]1[cH:7][cH:8][cH:9][cH:10][cH:11]1"
+    ">>[NH2:4][CH2:5][c:6]1[cH:7][cH:8][cH:9][cH:10][cH:11]1",
+]
+
+
+def test_extract_template_applies_to_example():
+    for rxn in APPLICABLE_RXNS:
+        precursors, products = rxn.split(">>")
+        expected = set(canonicalize_smiles(remove_atom_mapping(precursors)).split("."))
+        for radius in [0, 1]:
+            product_template, precursor_template = extract_template(
+                precursors, products, radius
+            ).split(">>")
+            # Product side as a single component, whatever its fragments
+            reaction = rdChemReactions.ReactionFromSmarts(
+                f"({product_template})>>{precursor_template}"
+            )
+            outcomes = [
+                {canonicalize_smiles(Chem.MolToSmiles(mol)) for mol in outcome}
+                for outcome in reaction.RunReactants(
+                    (Chem.MolFromSmiles(remove_atom_mapping(products)),)
+                )
+            ]
+            # The precursors that react are among the ones of the example
+            assert any(outcome <= expected for outcome in outcomes), (rxn, radius)
+
+
+def test_extract_templates():
+    reactions = AMIDE_RXNS + ["[CH3:1][OH:2]>>[CH3:1][OH:2]", "not a reaction"]
+    results = list(extract_templates(reactions, n_workers=2, chunksize=1))
+
+    assert [result.reaction for result in results] == reactions
+    assert [result.success for result in results] == [True, True, False, False]
+    assert results[0].template == results[1].template
+    assert results[2].error is not None and results[2].error.startswith(
+        "ValueError: No reaction centre"
+    )
+
+
+def test_tag_reaction_template():
+    # Extracted from the molecules parsed for tagging
+    for radius in [0, 1]:
+        for rxn in AMIDE_RXNS:
+            precursors, products = rxn.split(">>")
+            result = tag_reaction(precursors, products, template_radius=radius)
+            assert result.template == extract_template(precursors, products, radius)
+            assert (
+                result.tagged_products
+                == tag_reaction(precursors, products).tagged_products
+            )
+    precursors, products = AMIDE_RXNS[0].split(">>")
+    assert tag_reaction(precursors, products).template is None
+
+    # No reaction centre: tagged, but without template
+    result = tag_reaction("[CH3:1][OH:2]", "[CH3:1][OH:2]", template_radius=1)
+    assert result.num_tags == 0
+    assert result.template is None
+
+
+def test_template_table():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "data.templates.csv")
+        with TemplateTable(path, buffer_size=1) as table:
+            first_hash = table.add("[C:1]>>[C:1]", "a", count=2)
+            table.add("[N:1]>>[N:1]", "b")
+            assert table.add("[C:1]>>[C:1]", "c") == first_hash
+            assert len(table) == 2
+
+        assert os.listdir(tmpdir) == ["data.templates.csv"]
+        df = pd.read_csv(path)
+        assert df.columns.tolist() == TEMPLATE_COLUMNS
+        assert df["template_hash"].tolist()[0] == first_hash
+        assert df["retro_template"].tolist() == ["[C:1]>>[C:1]", "[N:1]>>[N:1]"]
+        assert df["count"].tolist() == [3, 1]
+        assert df["example_rxn"].tolist() == ["a", "b"]
+
+        # Empty table
+        with TemplateTable(path):
+            pass
+        assert pd.read_csv(path).columns.tolist() == TEMPLATE_COLUMNS
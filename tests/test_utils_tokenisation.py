@@ -0,0 +1,61 @@
+import os
+import tempfile
+
+import pandas as pd
+
+from dar.tokenisation import (
+    detokenize_and_split_enzymatic_reaction_smiles,
+    tokenize_and_split_reaction_smiles,
+    tokenize_reactions,
+    write_token_files,
+)
+
+TAGGED_RXNS = [
+    "CC(C)C(=O)Cl.Nc1ccccc1>>CC(C)[C:1](=O)[NH:1]c1ccccc1",
+    "not a tagged reaction",
+    "CCO.CC(=O)O>>CC[O:1]C(C)=O",
+]
+
+
+def test_tokenize_and_split_reaction_smiles():
+    assert tokenize_and_split_reaction_smiles(TAGGED_RXNS[2]) == (
+        "C C O . C C ( = O ) O",
+        "C C [O:1] C ( C ) = O",
+    )
+    assert tokenize_and_split_reaction_smiles(
+        "CC(=O)O.OCC|3.1.1.1>>CC[O:1]C(C)=O", enzymatic=True
+    ) == ("C C ( = O ) O . O C C [v3] [u1] [t1] [q1]", "C C [O:1] C ( C ) = O")
+
+
+def test_detokenize_and_split_enzymatic_reaction_smiles():
+    assert detokenize_and_split_enzymatic_reaction_smiles(
+        "C C ( = O ) O . O C C [v3] [u1] [t1] [q1] >> C C O C ( C ) = O"
+    ) == ("CC(=O)O.OCC", "3.1.1.1", "CCOC(C)=O")
+
+
+def test_tokenize_reactions():
+    results = list(tokenize_reactions(TAGGED_RXNS, n_workers=2, chunksize=1))
+
+    assert [rxn for rxn, _ in results] == TAGGED_RXNS
+    assert results[1][1] is None
+    assert results[2][1] == tokenize_and_split_reaction_smiles(TAGGED_RXNS[2])
+
+
+def test_write_token_files():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file_path = os.path.join(tmpdir, "data.tagged_filtered.csv")
+        pd.DataFrame({"tagged_rxn": TAGGED_RXNS}).to_csv(file_path, index=False)
+        output_prefix = os.path.join(tmpdir, "data.tagged_filtered")
+
+        assert write_token_files(file_path, output_prefix, chunk_size=2) == 2
+
+        with open(output_prefix + ".products_tokens") as f:
+            assert f.read().splitlines() == [
+                "C C ( C ) [C:1] ( = O ) [NH:1] c 1 c c c c c 1",
+                "C C [O:1] C ( C ) = O",
+            ]
+        with open(output_prefix + ".precursors_tokens") as f:
+            assert f.read().splitlines() == [
+                "C C ( C ) C ( = O ) Cl . N c 1 c c c c c 1",
+                "C C O . C C ( = O ) O",
+            ]